@@ -0,0 +1,255 @@
+"""Host agent programs in worker processes, talking through shared memory.
+
+An AgentHost makes n agents with AgentFactory inside worker processes,
+and gives back n RemoteAgent proxies to put in an Environment.  Percepts
+and actions cross over as fixed-size integer records in shared arrays:
+a codec turns each percept into codec.width ints, and each action is
+sent as its number in the list of actions.  AgentHost.step(env) steps a
+whole environment with one round of synchronization per worker, however
+many remote agents there are; calling a proxy's program on its own also
+works, but costs a round per call.
+
+>>> class Counter(Environment):
+...     def percept(self, agent): return ('Dirty', (agent.performance, 1))
+...     def execute_action(self, agent, action):
+...         if action == 'Suck': agent.performance += 1
+>>> host = AgentHost(lambda: RandomAgent(['Suck']), 4, VacuumCodec(),
+...                  ['Suck', 'NoOp'], workers=2)
+>>> host.exchange([(0, ('Dirty', (1, 1))), (3, ('Clean', (2, 1)))])
+['Suck', 'Suck']
+>>> host.agents[1].program(('Clean', (1, 1)))
+'Suck'
+>>> env = Counter()
+>>> for agent in host.agents:
+...     agent.performance = 0
+...     env.agents.append(agent)
+>>> host.run(env, 5)
+>>> [agent.performance for agent in env.agents]
+[5, 5, 5, 5]
+>>> host.close()
+
+An agent program that fails in a worker, or a worker that dies, is
+raised in the parent as a WorkerError, with the tracebacks of all the
+programs that failed.  The host then stops its workers, and is closed:
+
+>>> def Failing():
+...     agent = Agent()
+...     agent.program = lambda percept: if_(percept[0] == 'Dirty',
+...                                         lambda: 1 / 0, lambda: os._exit(3))
+...     return agent
+>>> for percept in [('Dirty', (1, 1)), ('Clean', (1, 1))]: # doctest: +ELLIPSIS
+...     host = AgentHost(Failing, 2, VacuumCodec(), ['Suck'], workers=2)
+...     try:
+...         host.exchange([(0, percept), (1, percept)])
+...     except WorkerError, e:
+...         print str(e).count('Traceback'), str(e).splitlines()[-1]
+2 ZeroDivisionError: integer division or modulo by zero
+0 worker process ... died (exit code 3)
+>>> host.exchange([(0, ('Dirty', (1, 1)))])
+Traceback (most recent call last):
+WorkerError: the AgentHost is closed
+"""
+from agents import *
+import multiprocessing, multiprocessing.queues, traceback
+
+#______________________________________________________________________________
+
+class WorkerError (Exception):
+    "An agent program (or other code) failed in a worker process."
+
+def report_errors(fn, errors):
+    """Call fn(); if it raises, put the traceback on errors (a SimpleQueue)
+    instead, so the worker lives on and the parent can raise it."""
+    try:
+        fn()
+    except Exception:
+        errors.put(traceback.format_exc())
+
+def drain(errors):
+    "Take all the tracebacks off errors."
+    tracebacks = []
+    while not errors.empty():
+        tracebacks.append(errors.get())
+    return tracebacks
+
+def wait_for_workers(done, processes, errors, poll=1.0):
+    """Acquire done once for each of processes.  Raise WorkerError, with
+    all the tracebacks put on errors, if there are any, or if a process
+    died without releasing done.  The workers are left out of step after
+    that, so their owner should stop them."""
+    for process in processes:
+        while not done.acquire(timeout=poll):
+            for p in processes:
+                if not p.is_alive():
+                    raise WorkerError(''.join(drain(errors)) +
+                                      'worker process %s died (exit code %s)'
+                                      % (p.pid, p.exitcode))
+    tracebacks = drain(errors)
+    if tracebacks:
+        raise WorkerError('in worker processes:\n' + ''.join(tracebacks))
+
+class VacuumCodec (object):
+    """Encode vacuum world percepts, ('Dirty' or 'Clean', (x, y)), as three
+    ints.  Any codec needs .width, encode(percept) and decode(record)."""
+    width = 3
+    statuses = ['Clean', 'Dirty']
+
+    def encode(self, (status, (x, y))):
+        return (self.statuses.index(status), x, y)
+
+    def decode(self, record):
+        return (self.statuses[record[0]], (record[1], record[2]))
+
+class RemoteAgent (Agent):
+    """Stands in an Environment for the agent in slot of an AgentHost."""
+
+    def __init__(self, host, slot):
+        self.host = host
+        self.slot = slot
+        super(RemoteAgent, self).__init__()
+
+    def make_agent_program(self):
+        host, slot = self.host, self.slot
+        return lambda percept: host.exchange([(slot, percept)])[0]
+
+def host_agents(AgentFactory, first, last, codec, actions,
+                records, replies, go, done, stopping, errors):
+    """The loop of a worker process: each time go is released, run the
+    programs of agents first..last-1 on the percepts flagged in records,
+    write the action numbers into replies and release done.  A program
+    that raises is reported on errors."""
+    programs = [AgentFactory().program for i in range(first, last)]
+    codes = dict([(action, i) for (i, action) in enumerate(actions)])
+    w = codec.width + 1
+    def answer():
+        for i in range(first, last):
+            base = i * w
+            if records[base]:
+                percept = codec.decode(records[base+1:base+w])
+                replies[i] = codes.get(programs[i - first](percept), -1)
+    while True:
+        go.acquire()
+        if stopping.value: break
+        report_errors(answer, errors)
+        done.release()
+
+class AgentHost (object):
+    """Run n agents made by AgentFactory in worker processes, spread over
+    workers processes in contiguous slots.  actions lists every action the
+    agents can do; anything else comes back as None.  AgentFactory must
+    be picklable where multiprocessing cannot fork.  Call close() when
+    done, to stop the workers."""
+
+    def __init__(self, AgentFactory, n, codec, actions, workers=2):
+        self.codec = codec
+        self.actions = list(actions)
+        self.w = codec.width + 1
+        self.records = multiprocessing.RawArray('l', n * self.w)
+        self.replies = multiprocessing.RawArray('h', n)
+        self.stopping = multiprocessing.RawValue('b', 0)
+        self.done = multiprocessing.Semaphore(0)
+        self.errors = multiprocessing.queues.SimpleQueue()
+        self.flagged = []
+        self.workers = []
+        size = (n + workers - 1) // workers
+        for first in range(0, n, size):
+            go = multiprocessing.Semaphore(0)
+            process = multiprocessing.Process(
+                target=host_agents,
+                args=(AgentFactory, first, min(first + size, n), codec,
+                      self.actions, self.records, self.replies, go,
+                      self.done, self.stopping, self.errors))
+            process.daemon = True
+            process.start()
+            self.workers.append((process, go))
+        self.agents = [RemoteAgent(self, i) for i in range(n)]
+
+    def exchange(self, requests):
+        """Send a list of (slot, percept) pairs to the workers, and return
+        the list of actions the agents in those slots chose.  If a program
+        raised, or a worker died, stop the workers and raise WorkerError."""
+        if not self.workers: raise WorkerError('the AgentHost is closed')
+        records, w, encode = self.records, self.w, self.codec.encode
+        for base in self.flagged:
+            records[base] = 0
+        self.flagged = []
+        for (slot, percept) in requests:
+            base = slot * w
+            records[base:base+w] = (1,) + tuple(encode(percept))
+            self.flagged.append(base)
+        for (process, go) in self.workers:
+            go.release()
+        try:
+            wait_for_workers(self.done, [p for (p, go) in self.workers],
+                             self.errors)
+        except WorkerError:
+            self.terminate()
+            raise
+        actions, replies = self.actions, self.replies
+        return [if_(replies[slot] >= 0, lambda: actions[replies[slot]], None)
+                for (slot, percept) in requests]
+
+    def step(self, env):
+        """Run env for one time step, like Environment.step, asking all the
+        remote agents of this host for their actions in one exchange.
+        >>> class Vacuum(VacuumEnvironment):
+        ...     def percept(self, agent):
+        ...         return (self.percept_status(agent), agent.location)
+        >>> def world(agent):
+        ...     env = Vacuum(6, implicit_walls=True)
+        ...     env.batch_moves('first')
+        ...     env.add_object(agent, (1, 1))
+        ...     env.add_object(RandomAgent(['Left']), (3, 1))
+        ...     env.add_population(AgentPopulation(reflex_population_program,
+        ...         ['Suck', 'Left', 'Right', 'Up', 'Down'], [(3, 3)], seed=1))
+        ...     return env
+        >>> host = AgentHost(lambda: RandomAgent(['Right']), 1, VacuumCodec(),
+        ...                  ['Right'], workers=1)
+        >>> stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        >>> serial = world(RandomAgent(['Right']))
+        >>> hosted = world(host.agents[0])
+        >>> serial.step(); host.step(hosted)
+        >>> sys.stdout = stdout
+        >>> host.close()
+        >>> for env in [serial, hosted]:
+        ...     print ([agent.location for agent in env.agents],
+        ...            env.populations[0].positions.tolist(), env.trace.now)
+        ([(2, 1), (3, 1)], [[3, 4]], 1)
+        ([(2, 1), (3, 1)], [[3, 4]], 1)
+        """
+        if env.is_done(): return
+        env.begin_step()
+        requests, actions = [], []
+        for agent in env.agents:
+            if getattr(agent, 'host', None) is self:
+                requests.append((agent.slot, env.percept(agent)))
+                actions.append(None)
+            else:
+                actions.append(agent.program(env.percept(agent)))
+        remote = iter(self.exchange(requests))
+        for (i, agent) in enumerate(env.agents):
+            if getattr(agent, 'host', None) is self:
+                actions[i] = remote.next()
+        env.apply_actions(env.agents, actions)
+
+    def run(self, env, steps=1000):
+        """Run env for given number of time steps."""
+        for step in range(steps):
+            if env.is_done(): return
+            self.step(env)
+
+    def terminate(self):
+        "Stop the worker processes at once, whatever they are doing."
+        for (process, go) in self.workers:
+            process.terminate()
+            process.join()
+        self.workers = []
+
+    def close(self):
+        "Stop the worker processes."
+        self.stopping.value = 1
+        for (process, go) in self.workers:
+            go.release()
+        for (process, go) in self.workers:
+            process.join()
+        self.workers = []
@@ -1,3 +1,4 @@
+# -*- coding: latin-1 -*-
 """"Implement Agents and Environments (Chapters 1-2).
 
 The class hierarchies are as follows:
@@ -25,7 +26,9 @@ EnvCanvas ## Canvas to display the environment of an EnvGUI
 
 """
 from utils import *
-import random, copy
+from array import array
+import random, copy, bisect, time
+import metrics as metrics_module
 
 #______________________________________________________________________________
 
@@ -33,7 +36,41 @@ import random, copy
 class Object (object):
     """This represents any physical object that can appear in an Environment.
     You subclass Object to get the objects you want.  Each object can have a
-    .__name__  slot (used for output only)."""
+    .__name__  slot (used for output only).  Objects use __slots__ to stay
+    small on large boards; a subclass that declares no __slots__ of its own
+    gets an ordinary __dict__ and can hold any attributes.  Objects pickle
+    (and copy) their slots with any protocol, not just protocol 2.
+    >>> import pickle
+    >>> wall = Wall(); wall.location = (1, 1)
+    >>> [pickle.loads(pickle.dumps(wall, protocol)).location
+    ...  for protocol in [0, 2]]
+    [(1, 1), (1, 1)]
+    """
+    __slots__ = ('location',)
+
+    def slot_names(self):
+        "The names of the slots of self's class and its bases, in MRO order."
+        names = []
+        for cls in type(self).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            if isinstance(slots, str): slots = (slots,)
+            names.extend([name for name in slots if name not in names and
+                          name not in ('__dict__', '__weakref__')])
+        return names
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for name in self.slot_names():
+            if hasattr(self, name): state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        names = self.slot_names()
+        for name in names:
+            if name in state: setattr(self, name, state[name])
+        for (name, value) in state.items():
+            if name not in names: setattr(self, name, value)
+
     def __repr__(self):
         return '<%s>' % getattr(self, '__name__', self.__class__.__name__)
 
@@ -52,40 +89,557 @@ class Agent (Object):
     percepts.  An agent program that needs a model of the world (and of
     the agent itself) will have to build and maintain its own model.
     There is an optional slots, .performance, which is a number giving
-    the performance measure of the agent in its environment."""
+    the performance measure of the agent in its environment.
+    .percept_needs names the fields of a Percept that the program reads;
+    the environment works those out as soon as it makes the percept, and
+    leaves the rest until they are read.
+    A program marked with pure() is wrapped in a MemoProgram, which
+    remembers its action for each percept; if .share_memo is true, all the
+    agents of the class share one MemoCache."""
+    __slots__ = ('program', 'alive', 'bump', 'performance', 'holding', 'held')
+    percept_needs = ()
+    share_memo = False
 
     def __init__(self):
         self.program = self.make_agent_program()
+        if getattr(self.program, 'pure', False):
+            self.program = MemoProgram(self.program, self.memo_cache(),
+                                       self.percept_needs)
         self.alive = True
         self.bump = False
 
+    def memo_cache(self):
+        "A new MemoCache, or with share_memo, the one of this class."
+        if self.share_memo:
+            return class_memo_caches.setdefault(self.__class__, MemoCache())
+        return MemoCache()
+
     def make_agent_program(self):
         
         def program(percept):
             return raw_input('Percept=%s; action? ' % percept)
         return program
 	
-def TraceAgent(agent):
-    """Wrap the agent's program to print its input and output. This will let
-    you see what the agent is doing in the environment."""
+def TraceAgent(agent, recorder=None, on=True):
+    """Wrap the agent's program to record its input and output in recorder
+    (a TraceRecorder; by default a new one, kept as the .recorder of the
+    new program).  Recording starts at once if on is true, and otherwise
+    when recorder.enable(agent) is called.  This will let you see what the
+    agent is doing in the environment."""
+    if recorder is None: recorder = TraceRecorder()
     old_program = agent.program
+    number = recorder.register(agent, on)
+    enabled, record = recorder.enabled, recorder.record
     def new_program(percept):
         action = old_program(percept)
-        print '%s perceives %s and does %s' % (agent, percept, action)
+        if enabled.get(number): record(agent, percept, action)
         return action
+    new_program.recorder = recorder
     agent.program = new_program
     return agent
 
-class RandomAgent (Agent):
-    "An agent that chooses an action at random, ignoring all percepts."
+class Unread (object):
+    "Stands for a field of a Percept that has not been read."
+    def __repr__(self): return '?'
+
+unread = Unread()
+
+class TraceRecorder (object):
+    """The last size (step, agent, percept, action) records of the traced
+    agents, in a ring of preallocated slots.  The records hold the agent,
+    percept and action themselves, so recording formats no strings, and
+    memory is bounded by the ring: a value is kept only while a record
+    refers to it.  A Percept is stored as the tuple of the fields the
+    program read, so that the record does not keep the environment.
+    .now is the step number to record (Environment.step moves it on), and
+    .enabled[n] says whether agent number n is traced; .agents[n] is the
+    agent, until it is forgotten.  With echo, each record is also printed
+    as it is made.
+    >>> trace = TraceRecorder(size=2)
+    >>> agent = TraceAgent(RandomAgent(['Suck']), trace)
+    >>> for step in range(3):
+    ...     trace.now = step
+    ...     action = agent.program(('Clean', (step, 1)))
+    >>> trace.dump()
+    step 1: <RandomAgent> perceives ('Clean', (1, 1)) and does Suck
+    step 2: <RandomAgent> perceives ('Clean', (2, 1)) and does Suck
+    >>> trace.forget(agent)
+    >>> trace.agents, len(trace.last())
+    ({}, 2)
+
+    An environment registers its agents in its .trace, but only records
+    what those that are enabled (say, from the GUI) do:
+
+    >>> env = Environment()
+    >>> env = env.add_object(Agent())
+    >>> env.trace.enabled.values()
+    [0]
+    >>> env.trace.enable(env.agents[0])
+    >>> env.trace.enabled.values()
+    [1]
+    """
+
+    def __init__(self, size=10000, echo=False):
+        self.size, self.echo = size, echo
+        self.count = 0        ## Records made so far
+        self.now = 0
+        self.agents = {}      ## Agent number -> agent, while registered
+        self.enabled = {}     ## Agent number -> whether it is traced
+        self.numbers = 0      ## Agent numbers given so far
+        self.columns = None   ## Made on the first record
+
+    def register(self, agent, on=True):
+        "Give agent a number, enabled if on, and return it."
+        number = self.numbers
+        self.numbers += 1
+        self.agents[number] = agent
+        self.enabled[number] = int(on)
+        return number
+
+    def forget(self, agent):
+        """Stop tracing agent (as when it leaves the environment), and drop
+        it, once its records have left the ring."""
+        for (number, a) in self.agents.items():
+            if a is agent:
+                del self.agents[number], self.enabled[number]
+
+    def enable(self, agent, on=True):
+        for (number, a) in self.agents.items():
+            if a is agent: self.enabled[number] = int(on)
+
+    def record(self, agent, percept, action):
+        "Record that agent perceived percept and did action."
+        if self.columns is None:
+            self.columns = [array('l', [0]) * self.size, [None] * self.size,
+                            [None] * self.size, [None] * self.size]
+        if isinstance(percept, Percept):
+            percept = tuple([percept.values.get(name, unread)
+                             for name in percept.fields])
+        i = self.count % self.size
+        steps, agents, percepts, actions = self.columns
+        steps[i], agents[i] = self.now, agent
+        percepts[i], actions[i] = percept, action
+        self.count += 1
+        if self.echo: self.dump(1)
+
+    def last(self, n=None):
+        """The last n records (all of them by default), oldest first, as
+        (step, agent, percept, action) tuples."""
+        n = min(n or self.size, self.count, self.size)
+        if not n: return []
+        steps, agents, percepts, actions = self.columns
+        result = []
+        for j in range(self.count - n, self.count):
+            i = j % self.size
+            result.append((steps[i], agents[i], percepts[i], actions[i]))
+        return result
+
+    def dump(self, n=None, file=None):
+        "Print the last n records (all of them by default) to file (stdout)."
+        file = file or sys.stdout
+        for (step, agent, percept, action) in self.last(n):
+            print >> file, 'step %d: %s perceives %s and does %s' % (
+                step, agent, percept, action)
+
+def pure(program):
+    """Declare that an agent program is pure: that its action depends on
+    nothing but the percept, so it may be remembered.  Return program."""
+    program.pure = True
+    return program
+
+## The MemoCache of each agent class with share_memo set
+class_memo_caches = {}
+
+def clear_memo_caches(cls=None):
+    """Forget the actions remembered by the shared MemoCache of cls, or of
+    every class, and drop the caches, so new agents start afresh."""
+    for c in if_(cls is None, lambda: class_memo_caches.keys(), [cls]):
+        cache = class_memo_caches.pop(c, None)
+        if cache is not None: cache.clear()
+
+class MemoCache (object):
+    """The actions of a pure program for at most about maxsize percepts.
+    Entries are kept in two generations: when the new one is full it
+    becomes the old one, and the old one is dropped, so the percepts seen
+    lately stay.  After trial lookups, if fewer than min_hit_rate of them
+    were hits, the cache gives up (.bypass is set) and frees its entries."""
+
+    def __init__(self, maxsize=10000, trial=1000, min_hit_rate=0.2):
+        self.maxsize, self.trial = maxsize, trial
+        self.min_hit_rate = min_hit_rate
+        self.new, self.old = {}, {}
+        self.hits = self.misses = 0
+        self.bypass = False
+
+    def clear(self):
+        self.new, self.old = {}, {}
+
+    def store(self, percept, action):
+        if len(self.new) >= self.maxsize // 2:
+            self.old, self.new = self.new, {}
+        self.new[percept] = action
+
+    def check(self):
+        "Once the trial is over, give up if the hit rate is too low."
+        lookups = self.hits + self.misses
+        if self.trial is None or lookups < self.trial: return
+        self.trial = None ## Decided
+        if self.hits < self.min_hit_rate * lookups:
+            self.bypass = True
+            self.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return Dict(hits=self.hits, misses=self.misses,
+                    size=len(self.new) + len(self.old),
+                    hit_rate=if_(lookups, lambda: float(self.hits) / lookups,
+                                 0.0),
+                    bypass=self.bypass)
+
+class MemoProgram (object):
+    """An agent program that looks up the action of the pure program for
+    the percept in a MemoCache, and only calls program on a miss (or for a
+    percept that cannot be hashed, or once the cache has given up).  A
+    Percept is looked up by the values of the fields in needs (those the
+    agent declares in its percept_needs, and so the only ones a pure
+    program may read), which the environment has already worked out; if
+    needs is empty, by the tuple of all its fields, which works them all
+    out.  Either way the cache holds on to values, not to the environment
+    and agent.
+    >>> @pure
+    ... def program(percept):
+    ...     print 'thinking'
+    ...     return if_(percept[0] == 'Dirty', 'Suck', 'Right')
+    >>> memo = MemoProgram(program, MemoCache())
+    >>> memo(('Dirty', (1, 1)))
+    thinking
+    'Suck'
+    >>> memo(('Dirty', (1, 1)))
+    'Suck'
+    >>> memo.cache.stats()['hit_rate']
+    0.5
+    >>> class Env:
+    ...     def percept_status(self, agent): return 'Dirty'
+    ...     def percept_location(self, agent): return (1, 1)
+    >>> memo(Percept(Env(), None, ('status', 'location')))
+    'Suck'
+    >>> memo.cache.new.keys()
+    [('Dirty', (1, 1))]
+    >>> class Lazy(Env):
+    ...     def percept_status(self, agent): print 'looking'; return 'Dirty'
+    >>> where = MemoProgram(pure(lambda percept: percept.location),
+    ...                     MemoCache(), needs=('location',))
+    >>> [where(Percept(Lazy(), None, ('status', 'location'), ['location']))
+    ...  for i in range(2)]
+    [(1, 1), (1, 1)]
+    >>> where.cache.new.keys()
+    [((1, 1),)]
+    >>> class Shared(Agent):
+    ...     share_memo = True
+    ...     def make_agent_program(self): return program
+    >>> Shared().program(('Clean', (1, 1)))
+    thinking
+    'Right'
+    >>> Shared().program(('Clean', (1, 1)))
+    'Right'
+    >>> clear_memo_caches(Shared)
+    >>> Shared().program(('Clean', (1, 1)))
+    thinking
+    'Right'
+    """
+
+    def __init__(self, program, cache, needs=()):
+        self.program, self.cache, self.needs = program, cache, tuple(needs)
+
+    def __call__(self, percept):
+        cache = self.cache
+        if cache.bypass: return self.program(percept)
+        key = percept
+        if isinstance(percept, Percept):
+            if self.needs:
+                key = tuple([percept.get(name) for name in self.needs])
+            else:
+                key = tuple(percept)
+        try:
+            action = cache.new[key]
+            cache.hits += 1
+            return action
+        except KeyError:
+            pass
+        except TypeError:
+            return self.program(percept) ## Unhashable percept
+        if key in cache.old:
+            action = cache.old[key]
+            cache.hits += 1
+        else:
+            action = self.program(percept)
+            cache.misses += 1
+        cache.store(key, action)
+        cache.check()
+        return action
+
+class Percept (object):
+    """A percept whose fields are only worked out, by calling
+    env.percept_<field>(agent), when the agent program reads them, and are
+    then kept.  It acts like the tuple of its .fields, so programs that
+    unpack, index, hash or compare percepts need not change (though it is
+    not an instance of tuple); other fields the environment offers are
+    read as attributes.  Printing it shows only the fields read so far.
+    >>> class Env:
+    ...     def percept_status(self, agent): print 'looking'; return 'Dirty'
+    ...     def percept_location(self, agent): return (1, 1)
+    >>> p = Percept(Env(), None, ('status', 'location'), ['location'])
+    >>> print p
+    (?, (1, 1))
+    >>> p.status
+    looking
+    'Dirty'
+    >>> p == ('Dirty', (1, 1)), p[0], {('Dirty', (1, 1)): 'Suck'}[p]
+    (True, 'Dirty', 'Suck')
+    """
+    __slots__ = ('env', 'agent', 'fields', 'values')
+
+    def __init__(self, env, agent, fields, needs=()):
+        self.env, self.agent, self.fields = env, agent, fields
+        self.values = values = {}
+        for name in needs:
+            values[name] = getattr(env, 'percept_' + name)(agent)
+
+    def get(self, name):
+        "The value of a field, working it out the first time."
+        values = self.values
+        if name not in values:
+            values[name] = getattr(self.env, 'percept_' + name)(self.agent)
+        return values[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in Percept.__slots__:
+            raise AttributeError(name)
+        return self.get(name)
+
+    def __iter__(self):
+        try:
+            values = self.values
+            return iter([values[name] for name in self.fields])
+        except KeyError:
+            return iter([self.get(name) for name in self.fields])
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return tuple(self)[i]
+        return self.get(self.fields[i])
+
+    def __eq__(self, other):
+        if isinstance(other, Percept): other = tuple(other)
+        return tuple(self) == other
+
+    def __ne__(self, other):
+        return not self == other
 
-    def __init__(self, actions):
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+    def __str__(self):
+        return str(tuple([self.values.get(name, unread)
+                          for name in self.fields]))
+
+    def __reduce__(self):
+        return (tuple, (tuple(self),))
+
+    def detached(self):
+        """A copy that no longer refers to the environment or the agent:
+        its fields, and those the agent needs, are worked out now, and
+        reading any other field raises AttributeError.  Hand this, not the
+        percept, to a program running on another thread.
+        >>> class Env:
+        ...     def percept_status(self, agent): return 'Dirty'
+        ...     def percept_location(self, agent): return (1, 1)
+        >>> q = Percept(Env(), None, ('status', 'location')).detached()
+        >>> q, q.env, q.status
+        (('Dirty', (1, 1)), None, 'Dirty')
+        >>> q.bump
+        Traceback (most recent call last):
+        AttributeError: 'NoneType' object has no attribute 'percept_bump'
+        """
+        for name in self.fields + tuple(getattr(self.agent, 'percept_needs',
+                                                 ())):
+            self.get(name)
+        copy = Percept(None, None, self.fields)
+        copy.values = dict(self.values)
+        return copy
+
+def detached(percept):
+    "percept, or if it is a Percept, a copy of it detached from the world."
+    if isinstance(percept, Percept): return percept.detached()
+    return percept
+
+class RandomBlocks (object):
+    """A seeded source of random choices, drawn block by block (with
+    NumPy, when it is there) and handed out one at a time by streams.  One
+    RandomBlocks can feed the streams of a whole population of agents;
+    each stream refills its own block from it when the block runs out.
+    >>> draw = RandomBlocks(seed=7).stream('abcd')
+    >>> first = [draw() for i in range(1000)]
+    >>> draw = RandomBlocks(seed=7).stream('abcd')
+    >>> [draw() for i in range(1000)] == first, sorted(set(first))
+    (True, ['a', 'b', 'c', 'd'])
+    """
+
+    def __init__(self, seed=None, block=128):
+        if seed is None: seed = random.getrandbits(32)
+        if numpy is None: self.rng = random.Random(seed)
+        else: self.rng = numpy.random.RandomState(seed)
+        self.block = block
+
+    def draw_block(self, choices):
+        "A list of block random elements of choices, last one first."
+        n = len(choices)
+        if numpy is None:
+            return [choices[self.rng.randrange(n)] for i in range(self.block)]
+        indices = self.rng.randint(n, size=self.block)[::-1].tolist()
+        return [choices[i] for i in indices]
+
+    def stream(self, choices):
+        "A function that returns the next of a stream of random choices."
+        buffer = []
+        def draw():
+            if not buffer:
+                buffer.extend(self.draw_block(choices))
+            return buffer.pop()
+        return draw
+
+class RandomAgent (Agent):
+    """An agent that chooses an action at random, ignoring all percepts.
+    Its choices come from its own stream of blocks; give a seed to fix
+    them, or blocks, a RandomBlocks, to share one generator with other
+    agents.  By default the seed is drawn from the random module, so
+    random.seed still makes runs repeatable."""
+    percept_needs = ()
+
+    def __init__(self, actions, seed=None, blocks=None):
         self.actions = actions
+        self.blocks = blocks or RandomBlocks(seed)
         super(RandomAgent, self).__init__()
 
     def make_agent_program(self):
-        actions = self.actions
-        return lambda percept: random.choice(actions)
+        draw = self.blocks.stream(self.actions)
+        return lambda percept: draw()
+
+class PerceptTable (object):
+    """A reflex agent program compiled into a dense table over a finite
+    percept space.  Percept p is row .index[p]; each action is stored as
+    its number in .actions.  Row i of .codes holds the action number for
+    that percept, or -1 for a stochastic row, which is sampled from
+    .dists[i], a (cumulative weights, action numbers) pair.
+
+    program is either a function from percept to action, called samples
+    times per percept to estimate its distribution, or a dict mapping each
+    percept to an action or to an {action: weight} dict.  A PerceptTable
+    is itself an agent program: table(percept) returns an action.
+    >>> table = PerceptTable({'Dirty': 'Suck', 'Clean': {'Left': 1,
+    ...                                                  'Right': 3}},
+    ...                      ['Dirty', 'Clean'])
+    >>> table('Dirty'), len(table), table.codes[table.index['Clean']]
+    ('Suck', 2, -1)
+    >>> random.seed(1)
+    >>> actions = table.batch(['Clean'] * 4000 + ['Dirty'])
+    >>> actions[-1], sorted(set(actions[:-1]))
+    ('Suck', ['Left', 'Right'])
+    >>> 0.72 < actions.count('Right') / 4000.0 < 0.78
+    True
+    >>> table = PerceptTable(lambda p: if_(p == 'Dirty', 'Suck', 'NoOp'),
+    ...                      ['Dirty', 'Clean'])
+    >>> table.batch(['Clean', 'Dirty']), table.dists
+    (['NoOp', 'Suck'], {})
+    """
+
+    def __init__(self, program, percepts, samples=1):
+        self.index = {}
+        self.actions = []
+        self.action_index = {}
+        self.codes = array('h')
+        self.dists = {}
+        for i, percept in enumerate(percepts):
+            self.index[percept] = i
+            if isinstance(program, dict):
+                entry = program[percept]
+                if isinstance(entry, dict): weights = entry
+                else: weights = {entry: 1}
+            else:
+                weights = DefaultDict(0)
+                for s in range(samples):
+                    weights[program(percept)] += 1
+            codes = [self.encode_action(a) for a in weights]
+            if len(codes) == 1:
+                self.codes.append(codes[0])
+            else:
+                totals = []
+                for a in weights:
+                    totals.append(weights[a] + (totals and totals[-1] or 0))
+                self.codes.append(-1)
+                self.dists[i] = (totals, codes)
+
+    def encode_action(self, action):
+        "Return the number of action, giving it one if it is new."
+        if action not in self.action_index:
+            self.action_index[action] = len(self.actions)
+            self.actions.append(action)
+        return self.action_index[action]
+
+    def sample(self, row):
+        "Draw an action number from the distribution of a stochastic row."
+        totals, codes = self.dists[row]
+        i = bisect.bisect(totals, random.random() * totals[-1])
+        return codes[min(i, len(codes) - 1)]
+
+    def __call__(self, percept):
+        row = self.index[percept]
+        code = self.codes[row]
+        if code < 0: code = self.sample(row)
+        return self.actions[code]
+
+    def batch(self, percepts):
+        "Return the list of actions for a sequence of percepts."
+        index, codes, actions = self.index, self.codes, self.actions
+        result = [codes[index[p]] for p in percepts]
+        for j, code in enumerate(result):
+            if code < 0: result[j] = self.sample(index[percepts[j]])
+        return [actions[code] for code in result]
+
+    def __len__(self):
+        return len(self.codes)
+
+class TableDrivenAgent (Agent):
+    """An agent whose program is a PerceptTable, so that choosing an action
+    costs one table lookup per step. [Fig. 2.7]"""
+
+    def __init__(self, table):
+        self.table = table
+        super(TableDrivenAgent, self).__init__()
+
+    def make_agent_program(self):
+        return self.table
+
+def compile_agent(AgentFactory, percepts, samples=1):
+    """Compile the program of an agent made by AgentFactory into one
+    PerceptTable over percepts, and return a factory for TableDrivenAgents
+    that share it.  Give samples > 1 for agents that choose at random.
+    >>> make = compile_agent(RandomVacuumAgent, ['Clean'], samples=200)
+    >>> sorted(make().table.actions)
+    ['Left', 'NoOp', 'Right', 'Suck']
+    """
+    table = PerceptTable(AgentFactory().program, list(percepts), samples)
+    return lambda: TableDrivenAgent(table)
+
+def vacuum_percepts(env):
+    "All the percepts an agent can get in a VacuumEnvironment."
+    return [(status, (x, y)) for status in ('Dirty', 'Clean')
+            for x in range(env.width) for y in range(env.height)]
 
 
 #______________________________________________________________________________
@@ -94,6 +648,7 @@ loc_A, loc_B = (1, 1), (2, 1) # The two locations for the Vacuum world
 
 class ReflexVacuumAgent (Agent):
     "A reflex agent for the two-state vacuum environment. [Fig. 2.8]"
+    percept_needs = ('status', 'location')
 
     def __init__(self):
         super(ReflexVacuumAgent, self).__init__()
@@ -114,9 +669,9 @@ class ReflexVacuumAgent (Agent):
             #elif location == 'Left' || location    elif location == 'Right': return 'Left'
         return program
 
-def RandomVacuumAgent():
+def RandomVacuumAgent(seed=None, blocks=None):
     "Randomly choose one of the actions from the vacuum environment."
-    return RandomAgent(['Right', 'Left', 'Suck', 'NoOp'])
+    return RandomAgent(['Right', 'Left', 'Suck', 'NoOp'], seed, blocks)
 
 	
 class Environment (object):
@@ -131,8 +686,20 @@ class Environment (object):
     need this."""
 
     def __init__(self):
-        self.objects = []
+        self.objects = ObjectList()
         self.agents = []
+        self.populations = [] ## AgentPopulations, stepped after the agents
+        self.trace = TraceRecorder() ## What the agents perceived and did
+        self.metrics = None ## Struct of metrics, when enable_metrics is on
+        self.trajectory = None ## A trajectories.TrajectoryWriter, if any
+
+    def enable_metrics(self, registry=None):
+        """Start counting steps, percepts, bumps and sucks, and timing the
+        agent programs, in registry (a new metrics.Registry by default).
+        Return the registry; see the metrics module for exporting it."""
+        if registry is None: registry = metrics_module.Registry()
+        self.metrics = metrics_module.environment_metrics(registry)
+        return registry
 
     def object_classes(self):
         return [] ## List of classes that can go into environment
@@ -153,29 +720,83 @@ class Environment (object):
         "By default, we're done when we can't find a live agent."
         for agent in self.agents:
             if agent.is_alive(): return False
+        for population in self.populations:
+            if population.alive.any(): return False
         return True
+
+    def list_agents(self):
+        "All the agents, with a view of each one in a population."
+        result = list(self.agents)
+        for population in self.populations:
+            result.extend(population.views())
+        return result
     
     def exogenous_change(self):
         "If there is spontaneous change in the world, override this."
         pass
 
+    def execute_actions(self, agents, actions):
+        "Execute each agent's action, in order."
+        for (agent, action) in zip(agents, actions):
+            self.execute_action(agent, action)
+
     def step(self):
         """Run the environment for one time step. If the
         actions and exogenous changes are independent, this method will
         do.  If there are interactions between them, you'll need to
         override this method."""
         if not self.is_done():
-                actions = [agent.program(self.percept(agent))
-                           for agent in self.agents]
-                for (agent, action) in zip(self.agents, actions):
-                    self.execute_action(agent, action)
-                self.exogenous_change()
+                self.begin_step()
+                self.apply_actions(self.agents,
+                                   self.agent_actions(self.agents))
+
+    def begin_step(self):
+        "Note what the agents perceive and have, before their actions."
+        if self.trajectory is not None: self.trajectory.observe(self)
+
+    def apply_actions(self, agents, actions):
+        """Finish a step in which agents chose actions: execute them all
+        together, step the populations, make the exogenous change and
+        count the step.  Anything that works out the actions some other
+        way (on threads, or in other processes) calls begin_step, then
+        this, so that it steps env just as step does."""
+        self.execute_actions(agents, actions)
+        for population in self.populations:
+            population.step(self)
+        self.exogenous_change()
+        if self.trajectory is not None: self.trajectory.record(self, actions)
+        self.trace.now += 1
+        if self.metrics is not None: self.metrics.steps.inc()
+
+    def agent_actions(self, agents):
+        "What each of agents does, given its percept now."
+        if self.metrics is None:
+            return [agent.program(self.percept(agent)) for agent in agents]
+        return self.timed_programs(agents)
+
+    def timed_programs(self, agents):
+        "The agents' actions, timing each program into metrics."
+        actions, clock = [], time.time
+        observe = self.metrics.program_latency.observe
+        for agent in agents:
+            percept = self.percept(agent)
+            start = clock()
+            actions.append(agent.program(percept))
+            observe(clock() - start)
+        self.metrics.percepts.inc(len(agents))
+        return actions
 
     def run(self, steps=1000):
-        """Run the Environment for given number of time steps."""
-        for step in range(steps):
-                if self.is_done(): return
-                self.step()
+        """Run the Environment for given number of time steps.  If a step
+        fails, the last steps of the trace are printed to stderr first."""
+        try:
+            for step in range(steps):
+                    if self.is_done(): return
+                    self.step()
+        except Exception:
+            print >> sys.stderr, 'Trace of the last steps:'
+            self.trace.dump(20 * max(len(self.agents), 1), sys.stderr)
+            raise
 
     def list_objects_at(self, location, oclass=Object):
         "Return all objects exactly at a given location."
@@ -199,7 +820,7 @@ class Environment (object):
         
         if isinstance(obj, Agent):
                 obj.performance = 0
-                self.agents.append(TraceAgent(obj))
+                self.agents.append(TraceAgent(obj, self.trace, on=False))
         else:
             self.objects.append(obj)
         return self
@@ -215,12 +836,191 @@ class Environment (object):
             trace_list("  from list", self.objects)
         if obj in self.agents:
             self.agents.remove(obj)
-
+            self.trace.forget(obj)
+
+
+class ObjectList (list):
+    """The list of objects in an environment, which can remove any of them
+    in constant time: it keeps the index of each object, and fills the gap
+    a removed object leaves with the last one.  So objects stay in the
+    order they were added only until the first removal.  Add and remove
+    objects only with append, extend and remove.
+    >>> a, b, c = Object(), Object(), Object()
+    >>> objects = ObjectList([a, b])
+    >>> objects.append(c); objects.remove(a)
+    >>> objects == [c, b], a in objects, c in objects
+    (True, False, True)
+    >>> objects.remove(a)
+    Traceback (most recent call last):
+    ValueError: ObjectList.remove(x): x not in list
+    """
+
+    def __init__(self, objects=()):
+        list.__init__(self)
+        self.positions = {} ## id(obj) -> its index in the list
+        self.extend(objects)
+
+    def append(self, obj):
+        self.positions[id(obj)] = len(self)
+        list.append(self, obj)
+
+    def extend(self, objs):
+        for obj in objs:
+            self.append(obj)
+
+    def remove(self, obj):
+        i = self.positions.pop(id(obj), None)
+        if i is None:
+            raise ValueError('ObjectList.remove(x): x not in list')
+        last = list.pop(self)
+        if i < len(self):
+            self[i] = last
+            self.positions[id(last)] = i
+
+    def __contains__(self, obj):
+        return id(obj) in self.positions
+
+    def __reduce__(self):
+        return (ObjectList, (list(self),)) ## The ids change when unpickled
 
 def trace_list (name, objlist):
     ol_list = [(obj, obj.location) for obj in objlist]
     print "%s: %s" % (name, ol_list)
 
+class ChunkedGrid (object):
+    """A sparse 2D grid holding a list of objects per cell.  Cells are
+    stored in square tiles of size x size, allocated on the first write to
+    any of their cells and freed when their last object goes, so memory
+    grows with the occupied area rather than the area of the board.
+    >>> grid = ChunkedGrid()
+    >>> grid.add((10**6, -3), 'dirt'); grid.add((10**6, -3), 'wall')
+    >>> grid.get((10**6, -3)), grid.get((0, 0)), len(grid.tiles)
+    (['dirt', 'wall'], (), 1)
+    >>> grid.move('dirt', (10**6, -3), (0, 0)); grid.discard((0, 0), 'dirt')
+    >>> grid.get((10**6, -3)), len(grid.tiles)
+    (['wall'], 1)
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.tiles = {}  ## (tx, ty) -> list of size*size cells, None if empty
+        self.counts = {} ## (tx, ty) -> number of objects in the tile
+
+    def get(self, (x, y)):
+        "The objects at a cell; an empty sequence if there are none."
+        size = self.size
+        tile = self.tiles.get((x // size, y // size))
+        return (tile and tile[(x % size) * size + y % size]) or ()
+
+    def add(self, (x, y), obj):
+        size = self.size
+        key, i = (x // size, y // size), (x % size) * size + y % size
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = [None] * (size * size)
+            self.counts[key] = 0
+        if tile[i] is None:
+            tile[i] = []
+        tile[i].append(obj)
+        self.counts[key] += 1
+
+    def discard(self, (x, y), obj):
+        "Remove obj from a cell, if it is there."
+        size = self.size
+        key, i = (x // size, y // size), (x % size) * size + y % size
+        tile = self.tiles.get(key)
+        if not (tile and tile[i] and obj in tile[i]): return
+        tile[i].remove(obj)
+        if not tile[i]: tile[i] = None
+        self.counts[key] -= 1
+        if not self.counts[key]:
+            del self.tiles[key], self.counts[key]
+
+    def move(self, obj, old, new):
+        self.discard(old, obj)
+        self.add(new, obj)
+
+class CellStats (object):
+    """Per-cell counters for an XYEnvironment: visits (times an agent moved
+    into the cell), bumps (times an agent bumped into it), cleaned (dirt
+    sucked up there) and dirt_age (the steps that dirt had lain there, in
+    total).  Counters are kept in flat arrays, so counting costs an array
+    increment; arrays() gives them as width x height NumPy arrays indexed
+    [x, y].  Stats of the same size can be added, to merge several runs.
+    >>> a, b = CellStats(3, 2), CellStats(3, 2)
+    >>> a.visit((2, 1)); b.visit((2, 1)); b.bump((0, 0)); b.visit((5, 5))
+    >>> merged = a + b
+    >>> merged.counter('visits')[2, 1], merged.total('bumps')
+    (2, 1)
+    """
+    fields = ('visits', 'bumps', 'cleaned', 'dirt_age')
+
+    def __init__(self, width, height, start=0):
+        self.width, self.height = width, height
+        self.start = start ## Objects already there count as born now
+        self.born = {}     ## Object -> step it was added
+        for field in self.fields:
+            setattr(self, field, array('l', [0]) * (width * height))
+
+    def index(self, (x, y)):
+        "The index of a cell in the counters, or None if it is off the grid."
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return x * self.height + y
+        return None
+
+    def visit(self, cell):
+        i = self.index(cell)
+        if i is not None: self.visits[i] += 1
+
+    def bump(self, cell):
+        i = self.index(cell)
+        if i is not None: self.bumps[i] += 1
+
+    def clean(self, dirt, now):
+        "Count the cleaning of dirt, which was at its location until now."
+        i = self.index(dirt.location)
+        if i is not None:
+            self.cleaned[i] += 1
+            self.dirt_age[i] += now - self.born.pop(dirt, self.start)
+
+    def counter(self, field):
+        "One counter, as a width x height NumPy array indexed [x, y]."
+        require_numpy('CellStats.counter')
+        return numpy.array(getattr(self, field)).reshape(self.width,
+                                                         self.height)
+
+    def arrays(self):
+        "All the counters, as a dict of NumPy arrays."
+        return dict([(f, self.counter(f)) for f in self.fields])
+
+    def total(self, field):
+        return sum(getattr(self, field))
+
+    def __add__(self, other):
+        if (self.width, self.height) != (other.width, other.height):
+            raise ValueError('CellStats of different sizes cannot be added')
+        result = CellStats(self.width, self.height)
+        for field in self.fields:
+            setattr(result, field, array('l', map(operator.add,
+                                                  getattr(self, field),
+                                                  getattr(other, field))))
+        return result
+
+    def save(self, path):
+        "Save the counters to a NumPy .npz file."
+        require_numpy('CellStats.save')
+        numpy.savez(path, **self.arrays())
+
+def load_cell_stats(path):
+    "Read CellStats saved with CellStats.save."
+    require_numpy('load_cell_stats')
+    data = numpy.load(path)
+    width, height = data['visits'].shape
+    stats = CellStats(width, height)
+    for field in CellStats.fields:
+        setattr(stats, field, array('l', data[field].ravel().tolist()))
+    return stats
+
 class XYEnvironment (Environment):
     """This class is for environments on a 2D plane, with locations
     labelled by (x, y) points, either discrete or continuous.
@@ -236,6 +1036,47 @@ class XYEnvironment (Environment):
         self.height = height
         #update(self, objects=[], agents=[], width=width, height=height)
         self.observers = []
+        self.grid = ChunkedGrid() ## Index of the non-agent objects by cell
+        self.implicit_walls = False
+        self.clock = 0            ## Steps so far
+        self.stats = None         ## CellStats, when instrumented
+        self.move_policy = None   ## Set by batch_moves
+        self.obstacle_mask = None ## Made by obstacles() when needed
+
+    def instrument(self, on=True):
+        """Start (or with on=False, stop) counting visits, bumps and
+        cleanings per cell into a new CellStats, self.stats.
+        >>> env = VacuumEnvironment(5, implicit_walls=True)
+        >>> stats = env.instrument()
+        >>> agent, actions = Agent(), iter(['NoOp', 'Suck', 'Left', 'Right'])
+        >>> agent.program = lambda percept: actions.next()
+        >>> stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        >>> env.add_object(Dirt(), (1, 1))
+        >>> env.add_object(agent, (1, 1))
+        >>> env.run(4)
+        >>> sys.stdout = stdout
+        >>> [stats.total(field) for field in stats.fields]
+        [1, 1, 1, 1]
+        >>> (stats.counter('visits')[2, 1], stats.counter('bumps')[0, 1],
+        ...  stats.counter('cleaned')[1, 1], stats.counter('dirt_age')[1, 1])
+        (1, 1, 1, 1)
+        """
+        self.stats = None
+        if on:
+            self.stats = CellStats(self.width, self.height, self.clock)
+        return self.stats
+
+    def exogenous_change(self):
+        self.clock += 1
+
+    def list_objects_at(self, location, oclass=Object):
+        "Return all objects exactly at a given location."
+        return [obj for obj in self.grid.get(location)
+                if isinstance(obj, oclass)]
+
+    def in_bounds(self, (x, y)):
+        "Is (x, y) inside the perimeter walls?"
+        return 0 < x < self.width - 1 and 0 < y < self.height - 1
         
     def objects_near(self, location, radius):
         "Return all objects within radius of location."
@@ -291,10 +1132,20 @@ class XYEnvironment (Environment):
         "Move an object to a new location."
 
         # Bumped?
-        obj.bump = self.some_objects_at(destination, Obstacle)
+        obj.bump = (self.some_objects_at(destination, Obstacle) or
+                    (self.implicit_walls and not self.in_bounds(destination)))
+        if obj.bump and self.stats is not None:
+            self.stats.bump(destination)
+        if obj.bump and self.metrics is not None:
+            self.metrics.bumps.inc()
 
         if not obj.bump:
             # Move object and report to observers
+            if not isinstance(obj, Agent):
+                self.grid.move(obj, obj.location, destination)
+                if isinstance(obj, Obstacle): self.obstacle_mask = None
+            elif self.stats is not None:
+                self.stats.visit(destination)
             obj.location = destination
             for o in self.observers:
                 o.object_moved(obj)
@@ -303,21 +1154,201 @@ class XYEnvironment (Environment):
         print obj
         print location
         super(XYEnvironment, self).add_object(obj, location)
-        obj.holding = []
-        obj.held = None
+        if isinstance(obj, Agent):
+            obj.holding = []
+            obj.held = None
+        else:
+            self.grid.add(obj.location, obj)
+            if self.stats is not None:
+                self.stats.born[obj] = self.clock
+            if isinstance(obj, Obstacle): self.obstacle_mask = None
         # self.objects.append(obj) # done in Environment!
         # Report to observers
         for obs in self.observers:
             obs.object_added(obj)
 
+    def add_objects(self, pairs):
+        """Add many (non-agent) objects at once, given (object, location)
+        pairs.  Observers that have an objects_added method are told about
+        all of them in one call."""
+        objs = []
+        for (obj, location) in pairs:
+            obj.location = location
+            self.grid.add(location, obj)
+            objs.append(obj)
+            if isinstance(obj, Obstacle): self.obstacle_mask = None
+        if self.stats is not None:
+            for obj in objs:
+                self.stats.born[obj] = self.clock
+        self.objects.extend(objs)
+        for obs in self.observers:
+            if hasattr(obs, 'objects_added'):
+                obs.objects_added(objs)
+            else:
+                for obj in objs: obs.object_added(obj)
+
     def delete_object(self, obj):
         super(XYEnvironment, self).delete_object(obj)
+        if not isinstance(obj, Agent):
+            self.grid.discard(obj.location, obj)
+            if self.stats is not None:
+                self.stats.born.pop(obj, None)
+            if isinstance(obj, Obstacle): self.obstacle_mask = None
         # Any more to do?  Object holding anything or being held?
         for obs in self.observers:
             obs.object_deleted(obj)
     
-    def add_walls(self):
-        "Put walls around the entire perimeter of the grid."
+    move_deltas = {'Right': (1, 0), 'Left': (-1, 0), 'Up': (0, -1),
+                   'Down': (0, 1)}
+    move_policies = ['overlap', 'first', 'random', 'bump']
+
+    def batch_moves(self, policy='overlap', seed=None):
+        """From now on, make all the agents' moves in a step at once, with
+        NumPy, in execute_actions, instead of one at a time with move_to.
+        policy says what happens when agents get in each other's way:
+            'overlap': nothing; agents share cells, as they do in move_to.
+            'first':   agents block each other, and never swap cells; of
+                       several agents moving into one cell, the first in
+                       self.agents gets it and the rest bump.
+            'random':  like 'first', but a random one of them gets it.
+            'bump':    like 'first', but they all bump.
+        An agent that moves into an agent that is blocked is blocked too.
+        policy=None goes back to move_to.
+        >>> env = XYEnvironment(6, 6)
+        >>> env.add_walls(implicit=True)
+        >>> a, b, c = Agent(), Agent(), Agent()
+        >>> a.location, b.location, c.location = (1, 1), (3, 1), (2, 2)
+        >>> env.agents = [a, b, c]
+        >>> env.batch_moves('first')
+        >>> env.execute_actions([a, b, c], ['Right', 'Left', 'Up'])
+        >>> [(agent.location, agent.bump) for agent in env.agents]
+        [((2, 1), False), ((3, 1), True), ((2, 2), True)]
+        >>> env.batch_moves('bump')
+        >>> env.execute_actions([a, b], ['Right', 'Up'])
+        >>> [(agent.location, agent.bump) for agent in [a, b]]
+        [((2, 1), True), ((3, 1), True)]
+        """
+        if policy is not None:
+            require_numpy('batch_moves')
+            if policy not in self.move_policies:
+                raise ValueError('Unknown move policy: %r' % policy)
+            self.move_random = numpy.random.RandomState(seed)
+        self.move_policy = policy
+
+    def execute_actions(self, agents, actions):
+        if self.move_policy is None:
+            return super(XYEnvironment, self).execute_actions(agents, actions)
+        movers, deltas = [], []
+        for (agent, action) in zip(agents, actions):
+            if action in self.move_deltas:
+                movers.append(agent)
+                deltas.append(self.move_deltas[action])
+            else:
+                self.execute_action(agent, action)
+        if movers:
+            self.move_agents(movers, deltas)
+
+    def obstacles(self):
+        "A width x height array of booleans, true where there is an Obstacle."
+        if self.obstacle_mask is None:
+            mask = numpy.zeros((self.width, self.height), bool)
+            for obj in self.objects:
+                if isinstance(obj, Obstacle):
+                    (x, y) = obj.location
+                    if 0 <= x < self.width and 0 <= y < self.height:
+                        mask[x, y] = True
+            self.obstacle_mask = mask
+        return self.obstacle_mask
+
+    def move_agents(self, agents, deltas):
+        """Move each agent by its (dx, dy) in deltas, all at once, bumping
+        into obstacles as in move_to and into each other as move_policy
+        says (see batch_moves)."""
+        start = numpy.array([agent.location for agent in agents])
+        target, bumped = self.move_targets(start, deltas)
+        if self.move_policy != 'overlap':
+            moving = set(map(id, agents))
+            still = [agent.location for agent in self.agents
+                     if id(agent) not in moving]
+            bumped = self.resolve_collisions(start, target, bumped, still)
+        bumps = 0
+        targets = map(tuple, target.tolist())
+        for (agent, destination, bump) in zip(agents, targets,
+                                              bumped.tolist()):
+            agent.bump = bump
+            if bump:
+                bumps += 1
+                if self.stats is not None:
+                    self.stats.bump(destination)
+            else:
+                if self.stats is not None:
+                    self.stats.visit(destination)
+                agent.location = destination
+                for o in self.observers:
+                    o.object_moved(agent)
+        if bumps and self.metrics is not None:
+            self.metrics.bumps.inc(bumps)
+
+    def move_targets(self, start, deltas):
+        """The cells that agents at start (an n x 2 array) move into, by
+        deltas, and an array saying which of them bump into an obstacle."""
+        target = start + numpy.asarray(deltas, dtype=int).reshape(-1, 2)
+        x, y = target[:, 0], target[:, 1]
+        if self.implicit_walls:
+            bumped = ~((0 < x) & (x < self.width - 1) &
+                       (0 < y) & (y < self.height - 1))
+        else:
+            bumped = numpy.zeros(len(target), bool)
+        inside = (0 <= x) & (x < self.width) & (0 <= y) & (y < self.height)
+        bumped[inside] |= self.obstacles()[x[inside], y[inside]]
+        return target, bumped
+
+    def resolve_collisions(self, start, target, bumped, still):
+        """Return bumped, with the agents that other agents block also
+        true.  start and target are n x 2 arrays of the movers' cells; still
+        lists the cells of the agents that are not moving."""
+        def rows(cells):
+            "An array with one element per row of cells, for in1d."
+            cells = numpy.ascontiguousarray(cells, dtype='int64')
+            return cells.view([('', 'int64')] * cells.shape[1]).ravel()
+        def keys(cells):
+            "One int per cell; cells are within 2**31 of the board."
+            cells = numpy.asarray(cells, dtype='int64').reshape(-1, 2)
+            return (cells[:, 0] << 32) + cells[:, 1]
+        n = len(start)
+        src, dst, fixed = keys(start), keys(target), keys(still)
+        if self.move_policy == 'random':
+            rank = self.move_random.permutation(n)
+        else:
+            rank = numpy.arange(n)
+        ## Agents that would swap cells always block each other
+        moving = ~bumped & ~numpy.in1d(rows(numpy.hstack([target, start])),
+                                       rows(numpy.hstack([start, target])))
+        while True:
+            ## Cells that agents stay in are blocked
+            held = numpy.concatenate([fixed, src[~moving]])
+            blocked = moving & numpy.in1d(dst, held)
+            ## Of the agents moving into one cell, the policy picks one
+            movers = numpy.nonzero(moving & ~blocked)[0]
+            order = movers[numpy.lexsort((rank[movers], dst[movers]))]
+            same = dst[order][1:] == dst[order][:-1]
+            if self.move_policy == 'bump':
+                contested = numpy.zeros(len(order), bool)
+                contested[1:] |= same
+                contested[:-1] |= same
+                blocked[order[contested]] = True
+            else:
+                blocked[order[1:][same]] = True
+            if not blocked.any(): return ~moving
+            moving &= ~blocked
+
+    def add_walls(self, implicit=False):
+        """Put walls around the entire perimeter of the grid.  If implicit,
+        no Wall objects are made; instead move_to treats every cell outside
+        in_bounds as blocked, which costs nothing on a huge board."""
+        if implicit:
+            self.implicit_walls = True
+            return
         for x in range(self.width):
             self.add_object(Wall(), (x, 0))
             self.add_object(Wall(), (x, self.height-1))
@@ -326,6 +1357,17 @@ class XYEnvironment (Environment):
                 self.add_object(Wall(), (0, y))
                 self.add_object(Wall(), (self.width-1, y))
 
+    def add_population(self, population):
+        """Add an AgentPopulation; observers with a population_moved
+        method are told whenever its agents move."""
+        self.populations.append(population)
+        self.population_moved(population)
+
+    def population_moved(self, population):
+        for obs in self.observers:
+            if hasattr(obs, 'population_moved'):
+                obs.population_moved(population)
+
     def add_observer(self, observer):
         """Adds an observer to the list of observers.  
         An observer is typically an EnvGUI.
@@ -343,16 +1385,16 @@ class XYEnvironment (Environment):
 class Obstacle (Object):
     """Something that can cause a bump, preventing an agent from
     moving into the same square it's in."""
-    pass
+    __slots__ = ()
 
 class Wall (Obstacle):
-    pass
+    __slots__ = ()
 
 #______________________________________________________________________________
 ## Vacuum environment 
 
 class Dirt (Object):
-    pass
+    __slots__ = ()
     
 class VacuumEnvironment (XYEnvironment):
     """The environment of [Ex. 2.12]. Agent perceives dirty or clean,
@@ -360,20 +1402,101 @@ class VacuumEnvironment (XYEnvironment):
     performance measure is 100 for each dirt cleaned, and -1 for
     each turn taken."""
 
-    def __init__(self, width=10, height=10):
+    def __init__(self, width=10, height=10, implicit_walls=False):
         super(VacuumEnvironment, self).__init__(width, width)
-        self.add_walls()
+        self.add_walls(implicit_walls)
+        self.dirt_rate = None
+        self.dirt_counts = None ## Made by dirt_grid() when needed
+
+    def regenerate_dirt(self, rate, every=1, poisson=False, seed=None):
+        """Make dirt appear by itself, as an exogenous change: every `every`
+        steps, each cell inside the walls gets a new Dirt with probability
+        rate, or if poisson, a Poisson(rate) number of them.  rate is either
+        a number or a width x height array of per-cell rates, indexed
+        [x, y].  Each time, all the cells are drawn at once with NumPy."""
+        require_numpy('regenerate_dirt')
+        if not numpy.isscalar(rate):
+            rate = numpy.asarray(rate, dtype=float)
+        self.dirt_rate, self.dirt_every = rate, every
+        self.dirt_poisson = poisson
+        self.dirt_random = numpy.random.RandomState(seed)
+
+    def exogenous_change(self):
+        super(VacuumEnvironment, self).exogenous_change()
+        if self.dirt_rate is not None and self.clock % self.dirt_every == 0:
+            self.add_objects([(Dirt(), cell) for cell in self.dirt_cells()
+                              if not self.some_objects_at(cell, Obstacle)])
+
+    def dirt_cells(self):
+        """Draw the list of cells that get new dirt this time; with poisson,
+        a cell appears once for each Dirt it gets.
+        >>> env = VacuumEnvironment(102, implicit_walls=True)
+        >>> for rate in [0.01, 0.3, 0.9]:
+        ...     env.regenerate_dirt(rate, seed=1)
+        ...     cells = env.dirt_cells()
+        ...     distinct = len(set(cells)) == len(cells)
+        ...     print distinct, abs(len(cells) / 10000.0 - rate) < 0.02
+        True True
+        True True
+        True True
+        """
+        rng, rate = self.dirt_random, self.dirt_rate
+        w, h = self.width - 2, self.height - 2
+        if numpy.isscalar(rate):
+            ## Cells are numbered x * h + y, from 0, inside the walls.  For
+            ## a small rate, draw how many cells get dirt, then which ones,
+            ## drawing again for any drawn twice.
+            if self.dirt_poisson:
+                cells = rng.randint(w * h, size=rng.poisson(rate * w * h))
+            elif rate > 0.1:
+                cells = numpy.nonzero(rng.random_sample(w * h) < rate)[0]
+            else:
+                n = rng.binomial(w * h, rate)
+                cells = numpy.unique(rng.randint(w * h, size=n))
+                while len(cells) < n:
+                    more = rng.randint(w * h, size=n - len(cells))
+                    cells = numpy.unique(numpy.concatenate([cells, more]))
+            return zip((cells // h + 1).tolist(), (cells % h + 1).tolist())
+        inside = rate[1:w+1, 1:h+1]
+        if self.dirt_poisson:
+            counts = rng.poisson(inside)
+        else:
+            counts = (rng.random_sample(inside.shape) < inside).astype(int)
+        xs, ys = counts.nonzero()
+        repeats = counts[xs, ys]
+        xs, ys = numpy.repeat(xs + 1, repeats), numpy.repeat(ys + 1, repeats)
+        return zip(xs.tolist(), ys.tolist())
 
     def object_classes(self):
-        return [Wall, Dirt, ReflexVacuumAgent, RandomVacuumAgent, SimpleReflexAgent]
+        return [Wall, Dirt, ReflexVacuumAgent, RandomVacuumAgent, SimpleReflexAgent,
+                ModelBasedVacuumAgent]
+
+    percept_fields = ('status', 'location')
 
     def percept(self, agent):
-        """The percept is a tuple of ('Dirty' or 'Clean', 'Bump' or 'None').
-        Unlike the TrivialVacuumEnvironment, location is NOT perceived."""
-        print 
-        status = if_(self.some_objects_at(agent.location, Dirt),
-                     'Dirty', 'Clean')        
-        return (status, agent.location)
+        """The percept is ('Dirty' or 'Clean', location), as a Percept that
+        only looks for dirt when the status is read.  Its .bump ('Bump' or
+        'None') and .nearby fields can be read too.  An agent that needs
+        both status and location gets a plain tuple, which is cheaper."""
+        if agent.percept_needs == self.percept_fields:
+            return (self.percept_status(agent), agent.location)
+        return Percept(self, agent, self.percept_fields, agent.percept_needs)
+
+    def percept_status(self, agent):
+        return if_(self.some_objects_at(agent.location, Dirt),
+                   'Dirty', 'Clean')
+
+    def percept_location(self, agent):
+        return agent.location
+
+    def percept_bump(self, agent):
+        return if_(agent.bump, 'Bump', 'None')
+
+    def percept_nearby(self, agent):
+        "(class name, cell) for each object in the four cells around agent."
+        return [(obj.__class__.__name__, cell)
+                for cell in grid_neighbors(agent.location)
+                for obj in self.list_objects_at(cell)]
 
     def execute_action(self, agent, action):
         if action == 'Suck':
@@ -381,16 +1504,120 @@ class VacuumEnvironment (XYEnvironment):
             if dirt_list != []:
                 dirt = dirt_list[0]
                 agent.performance += 100
+                if self.stats is not None:
+                    self.stats.clean(dirt, self.clock)
+                if self.metrics is not None:
+                    self.metrics.sucks.inc()
                 self.delete_object(dirt)
         else:
             super(VacuumEnvironment, self).execute_action(agent, action)
 
         if action != 'Nop':
             agent.performance -= 1
+
+    def move_agents(self, agents, deltas):
+        super(VacuumEnvironment, self).move_agents(agents, deltas)
+        for agent in agents:
+            agent.performance -= 1
+
+    def add_object(self, obj, location=(1, 1)):
+        super(VacuumEnvironment, self).add_object(obj, location)
+        if isinstance(obj, Dirt): self.count_dirt(obj.location, +1)
+
+    def add_objects(self, pairs):
+        super(VacuumEnvironment, self).add_objects(pairs)
+        if self.dirt_counts is not None:
+            for (obj, location) in pairs:
+                if isinstance(obj, Dirt): self.count_dirt(location, +1)
+
+    def delete_object(self, obj):
+        super(VacuumEnvironment, self).delete_object(obj)
+        if isinstance(obj, Dirt): self.count_dirt(obj.location, -1)
+
+    def count_dirt(self, (x, y), n):
+        if (self.dirt_counts is not None and 0 <= x < self.width
+            and 0 <= y < self.height):
+            self.dirt_counts[x, y] += n
+
+    def dirt_grid(self):
+        """A width x height array of the number of Dirts in each cell, kept
+        up to date once made.  (Dirt does not move.)"""
+        if self.dirt_counts is None:
+            counts = numpy.zeros((self.width, self.height), int)
+            for obj in self.objects:
+                if isinstance(obj, Dirt):
+                    (x, y) = obj.location
+                    if 0 <= x < self.width and 0 <= y < self.height:
+                        counts[x, y] += 1
+            self.dirt_counts = counts
+        return self.dirt_counts
+
+    def population_percept(self, population, needs):
+        """The percepts of all the agents of a population at once, as a
+        dict of field -> array: status is true where the agent's cell is
+        dirty; location and bump are copies of the population's arrays."""
+        percepts = {}
+        if 'status' in needs:
+            x, y = population.positions[:, 0], population.positions[:, 1]
+            inside = (0 <= x) & (x < self.width) & (0 <= y) & (y < self.height)
+            status = numpy.zeros(len(population), bool)
+            status[inside] = self.dirt_grid()[x[inside], y[inside]] > 0
+            percepts['status'] = status
+        if 'location' in needs:
+            percepts['location'] = population.positions.copy()
+        if 'bump' in needs:
+            percepts['bump'] = population.bump.copy()
+        return percepts
+
+    def execute_population(self, population, codes):
+        """Do the actions of all the agents of a population, given as their
+        numbers in population.actions (-1 for none), as execute_action and
+        move_agents would.  Agents in a population may share cells; of
+        several sucking in one cell, the first gets the dirt."""
+        actions, positions = population.actions, population.positions
+        numbers = dict([(a, i) for (i, a) in enumerate(actions)])
+        deltas = numpy.zeros((len(population), 2), int)
+        moving = numpy.zeros(len(population), bool)
+        for (action, delta) in self.move_deltas.items():
+            if action in numbers:
+                chosen = codes == numbers[action]
+                deltas[chosen] = delta
+                moving |= chosen
+        movers = numpy.nonzero(moving)[0]
+        target, bumped = self.move_targets(positions[movers], deltas[movers])
+        population.bump[:] = False
+        population.bump[movers[bumped]] = True
+        positions[movers[~bumped]] = target[~bumped]
+        if self.stats is not None:
+            for cell in map(tuple, target[bumped].tolist()):
+                self.stats.bump(cell)
+            for cell in map(tuple, target[~bumped].tolist()):
+                self.stats.visit(cell)
+        if self.metrics is not None:
+            self.metrics.bumps.inc(int(bumped.sum()))
+        if 'Suck' in numbers:
+            suckers = numpy.nonzero(codes == numbers['Suck'])[0]
+            dirty = self.population_percept(population, ['status'])['status']
+            suckers = suckers[dirty[suckers]]
+            cells = [tuple(cell) for cell in positions[suckers].tolist()]
+            for (i, cell) in zip(suckers.tolist(), cells):
+                dirt_list = self.list_objects_at(cell, Dirt)
+                if dirt_list:
+                    population.performance[i] += 100
+                    if self.stats is not None:
+                        self.stats.clean(dirt_list[0], self.clock)
+                    if self.metrics is not None:
+                        self.metrics.sucks.inc()
+                    self.delete_object(dirt_list[0])
+        charged = codes >= 0
+        if 'Nop' in numbers: charged &= codes != numbers['Nop']
+        population.performance[charged] -= 1
+        if len(movers): self.population_moved(population)
 #______________________________________________________________________________
 
 class SimpleReflexAgent (Agent):
     """This agent takes action based solely on the percept. [Fig. 2.13]"""
+    percept_needs = ('status',)
 
     def __init__(self):                
         super(SimpleReflexAgent, self).__init__()
@@ -404,11 +1631,424 @@ class SimpleReflexAgent (Agent):
                 return random.choice(['Left','Right','Up','Down'])                            
         return program
 
+class Rule (object):
+    """A condition-action rule.  conditions maps percept fields (indices
+    into the percept tuple) to the value each must have for the rule to
+    match; an empty dict matches every percept."""
+
+    def __init__(self, conditions, action):
+        self.conditions = dict(conditions)
+        self.action = action
+
+    def matches(self, state):
+        for field, value in self.conditions.items():
+            if state[field] != value: return False
+        return True
+
+    def __repr__(self):
+        return 'Rule(%r, %r)' % (self.conditions, self.action)
+
+class RuleIndex (object):
+    """The rules of a condition-action agent, indexed for rule_match.
+    Rules are grouped by the set of fields their conditions test, and each
+    group is a hash table from the tested values to the rules that need
+    them, so a match costs one lookup per group rather than one test per
+    rule.  Rules without .conditions are kept apart and tested in turn.
+    Rules have priority in the order they were added, unless a priority
+    is given (lower goes first).
+    >>> rules = RuleIndex([Rule({0: 'Dirty'}, 'Suck'),
+    ...                    Rule({1: (1, 1)}, 'Right'), Rule({}, 'NoOp')])
+    >>> rule_match(('Dirty', (1, 1)), rules).action
+    'Suck'
+    >>> rule_match(('Clean', (1, 1)), rules).action
+    'Right'
+    >>> rules.add(Rule({0: 'Clean', 1: (1, 1)}, 'Up'), priority=-1)
+    >>> rule_match(('Clean', (1, 1)), rules).action
+    'Up'
+    """
+
+    def __init__(self, rules=()):
+        self.tables = {}  ## fields -> {values: sorted [(priority, n, rule)]}
+        self.others = []  ## sorted [(priority, n, rule)] without conditions
+        self.entries = {} ## rule -> (fields, values, entry)
+        self.count = 0
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule, priority=None):
+        "Add a rule; by default it comes after all the rules already added."
+        if priority is None: priority = self.count
+        entry = (priority, self.count, rule)
+        self.count += 1
+        conditions = getattr(rule, 'conditions', None)
+        if conditions is None:
+            fields = values = None
+            bisect.insort(self.others, entry)
+        else:
+            fields = tuple(sorted(conditions))
+            values = tuple([conditions[f] for f in fields])
+            table = self.tables.setdefault(fields, {})
+            bisect.insort(table.setdefault(values, []), entry)
+        self.entries[rule] = (fields, values, entry)
+
+    def remove(self, rule):
+        "Remove a rule that was added before."
+        fields, values, entry = self.entries.pop(rule)
+        if fields is None:
+            self.others.remove(entry)
+            return
+        table = self.tables[fields]
+        table[values].remove(entry)
+        if not table[values]:
+            del table[values]
+            if not table: del self.tables[fields]
+
+    def match(self, state):
+        "Return the first rule, in priority order, that matches state."
+        best = None
+        for fields, table in self.tables.items():
+            try:
+                bucket = table.get(tuple([state[f] for f in fields]))
+            except (IndexError, KeyError, TypeError):
+                continue
+            if bucket and (best is None or bucket[0] < best):
+                best = bucket[0]
+        for entry in self.others:
+            if best is not None and best < entry: break
+            if entry[2].matches(state):
+                best = entry
+                break
+        return best and best[2]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter([entry[2] for (_, _, entry)
+                     in sorted(self.entries.values(), key=lambda e: e[2])])
+
 def rule_match(state, rules):
     "Find the first rule that matches state."
+    if isinstance(rules, RuleIndex):
+        return rules.match(state)
     for rule in rules:
         if rule.matches(state):
             return rule
+#______________________________________________________________________________
+## Model-based vacuum agent
+
+def grid_neighbors((x, y)):
+    "The four cells next to (x, y), in the order Right, Left, Down, Up."
+    return [(x+1, y), (x-1, y), (x, y+1), (x, y-1)]
+
+headings = {(1, 0): 'Right', (-1, 0): 'Left', (0, 1): 'Down', (0, -1): 'Up'}
+
+class DistanceField (object):
+    """Distances on a 4-connected grid from every open cell to the nearest
+    goal cell.  Cells and goals can be added and removed at any time, and
+    only the part of the field that depended on them is repaired: cells
+    that lost the neighbor their distance came from are raised to infinity
+    (breadth first, with a FIFOQueue), then distances flow back into them
+    from their neighbors (cheapest first, with a PriorityQueue), as in the
+    incremental planners D* Lite and Dynamic Brushfire.  With
+    incremental=False the whole field is recomputed after any change.
+    >>> field = DistanceField()
+    >>> for x in range(5):
+    ...     for y in range(5): field.open((x, y), goal=(x, y) == (4, 4))
+    >>> field.dist[(0, 0)]
+    8
+    >>> for cell in [(1, 0), (1, 1), (1, 2), (1, 3)]: field.close(cell)
+    >>> field.add_goal((0, 4)); field.remove_goal((4, 4))
+    >>> repaired = dict(field.dist)
+    >>> field.recompute()
+    >>> repaired == field.dist, field.dist[(0, 0)]
+    (True, 4)
+    """
+
+    def __init__(self, incremental=True):
+        self.dist = {}
+        self.goals = set()
+        self.incremental = incremental
+        self.stale = False
+
+    def neighbors(self, cell):
+        dist = self.dist
+        return [n for n in grid_neighbors(cell) if n in dist]
+
+    def open(self, cell, goal=False):
+        "Add a cell that can be crossed; goal says if it is a goal."
+        self.dist[cell] = infinity
+        if goal:
+            self.add_goal(cell)
+        else:
+            self.update([cell], [cell])
+
+    def close(self, cell):
+        "Remove a cell, because it turned out to be blocked."
+        neighbors = self.neighbors(cell)
+        del self.dist[cell]
+        self.goals.discard(cell)
+        self.update(neighbors, [])
+
+    def add_goal(self, cell):
+        self.goals.add(cell)
+        self.dist[cell] = 0
+        self.update([], [cell])
+
+    def remove_goal(self, cell):
+        self.goals.discard(cell)
+        self.update([cell], [])
+
+    def update(self, suspects, lowered):
+        """Repair the field after the cells in suspects may have lost their
+        support, and the cells in lowered got shorter distances."""
+        if not self.incremental:
+            self.stale = True
+            return
+        dist, goals = self.dist, self.goals
+        raised, queue = [], FIFOQueue()
+        queue.extend(suspects)
+        while queue:
+            cell = queue.pop()
+            d = dist.get(cell, infinity)
+            if cell in goals or d == infinity: continue
+            if not [n for n in self.neighbors(cell) if dist[n] == d - 1]:
+                dist[cell] = infinity
+                raised.append(cell)
+                queue.extend(self.neighbors(cell))
+        for cell in raised + [c for c in suspects if c not in goals]:
+            if cell in dist:
+                dist[cell] = 1 + min([dist[n] for n in self.neighbors(cell)]
+                                     + [infinity])
+        self.lower(raised + suspects + lowered)
+
+    def lower(self, cells):
+        "Let the distances of cells flow out to their neighbors."
+        dist = self.dist
+        queue = PriorityQueue(min)
+        queue.extend([(dist[c], c) for c in cells
+                      if dist.get(c, infinity) < infinity])
+        while queue:
+            d, cell = queue.pop()
+            if d > dist[cell]: continue
+            for n in self.neighbors(cell):
+                if d + 1 < dist[n]:
+                    dist[n] = d + 1
+                    queue.append((d + 1, n))
+
+    def recompute(self):
+        "Compute the whole field from scratch, breadth first from the goals."
+        dist = self.dist
+        for cell in dist:
+            dist[cell] = infinity
+        queue = FIFOQueue()
+        for cell in self.goals:
+            dist[cell] = 0
+            queue.append(cell)
+        while queue:
+            cell = queue.pop()
+            for n in self.neighbors(cell):
+                if dist[n] == infinity:
+                    dist[n] = dist[cell] + 1
+                    queue.append(n)
+        self.stale = False
+
+    def next_step(self, cell):
+        "The neighbor of cell that is closest to a goal, or None if no goal."
+        if self.stale: self.recompute()
+        neighbors = self.neighbors(cell)
+        if not neighbors: return None
+        best = argmin(neighbors, self.dist.get)
+        if self.dist[best] == infinity: return None
+        return best
+
+class ModelBasedVacuumAgent (Agent):
+    """A vacuum agent that keeps a map of the cells it has visited and the
+    walls it has bumped into, sucks up any dirt it finds, and otherwise
+    heads for the nearest cell it has not seen yet.  A move that leaves the
+    location unchanged was a bump, so the target cell is a wall.  Paths
+    come from a DistanceField to the unexplored cells, which is repaired
+    rather than recomputed as the map grows.
+    >>> stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    >>> env = VacuumEnvironment(6)
+    >>> env.add_objects([(Dirt(), (2, 3)), (Dirt(), (4, 1)), (Dirt(), (3, 4))])
+    >>> env.add_object(ModelBasedVacuumAgent(), (1, 1))
+    >>> env.run(60)
+    >>> sys.stdout = stdout
+    >>> [obj for obj in env.objects if isinstance(obj, Dirt)]
+    []
+    """
+    percept_needs = ('status', 'location')
+
+    def __init__(self, incremental=True):
+        self.incremental = incremental
+        super(ModelBasedVacuumAgent, self).__init__()
+
+    def make_agent_program(self):
+        field = DistanceField(self.incremental)
+        visited, walls = set(), set()
+        last = [None, None] ## Last location and the cell we tried to enter
+
+        def program((status, location)):
+            if last[1] is not None and location == last[0]:
+                walls.add(last[1])
+                if last[1] in field.dist: field.close(last[1])
+            if location not in visited:
+                visited.add(location)
+                for n in grid_neighbors(location):
+                    if n not in visited and n not in walls \
+                           and n not in field.dist:
+                        field.open(n, goal=True)
+                if location in field.dist:
+                    field.remove_goal(location)
+                else:
+                    field.open(location)
+            last[:] = [location, None]
+            if status == 'Dirty':
+                return 'Suck'
+            target = field.next_step(location)
+            if target is None:
+                return 'NoOp'
+            last[1] = target
+            return headings[(target[0] - location[0],
+                             target[1] - location[1])]
+        return program
+
+#______________________________________________________________________________
+# Populations of simple agents
+
+class AgentPopulation (object):
+    """Many agents of one kind, kept as parallel NumPy arrays (.positions,
+    n x 2, and .performance, .alive and .bump) instead of one Agent object
+    each, and run by one vectorized program for all of them.
+    program(percepts, population) gets a dict of field -> array from the
+    environment's population_percept, for the fields in its percept_needs
+    attribute, and returns an array of action numbers into actions.
+    Programs should get random numbers from population.draw, which depends
+    only on the seed, the step and the agent, so that any group of the
+    agents (such as a shard; see shards.py) draws what it would have drawn
+    as part of the whole population.
+    Environment.list_agents() and the GUI see each agent as an AgentView.
+    >>> env = VacuumEnvironment(6, implicit_walls=True)
+    >>> env.add_objects([(Dirt(), (1, 1)), (Dirt(), (3, 3))])
+    >>> population = AgentPopulation(reflex_population_program,
+    ...     ['Suck', 'Left', 'Right', 'Up', 'Down'], [(1, 1), (3, 3), (4, 4)])
+    >>> env.add_population(population)
+    >>> env.step()
+    >>> population.performance.tolist(), len(env.objects)
+    ([99, 99, -1], 0)
+    >>> env.list_agents()[0].performance
+    99
+    """
+
+    def __init__(self, program, actions, locations, seed=None):
+        require_numpy('AgentPopulation')
+        self.program = program
+        self.percept_needs = getattr(program, 'percept_needs',
+                                     ('status', 'location', 'bump'))
+        self.actions = list(actions)
+        self.positions = numpy.array(locations, dtype=int).reshape(-1, 2)
+        n = len(self.positions)
+        self.performance = numpy.zeros(n, int)
+        self.alive = numpy.ones(n, bool)
+        self.bump = numpy.zeros(n, bool)
+        self.ids = numpy.arange(n)
+        if seed is None: seed = random.getrandbits(32)
+        self.seed = seed
+        self.steps = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def draw(self, low, high):
+        "One random int in [low, high) for each agent, for this step."
+        return hashed_ints(self.seed, self.steps, self.ids, low, high)
+
+    def step(self, env):
+        "Perceive, choose and act, for all the live agents at once."
+        percepts = env.population_percept(self, self.percept_needs)
+        codes = numpy.asarray(self.program(percepts, self), dtype=int)
+        codes = numpy.where(self.alive, codes, -1)
+        if env.metrics is not None:
+            env.metrics.percepts.inc(len(self))
+        env.execute_population(self, codes)
+        self.steps += 1
+
+    def view(self, i):
+        return AgentView(self, i)
+
+    def views(self):
+        return [AgentView(self, i) for i in range(len(self))]
+
+def hashed_ints(seed, step, ids, low, high):
+    """Random ints in [low, high), one for each of the ids, that depend only
+    on seed, step and the id: the splitmix64 hash of all three.
+    >>> ids = numpy.arange(6)
+    >>> whole = hashed_ints(1, 2, ids, 0, 4)
+    >>> (whole[3:] == hashed_ints(1, 2, ids[3:], 0, 4)).all()
+    True
+    """
+    u = numpy.uint64
+    key = (seed * 0x9E3779B97F4A7C15 + step * 0xD1B54A32D192ED03) % 2**64
+    x = numpy.asarray(ids, dtype=u) * u(0x9E3779B97F4A7C15) + u(key)
+    x ^= x >> u(30)
+    x *= u(0xBF58476D1CE4E5B9)
+    x ^= x >> u(27)
+    x *= u(0x94D049BB133111EB)
+    x ^= x >> u(31)
+    return low + (x % u(high - low)).astype(int)
+
+def population_field(name):
+    "A property that reads and writes element .index of population.<name>."
+    def get(self):
+        return getattr(self.population, name)[self.index].item()
+    def set(self, value):
+        getattr(self.population, name)[self.index] = value
+    return property(get, set)
+
+class AgentView (Agent):
+    """Agent number index of an AgentPopulation, looking like an Agent;
+    its attributes are read from and written to the population's arrays.
+    Views are equal when they show the same agent."""
+    __slots__ = ('population', 'index')
+
+    def __init__(self, population, index):
+        self.population, self.index = population, index
+
+    def get_location(self):
+        return tuple(self.population.positions[self.index].tolist())
+
+    def set_location(self, location):
+        self.population.positions[self.index] = location
+
+    location = property(get_location, set_location)
+    performance = population_field('performance')
+    alive = population_field('alive')
+    bump = population_field('bump')
+
+    def __eq__(self, other):
+        return (isinstance(other, AgentView) and
+                (self.population, self.index) == (other.population,
+                                                  other.index))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.population), self.index))
+
+def random_population_program(percepts, population):
+    "Each agent does one of the population's actions, at random."
+    return population.draw(0, len(population.actions))
+random_population_program.percept_needs = ()
+
+def reflex_population_program(percepts, population):
+    """Like SimpleReflexAgent: suck if dirty, else move at random.  The
+    actions must be ['Suck', 'Left', 'Right', 'Up', 'Down']."""
+    moves = population.draw(1, 5)
+    return numpy.where(percepts['status'], 0, moves)
+reflex_population_program.percept_needs = ('status',)
+
 def compare_agents(EnvFactory, AgentFactories, n=10, steps=1000):
     """See how well each of several agents do in n instances of an environment.
     Pass in a factory (constructor) for environments, and several for agents.
@@ -440,6 +2080,7 @@ __doc__ += """
 # and muddle through without a GUI.
 
 import Tkinter as tk
+import fractions
 import tkSimpleDialog
 import tkFont
 
@@ -490,11 +2131,13 @@ class EnvToolbar(tk.Frame, object):
         
         # Create buttons and other controls
 
-        for txt, cmd in [('Step >', self.env.step),
+        for txt, cmd in [('Step >', self.step),
                          ('Ejecutar >>', self.run),
                          ('Detener [ ]', self.stop),
                          ('Listar objetos', self.list_things),
-                         ('Listar agentes', self.list_agents)]:
+                         ('Listar agentes', self.list_agents),
+                         ('Ver traza', self.show_trace),
+                         ('Trazar agentes', self.choose_traced)]:
             tk.Button(self, text=txt, command=cmd, font=self.customFont, bd=1).pack(side='left')
 
         tk.Label(self, text='Speed', bd=0, font=self.customFont).pack(side='left')
@@ -504,6 +2147,10 @@ class EnvToolbar(tk.Frame, object):
         scale.set(self.speed)
         scale.pack(side='left')
 
+    def step(self):
+        self.env.step()
+        self.canvas.repintarAgente(self.canvas, self.env)
+
     def run(self):
         print 'run'
         self.running = True
@@ -531,83 +2178,328 @@ class EnvToolbar(tk.Frame, object):
 
     def list_agents(self):
         print "Agentes en el ambiente"
-        for agt in self.env.agents:
+        for agt in self.env.list_agents():
             print "%s at %s" % (agt, agt.location)
 
+    def show_trace(self, n=50):
+        "Print the last n records of the trace."
+        trace = getattr(self.env, 'trace', None)
+        if trace is None: return
+        print "Traza de los agentes"
+        trace.dump(n)
+
+    def choose_traced(self):
+        "Pop up a menu to turn tracing on and off for each agent."
+        trace = getattr(self.env, 'trace', None)
+        if trace is None: return
+        menu = tk.Menu(self, tearoff=0)
+        self.traced = [] ## Keep the variables, or Tk forgets them
+        for (n, agent) in sorted(trace.agents.items()):
+            var = tk.IntVar(value=trace.enabled[n])
+            self.traced.append(var)
+            menu.add_checkbutton(
+                label='%s at %s' % (agent, agent.location), variable=var,
+                command=lambda agent=agent, var=var: trace.enable(agent,
+                                                                  var.get()))
+        menu.tk_popup(self.winfo_rootx(), self.winfo_rooty())
+
     def set_speed(self, speed):
         self.speed = float(speed)
         
-class EnvCanvas (tk.Canvas, object):
+## The picture and the raster colour for each kind of object, in drawing
+## order; an object is drawn as the first class it is an instance of.
+object_looks = [(Obstacle, 'wall.gif', '#808080'),
+                (Dirt, 'dirt.gif', '#785028'),
+                (Agent, 'vacuum.gif', '#c80000')]
+
+def object_look(obj):
+    "The index in object_looks of the way to draw obj, or None."
+    for i, (oclass, image, colour) in enumerate(object_looks):
+        if isinstance(obj, oclass): return i
+    return None
+
+def raster_rows(env, origin, scale, width, height, background='#ffffff'):
+    """The colours of a width x height pixel view of env, whose top left
+    corner is the cell origin, at scale pixels per cell: a list of rows of
+    '#rrggbb' strings, to put in a PhotoImage.  When a pixel covers several
+    cells it shows the last-drawn kind of object in any of them.
+    >>> env = VacuumEnvironment(4, implicit_walls=True)
+    >>> env.add_objects([(Dirt(), (1, 1))])
+    >>> env.agents.append(Agent()); env.agents[0].location = (2, 1)
+    >>> for row in raster_rows(env, (0, 0), 1, 4, 3): print ' '.join(row)
+    #808080 #808080 #808080 #808080
+    #808080 #785028 #c80000 #808080
+    #808080 #ffffff #ffffff #808080
+    >>> raster_rows(env, (0, 0), 0.5, 2, 1)
+    [['#785028', '#c80000']]
+    >>> raster_rows(env, (1, 1), 2, 4, 1)
+    [['#785028', '#785028', '#c80000', '#c80000']]
+    """
+    x0, y0 = origin
+    rows = [[background] * width for i in range(height)]
+    ranks = [[-1] * width for i in range(height)]
+    x1, y1 = x0 + int(width / scale) + 1, y0 + int(height / scale) + 1
+    cells = [(obj.location, object_look(obj))
+             for obj in env.objects + env.list_agents()]
+    if getattr(env, 'implicit_walls', False):
+        walls = object_look(Wall())
+        xs = range(max(x0, 0), min(x1, env.width))
+        ys = range(max(y0, 0), min(y1, env.height))
+        cells.extend([((x, y), walls) for x in xs for y in (0, env.height - 1)
+                      if y in ys])
+        cells.extend([((x, y), walls) for y in ys for x in (0, env.width - 1)
+                      if x in xs])
+    for ((x, y), rank) in cells:
+        if rank is None or not (x0 <= x < x1 and y0 <= y < y1): continue
+        colour = object_looks[rank][2]
+        px0, py0 = int((x - x0) * scale), int((y - y0) * scale)
+        px1 = min(max(px0 + 1, int((x - x0 + 1) * scale)), width)
+        py1 = min(max(py0 + 1, int((y - y0 + 1) * scale)), height)
+        for py in range(py0, py1):
+            row, rank_row = rows[py], ranks[py]
+            for px in range(px0, px1):
+                if rank > rank_row[px]:
+                    row[px], rank_row[px] = colour, rank
+    return rows
 
-    def __init__ (self, parent, env, cellwidth):
-        canvwidth = cellwidth * env.width # (cellwidth + 1 ) * n
-        canvheight = cellwidth * env.width # (cellwidth + 1) * n
+class EnvCanvas (tk.Canvas, object):
+    """A view of the environment, at most maxview pixels on a side.  Only
+    the cells in view get canvas items, and the canvas observes the
+    environment to move, add and delete just the items that change.  The
+    arrow keys or dragging scroll the view; the mouse wheel, + and - zoom
+    it.  When cells get smaller than sprite_below pixels the view becomes
+    a single raster image, one colour per cell, or per block of cells once
+    there are several cells to a pixel, redrawn once per step."""
+
+    zooms = [100, 50, 25, 10, 5, 2, 1, 0.5, 0.2, 0.1, 0.05, 0.02, 0.01]
+    sprite_below = 10
+
+    def __init__ (self, parent, env, cellwidth, maxview=600):
+        self.viewwidth = min(cellwidth * env.width, maxview)
+        self.viewheight = min(cellwidth * env.height, maxview)
         super(EnvCanvas, self).__init__(parent, background="white",
-                                        width=canvwidth, height=canvheight)
+                                        width=self.viewwidth,
+                                        height=self.viewheight)
 
         # Initialize instance variables
         
         self.env = env
         self.cellwidth = cellwidth
         self.n = env.width
-
-        # Draw the gridlines
-        """  
-        if cellwidth:
-            for i in range(0, self.n+1):
-                self.create_line(0, i*cellwidth, self.n*cellwidth, i*cellwidth, fill="blue", dash=(4, 4))
-                self.create_line(i*cellwidth, 0, i*cellwidth, self.n*cellwidth, fill="blue", dash=(4, 4))
-                self.pack(expand=1, fill='both')
-        self.pack()"""
-        self.pintarTablero()
-
-        # Set up image dictionary.
-
-        # Ugly hack: we need to keep a reference to each ImageTk.PhotoImage,
-        # or it will be garbage collected.  This dictionary maps image files
-        # that have been opened to their PhotoImage objects
-        self.images = []
-        self.imagesObj = []
+        self.origin = (0, 0) ## The cell at the top left of the view
+        self.items = {}      ## Object -> its canvas item, for objects in view
+        self.stale = False   ## Does the raster need redrawing?
+        self.drag = None
+
+        # Ugly hack: we need to keep a reference to each PhotoImage, or it
+        # will be garbage collected.  This dictionary maps (image file,
+        # cell width) to the PhotoImage for it; self.raster holds the
+        # raster image when there is one.
+        self.images = {}
+        self.raster = None
 
         # Bind canvas events.
         
         self.bind('<Button-1>', self.user_left) ## What should this do?
+        self.bind('<Button-1>', self.start_drag, add='+')
+        self.bind('<B1-Motion>', self.user_drag)
         self.bind('<Button-2>', self.user_edit_objects)        
         self.bind('<Button-3>', self.user_add_object)
+        self.bind('<Enter>', lambda event: self.focus_set())
+        for key, (dx, dy) in [('<Left>', (-1, 0)), ('<Right>', (1, 0)),
+                              ('<Up>', (0, -1)), ('<Down>', (0, 1))]:
+            self.bind(key, lambda event, dx=dx, dy=dy:
+                      self.scroll(dx * self.page_cells()[0] // 4 or dx,
+                                  dy * self.page_cells()[1] // 4 or dy))
+        for key, steps in [('<plus>', 1), ('<KP_Add>', 1), ('<Button-4>', 1),
+                           ('<minus>', -1), ('<KP_Subtract>', -1),
+                           ('<Button-5>', -1)]:
+            self.bind(key, lambda event, steps=steps: self.zoom(steps, event))
+        self.bind('<MouseWheel>', lambda event:
+                  self.zoom(if_(event.delta > 0, 1, -1), event))
+
+        env.add_observer(self)
+        self.repintar()
+
+    def sprites(self):
+        "Are we drawing pictures, rather than a raster?"
+        return self.cellwidth >= self.sprite_below
+
+    def page_cells(self):
+        "How many cells fit across and down the view."
+        w = float(self.cellwidth)
+        return (int(math.ceil(self.viewwidth / w)),
+                int(math.ceil(self.viewheight / w)))
+
+    def in_view(self, (x, y)):
+        (x0, y0), (nx, ny) = self.origin, self.page_cells()
+        return x0 <= x < x0 + nx and y0 <= y < y0 + ny
+
+    def image(self, obj):
+        "The PhotoImage for obj at the current cell width, or None."
+        look = object_look(obj)
+        if look is None: return None
+        name, w = object_looks[look][1], self.cellwidth
+        if (name, w) not in self.images:
+            if (name, 50) not in self.images:
+                self.images[(name, 50)] = tk.PhotoImage(
+                    file=os.path.join('images', name))
+            image = self.images[(name, 50)] ## The pictures are 50 x 50
+            ## Scale by w/50 exactly: zoom by w, then subsample by 50, both
+            ## divided by their common factor to keep the zoomed copy small
+            g = fractions.gcd(w, 50)
+            if w // g > 1: image = image.zoom(w // g)
+            if 50 // g > 1: image = image.subsample(50 // g)
+            self.images[(name, w)] = image
+        return self.images[(name, w)]
 
-        self.pintarObjetos()
-        
     def pintarTablero(self):
-        if self.cellwidth:
-            for i in range(0, self.n+1):
-                self.create_line(0, i*self.cellwidth, self.n*self.cellwidth, i*self.cellwidth, fill="green")
-                self.create_line(i*self.cellwidth, 0, i*self.cellwidth, self.n*self.cellwidth, fill="green")
-                self.pack(expand=1, fill='both')
-        self.pack()
-    
-    def pintarObjetos(self):
-        for obst in self.env.objects:
-            if isinstance(obst, Wall):
-                imgwall=tk.PhotoImage(file=r"images\wall.gif")                                                            
-            else:
-                imgwall=tk.PhotoImage(file=r"images\dirt.gif")
-            test = [imgwall, obst.location]
-            self.imagesObj.append(test)
+        "Draw the grid lines in view."
+        w, (x0, y0), (nx, ny) = self.cellwidth, self.origin, self.page_cells()
+        nx = min(nx, self.env.width - x0)
+        ny = min(ny, self.env.height - y0)
+        for i in range(0, nx+1):
+            self.create_line(i*w, 0, i*w, ny*w, fill="green")
+        for i in range(0, ny+1):
+            self.create_line(0, i*w, nx*w, i*w, fill="green")
 
-        for imgO in self.imagesObj:
-            self.create_image(self.cell_topleft_xy(imgO[1]), anchor="nw", image=imgO[0])
+    def pintarObjetos(self):
+        "Draw the objects in view."
+        (x0, y0), (nx, ny) = self.origin, self.page_cells()
+        for x in range(x0, x0 + nx):
+            for y in range(y0, y0 + ny):
+                for obj in self.env.list_objects_at((x, y)):
+                    self.draw_object(obj, raise_agents=False)
+        for agent in self.env.list_agents():
+            if self.in_view(agent.location):
+                self.draw_object(agent)
+
+    def pintarRaster(self):
+        "Draw the whole view as one raster image."
+        rows = raster_rows(self.env, self.origin, self.cellwidth,
+                           self.viewwidth, self.viewheight)
+        self.raster = tk.PhotoImage(width=self.viewwidth,
+                                    height=self.viewheight)
+        self.raster.put(' '.join(['{%s}' % ' '.join(row) for row in rows]))
+        self.delete('all')
+        self.create_image(0, 0, anchor='nw', image=self.raster)
+        self.stale = False
+
+    def draw_object(self, obj, raise_agents=True):
+        """Draw obj.  Agents stay above other objects: drawing one of those
+        raises them again, unless raise_agents is false (when drawing many
+        objects, raise them once at the end)."""
+        image = self.image(obj)
+        if image is None: return
+        item = self.create_image(self.cell_topleft_xy(obj.location),
+                                 anchor="nw", image=image)
+        self.items[obj] = item
+        if isinstance(obj, Agent):
+            self.itemconfig(item, tags='agent')
+        elif raise_agents:
+            self.tag_raise('agent')
 
     def repintarAgente(self, can, envi):
-        self.repintar()
-        for agnt in envi.agents:
-            print agnt.location
-            tk_image=tk.PhotoImage(file=r"images\vacuum.gif")            
-            can.create_image(can.cell_topleft_xy(agnt.location), anchor="nw", image=tk_image)
+        "Bring the view up to date after a step."
+        if self.stale: self.pintarRaster()
 
     def repintar(self):
-        self.delete("all")        
-        self.pintarTablero()
-        self.pintarObjetos()
+        "Draw the whole view again."
+        self.delete("all")
+        self.items = {}
+        if self.sprites():
+            self.pintarTablero()
+            self.pintarObjetos()
+        else:
+            self.pintarRaster()
+
+    # Observing the environment
+
+    def object_added(self, obj):
+        if not self.sprites():
+            self.stale = True
+        elif self.in_view(obj.location):
+            self.draw_object(obj)
+
+    def objects_added(self, objs):
+        if not self.sprites():
+            self.stale = True
+            return
+        for obj in objs:
+            if self.in_view(obj.location):
+                self.draw_object(obj, raise_agents=False)
+        self.tag_raise('agent')
+
+    def object_moved(self, obj):
+        if not self.sprites():
+            self.stale = True
+            return
+        item = self.items.get(obj)
+        if not self.in_view(obj.location):
+            if item is not None:
+                self.delete(item)
+                del self.items[obj]
+        elif item is not None:
+            self.coords(item, *self.cell_topleft_xy(obj.location))
+        else:
+            self.draw_object(obj)
+
+    def population_moved(self, population):
+        if not self.sprites():
+            self.stale = True
+            return
+        for agent in population.views():
+            self.object_moved(agent)
+
+    def object_deleted(self, obj):
+        if not self.sprites():
+            self.stale = True
+        elif obj in self.items:
+            self.delete(self.items.pop(obj))
+
+    # Moving the view
+
+    def clamp(self, (x0, y0)):
+        "The nearest origin to (x0, y0) that keeps the view on the world."
+        nx, ny = self.page_cells()
+        return (clip(x0, 0, max(0, self.env.width - nx)),
+                clip(y0, 0, max(0, self.env.height - ny)))
+
+    def scroll(self, dx, dy):
+        "Move the view by dx, dy cells, but not past the edges of the world."
+        origin = self.clamp((self.origin[0] + dx, self.origin[1] + dy))
+        if origin != self.origin:
+            self.origin = origin
+            self.repintar()
+
+    def zoom(self, steps, event=None):
+        """Zoom in (steps > 0) or out by steps levels, keeping the cell at
+        the mouse pointer, if there is an event, where it is."""
+        levels = self.zooms
+        now = argmin(range(len(levels)),
+                     lambda i: abs(levels[i] - self.cellwidth))
+        i = clip(now - steps, 0, len(levels) - 1)
+        if levels[i] == self.cellwidth: return
+        px, py = if_(event, lambda: (event.x, event.y),
+                     (self.viewwidth // 2, self.viewheight // 2))
+        cx, cy = self.xy_cell((px, py))
+        self.cellwidth = levels[i]
+        self.origin = (0, 0)
+        ox, oy = self.xy_cell((px, py))
+        self.origin = self.clamp((cx - ox, cy - oy))
+        self.repintar()
+
+    def start_drag(self, event):
+        self.drag = (event.x, event.y)
+
+    def user_drag(self, event):
+        if self.drag is None: return
+        w = float(self.cellwidth)
+        dx = int((self.drag[0] - event.x) / w)
+        dy = int((self.drag[1] - event.y) / w)
+        if dx or dy:
+            self.drag = (self.drag[0] - dx * w, self.drag[1] - dy * w)
+            self.scroll(dx, dy)
         
     def user_left(self, event):
         print 'left at %d, %d' % self.event_cell(event)        
@@ -632,29 +2524,9 @@ class EnvCanvas (tk.Canvas, object):
         def draw_agent(agentType):
             def draw ():
                 obj = agentType()
-                self.env.add_object(obj, cell)
-                
-                print "Drawing agent %s at cell %s xy %s" % (obj, cell, xy)                
-                if isinstance(obj, ReflexVacuumAgent):
-                    tk_image=tk.PhotoImage(file=r"images\vacuum.gif")
-                    self.images.append(tk_image)
-                elif isinstance(obj, RandomAgent):
-                    tk_image=tk.PhotoImage(file=r"images\vacuum.gif")
-                    self.images.append(tk_image)
-                elif isinstance(obj, Wall):
-                    tk_image=tk.PhotoImage(file=r"images\wall.gif")
-                    self.images.append(tk_image)
-                elif isinstance(obj, Dirt):
-                    tk_image=tk.PhotoImage(file=r"images\dirt.gif")
-                    self.images.append(tk_image)
-                else:
-                    tk_image=tk.PhotoImage(file=r"images\vacuum.gif")
-                    self.images.append(tk_image)
-                
-                
-                for img in self.images:
-                    self.create_image(xy, anchor="nw", image=img)                
-                                    
+                self.env.add_object(obj, cell) ## We observe, and draw it
+                print "Drawing agent %s at cell %s xy %s" % (obj, cell, xy)
+                self.repintarAgente(self, self.env)
             return draw
 
         for agentType in obj_classes:
@@ -669,16 +2541,17 @@ class EnvCanvas (tk.Canvas, object):
     def xy_cell (self, (x, y)):
         """Given an (x, y) on the canvas, return the row and column
         of the cell containing it."""
-        w = self.cellwidth
-        return x / w, y / w
+        w = float(self.cellwidth)
+        return int(x / w) + self.origin[0], int(y / w) + self.origin[1]
     
     def cell_topleft_xy (self, (row, column)):
         """Given a (row, column) tuple, return the (x, y) coordinates
         of the cell(row, column)'s top left corner."""
 
-        w = self.cellwidth
-        return (w * row)+0.5, (w * column)+0.5
+        w, (x0, y0) = self.cellwidth, self.origin
+        return (w * (row - x0))+0.5, (w * (column - y0))+0.5
     
 
-w = EnvFrame(None);
+if __name__ == '__main__':
+    w = EnvFrame(None);
 
@@ -0,0 +1,568 @@
+"""Micro-benchmarks for the utilities and environments.
+
+Run all of them with "python benchmarks.py", or name the ones you want:
+"python benchmarks.py defaultdict".  Each benchmark prints a table of
+(case, seconds) rows with utils.print_table.
+
+"""
+from utils import *
+import time
+
+def timed(fn, *args):
+    "Call fn(*args) and return the elapsed wall-clock time in seconds."
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+class NullWriter:
+    "A file that throws away what is written to it."
+    def write(self, text): pass
+
+def quietly(fn, *args):
+    "Call fn(*args) with the environments' tracing output thrown away."
+    stdout, sys.stdout = sys.stdout, NullWriter()
+    try:
+        return fn(*args)
+    finally:
+        sys.stdout = stdout
+
+def dirty_vacuum_world(size, density, seed):
+    "A VacuumEnvironment of size x size cells with dirt on some of them."
+    import agents
+    env = quietly(agents.VacuumEnvironment, size)
+    rng = random.Random(seed)
+    for x in range(1, size - 1):
+        for y in range(1, size - 1):
+            if rng.random() < density:
+                quietly(env.add_object, agents.Dirt(), (x, y))
+    return env
+
+#______________________________________________________________________________
+
+class OldDefaultDict(dict):
+    """The DefaultDict as it was: deepcopy per miss, double lookup per hit."""
+    def __init__(self, default):
+        self.default = default
+
+    def __getitem__(self, key):
+        if key in self: return self.get(key)
+        return self.setdefault(key, copy.deepcopy(self.default))
+
+def bench_defaultdict(n=200000):
+    "Count n cells into a table, then read them all back."
+    cells = [(i % 500, i // 500) for i in range(n)]
+    def fill(d):
+        for cell in cells:
+            d[cell] += 1
+    def append(d):
+        for cell in cells:
+            d[cell].append(1)
+    def read(d):
+        for cell in cells:
+            d[cell]
+    rows = []
+    for name, make in [('old DefaultDict(0)', lambda: OldDefaultDict(0)),
+                       ('DefaultDict(0)', lambda: DefaultDict(0))]:
+        d = make()
+        rows.append([name + ' count', timed(fill, d)])
+        rows.append([name + ' read', timed(read, d)])
+    for name, make in [('old DefaultDict([])', lambda: OldDefaultDict([])),
+                       ('DefaultDict([])', lambda: DefaultDict([])),
+                       ('DefaultDict(factory=list)',
+                        lambda: DefaultDict(factory=list))]:
+        rows.append([name + ' append', timed(append, make())])
+    print_table(rows, ['case', 'seconds'], numfmt='%.4f')
+
+#______________________________________________________________________________
+
+class OldWall(object):
+    """A Wall as it was: a __dict__ per object, plus the holding and held
+    slots that XYEnvironment.add_object used to attach to everything."""
+
+def object_bytes(obj):
+    "Bytes taken by obj, its __dict__ and its holding list, if any."
+    total = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'): total += sys.getsizeof(obj.__dict__)
+    if hasattr(obj, 'holding'): total += sys.getsizeof(obj.holding)
+    return total
+
+def bench_objects(n=100000):
+    "Bytes per object, and time to build n objects, before and after slots."
+    import agents
+    def old_wall(location):
+        obj = OldWall()
+        obj.location, obj.holding, obj.held = location, [], None
+        return obj
+    def new_wall(location):
+        obj = agents.Wall()
+        obj.location = location
+        return obj
+    def new_agent(location):
+        obj = agents.Agent()
+        obj.location, obj.holding, obj.held = location, [], None
+        return obj
+    rows = []
+    for name, make in [('old Wall', old_wall), ('Wall', new_wall),
+                       ('Agent', new_agent)]:
+        objs = []
+        seconds = timed(lambda: objs.extend(make((i, i)) for i in range(n)))
+        rows.append([name, object_bytes(objs[0]), seconds])
+    print_table(rows, ['case', 'bytes/object', 'seconds'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_rules(sizes=(10, 1000, 100000), queries=200):
+    """Microseconds per match, linear rule_match against a RuleIndex, for
+    location-specific vacuum rules with a catch-all rule at the end."""
+    import agents
+    rows = []
+    for n in sizes:
+        side = int(math.sqrt(n / 2)) + 1
+        rules = [agents.Rule({0: status, 1: (i % side, i // side)}, 'NoOp')
+                 for i in range(n // 2) for status in ('Dirty', 'Clean')]
+        rules.append(agents.Rule({}, 'Suck'))
+        index = agents.RuleIndex(rules)
+        states = [(random.choice(['Dirty', 'Clean']),
+                   (random.randrange(side), random.randrange(side + 1)))
+                  for q in range(queries)]
+        def run(rules):
+            for state in states:
+                agents.rule_match(state, rules)
+        linear, indexed = timed(run, rules), timed(run, index)
+        rows.append([len(rules), 1e6 * linear / queries,
+                     1e6 * indexed / queries])
+    print_table(rows, ['rules', 'linear us/match', 'indexed us/match'],
+                numfmt='%.6g')
+
+#______________________________________________________________________________
+
+def bench_vacuum(size=20, density=0.2, max_steps=5000, seed=1):
+    """Steps to clean a board, and milliseconds of agent program per step,
+    for the random reflex agent and the model-based agent."""
+    import agents
+    rows = []
+    for name, make in [
+        ('SimpleReflexAgent', agents.SimpleReflexAgent),
+        ('ModelBased, recompute', lambda: agents.ModelBasedVacuumAgent(False)),
+        ('ModelBasedVacuumAgent', agents.ModelBasedVacuumAgent)]:
+        env = dirty_vacuum_world(size, density, seed)
+        random.seed(seed)
+        agent = make()
+        program, clock = agent.program, [0.0]
+        def timed_program(percept):
+            start = time.time()
+            action = program(percept)
+            clock[0] += time.time() - start
+            return action
+        agent.program = timed_program
+        quietly(env.add_object, agent, (1, 1))
+        steps = 0
+        while steps < max_steps:
+            if not [o for o in env.objects if isinstance(o, agents.Dirt)]:
+                break
+            quietly(env.step)
+            steps += 1
+        rows.append([name, steps, 1000 * clock[0] / max(steps, 1)])
+    print_table(rows, ['agent', 'steps', 'program ms/step'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def pipe_agents(conn, AgentFactory, n):
+    "Answer pickled lists of (slot, percept) pairs sent over conn."
+    programs = [AgentFactory().program for i in range(n)]
+    for requests in iter(conn.recv, None):
+        conn.send([programs[slot](percept) for (slot, percept) in requests])
+
+def bench_remote(n=1000, steps=50):
+    """Milliseconds per step for n agents in 2 worker processes, one pickled
+    pipe message per agent against one shared-memory exchange per step."""
+    import agents, agenthost, multiprocessing
+    make = lambda: agents.RandomAgent(['Suck', 'NoOp'])
+    percepts = [(slot, ('Dirty', (slot, 1))) for slot in range(n)]
+    def by_pipe():
+        ends = [multiprocessing.Pipe() for i in range(2)]
+        for (conn, other) in ends:
+            multiprocessing.Process(target=pipe_agents,
+                                    args=(other, make, n)).start()
+        def step():
+            for (slot, percept) in percepts:
+                conn = ends[slot % 2][0]
+                conn.send([(slot, percept)])
+                conn.recv()
+        seconds = timed(lambda: [step() for i in range(steps)])
+        for (conn, other) in ends: conn.send(None)
+        return seconds
+    def by_host():
+        host = agenthost.AgentHost(make, n, agenthost.VacuumCodec(),
+                                   ['Suck', 'NoOp'], workers=2)
+        seconds = timed(lambda: [host.exchange(percepts)
+                                 for i in range(steps)])
+        host.close()
+        return seconds
+    print_table([['pipe per agent', 1000 * by_pipe() / steps],
+                 ['AgentHost.exchange', 1000 * by_host() / steps]],
+                ['case', 'ms/step'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_dirt(size=200, rate=0.01, steps=20):
+    """Milliseconds per step to re-soil a board, with a Python loop over the
+    cells calling add_object, and with VacuumEnvironment.regenerate_dirt."""
+    import agents
+    def by_loop():
+        env = quietly(agents.VacuumEnvironment, size)
+        def step():
+            for x in range(1, size - 1):
+                for y in range(1, size - 1):
+                    if random.random() < rate:
+                        env.add_object(agents.Dirt(), (x, y))
+        return quietly(timed, lambda: [step() for i in range(steps)]), env
+    def vectorized(rates):
+        env = quietly(agents.VacuumEnvironment, size)
+        env.regenerate_dirt(rates, seed=1)
+        return timed(lambda: [env.exogenous_change()
+                              for i in range(steps)]), env
+    rows = []
+    for name, run in [('add_object loop', by_loop),
+                      ('regenerate_dirt(rate)', lambda: vectorized(rate)),
+                      ('regenerate_dirt(array)', lambda: vectorized(
+                          agents.numpy.ones((size, size)) * rate))]:
+        seconds, env = run()
+        rows.append([name, 1000 * seconds / steps, len(env.objects)])
+    print_table(rows, ['case', 'ms/step', 'objects'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_delete(deletes=200, seed=1):
+    """Microseconds to delete a Dirt from worlds with more and more of it,
+    with the objects in a plain list and in the environment's ObjectList."""
+    import agents
+    rows = []
+    for n in [10000, 100000, 300000]:
+        size = int(n ** 0.5) + 2
+        row = ['%d' % n]
+        for make in [list, agents.ObjectList]:
+            env = quietly(agents.VacuumEnvironment, size)
+            quietly(env.add_objects,
+                    [(agents.Dirt(), (x, y)) for x in range(1, size - 1)
+                     for y in range(1, size - 1)][:n])
+            env.objects = make(env.objects)
+            doomed = random.Random(seed).sample(env.objects, deletes)
+            seconds = quietly(timed, lambda: map(env.delete_object, doomed))
+            row.append(1e6 * seconds / deletes)
+        rows.append(row)
+    print_table(rows, ['dirt', 'list us', 'ObjectList us'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_render(frames=200):
+    "Frames per second drawn by the offscreen Renderer."
+    import agents, render
+    rows = []
+    for size, density, cellsize in [(50, 0.2, 8), (500, 0.05, 1),
+                                    (500, 0.05, 2)]:
+        env = dirty_vacuum_world(size, density, 1)
+        renderer = render.Renderer(env, cellsize)
+        frame = renderer.render()
+        seconds = timed(lambda: [renderer.render(frame)
+                                 for i in range(frames)])
+        rows.append(['%dx%d board, %dpx cells' % (size, size, cellsize),
+                     len(env.objects), frames / seconds])
+    print_table(rows, ['case', 'objects', 'frames/s'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_metrics(agents_per_env=50, steps=200, seed=1):
+    """Seconds for steps of a vacuum world full of reflex agents, with and
+    without enable_metrics, and the overhead of the metrics in percent."""
+    import agents
+    rows, base = [], None
+    for name, on in [('metrics off', False), ('metrics on', True)]:
+        env = dirty_vacuum_world(30, 0.2, seed)
+        random.seed(seed)
+        for i in range(agents_per_env):
+            quietly(env.add_object, agents.SimpleReflexAgent(),
+                    (random.randrange(1, 29), random.randrange(1, 29)))
+        if on: env.enable_metrics()
+        seconds = quietly(timed, env.run, steps)
+        if base is None: base = seconds
+        rows.append([name, seconds, 100 * (seconds - base) / base])
+    print_table(rows, ['case', 'seconds', 'overhead %'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_moves(n=5000, size=200, steps=20, seed=1):
+    """Milliseconds per step for n random vacuum agents to move, one at a
+    time with move_to, and all at once with each batch_moves policy."""
+    import agents
+    rows = []
+    for policy in [None] + agents.XYEnvironment.move_policies:
+        env = quietly(agents.VacuumEnvironment, size)
+        rng = random.Random(seed)
+        for i in range(n):
+            agent = agents.Agent()
+            agent.performance = 0
+            agent.location = (rng.randrange(1, size - 1),
+                              rng.randrange(1, size - 1))
+            env.agents.append(agent)
+        if policy: env.batch_moves(policy, seed)
+        moves = [[rng.choice(['Up', 'Down', 'Left', 'Right'])
+                  for i in range(n)] for step in range(steps)]
+        seconds = quietly(timed, lambda: [env.execute_actions(env.agents, m)
+                                          for m in moves])
+        rows.append([policy or 'move_to', 1000 * seconds / steps,
+                     len(set([agent.location for agent in env.agents]))])
+    print_table(rows, ['policy', 'ms/step', 'cells occupied'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_percepts(n=20000, size=50, seed=1):
+    """Microseconds to make a percept and run an agent program on it, with
+    the old tuple percept and with VacuumEnvironment.percept."""
+    import agents
+    env = dirty_vacuum_world(size, 0.2, seed)
+    def tuple_percept(agent):
+        status = if_(env.some_objects_at(agent.location, agents.Dirt),
+                     'Dirty', 'Clean')
+        return (status, agent.location)
+    rows = []
+    for name, make in [('RandomVacuumAgent', agents.RandomVacuumAgent),
+                       ('ModelBasedVacuumAgent', agents.ModelBasedVacuumAgent)]:
+        row = [name]
+        for percept in [tuple_percept, env.percept]:
+            agent = make()
+            agent.location = (1, 1)
+            program = agent.program
+            seconds = quietly(timed, lambda: [program(percept(agent))
+                                              for i in range(n)])
+            row.append(1e6 * seconds / n)
+        rows.append(row)
+    print_table(rows, ['agent', 'tuple us', 'env.percept us'], numfmt='%.3g')
+
+#______________________________________________________________________________
+
+def bench_population(size=300, steps=10, seed=1):
+    """Microseconds per agent per step for reflex vacuum agents as Agent
+    objects, and as an AgentPopulation, and the bytes each agent takes."""
+    import agents
+    numpy = agents.numpy
+    rows = []
+    for name, n in [('SimpleReflexAgent', 2000),
+                    ('AgentPopulation', 2000), ('AgentPopulation', 100000)]:
+        env = quietly(agents.VacuumEnvironment, size, size, True)
+        env.regenerate_dirt(0.01, seed=seed)
+        cells = numpy.random.RandomState(seed).randint(1, size - 1, (n, 2))
+        if name == 'AgentPopulation':
+            population = agents.AgentPopulation(
+                agents.reflex_population_program,
+                ['Suck', 'Left', 'Right', 'Up', 'Down'], cells, seed)
+            env.add_population(population)
+            size_of = sum([a.nbytes for a in [population.positions,
+                           population.performance, population.alive,
+                           population.bump]]) / float(n)
+        else:
+            for cell in cells.tolist():
+                quietly(env.add_object, agents.SimpleReflexAgent(),
+                        tuple(cell))
+            size_of = object_bytes(env.agents[0])
+        seconds = quietly(timed, env.run, steps)
+        rows.append(['%d %s' % (n, name), 1e6 * seconds / steps / n, size_of])
+    print_table(rows, ['agents', 'us/agent/step', 'bytes/agent'],
+                numfmt='%.3g')
+
+#______________________________________________________________________________
+
+def bench_random(n=1000, steps=1000, seed=1):
+    """Microseconds per call of RandomAgent programs: random.choice on the
+    global generator as before, a stream per agent, and one RandomBlocks
+    shared by all the agents."""
+    import agents
+    actions = ['Right', 'Left', 'Suck', 'NoOp']
+    def old_program():
+        return lambda percept: random.choice(actions)
+    blocks = agents.RandomBlocks(seed)
+    rows = []
+    for name, make in [
+        ('random.choice', old_program),
+        ('own stream', lambda: agents.RandomAgent(actions).program),
+        ('shared blocks', lambda: agents.RandomAgent(actions,
+                                                     blocks=blocks).program)]:
+        random.seed(seed)
+        programs = [make() for i in range(n)]
+        seconds = timed(lambda: [[program(None) for program in programs]
+                                 for step in range(steps)])
+        rows.append([name, 1e6 * seconds / (n * steps)])
+    print_table(rows, ['case', 'us/call'], numfmt='%.3g')
+
+#______________________________________________________________________________
+
+def bench_shards(n=400000, size=1000, steps=10, seed=1):
+    """Milliseconds per step for a big population of reflex agents, stepped
+    by the environment and by ShardedWorlds with more and more workers."""
+    import agents, shards
+    numpy = agents.numpy
+    def world():
+        env = quietly(agents.VacuumEnvironment, size, size, True)
+        env.regenerate_dirt(0.01, seed=seed)
+        cells = numpy.random.RandomState(seed).randint(1, size - 1, (n, 2))
+        env.add_population(agents.AgentPopulation(
+            agents.reflex_population_program,
+            ['Suck', 'Left', 'Right', 'Up', 'Down'], cells, seed))
+        return env
+    env = world()
+    rows = [['Environment.step', 1000 * timed(env.run, steps) / steps]]
+    for workers in [1, 2, 4]:
+        env = world()
+        sharded = shards.ShardedWorld(env, env.populations[0], workers)
+        rows.append(['%d workers' % workers,
+                     1000 * timed(sharded.run, steps) / steps])
+        sharded.close()
+    print_table(rows, ['case', 'ms/step'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_memo(calls=20000, size=20, seed=1):
+    """Microseconds per call of an expensive pure program, called directly
+    and through a MemoProgram, for a random walk over a size x size board
+    (few percepts) and for percepts that never repeat (the cache gives
+    up)."""
+    import agents
+    def plan((status, (x, y))):
+        return ['Left', 'Right', 'Up', 'Down'][
+            sum([(x * i + y) % 7 for i in range(500)]) % 4]
+    rng = random.Random(seed)
+    walk = [(rng.choice(['Clean', 'Dirty']),
+             (rng.randrange(size), rng.randrange(size)))
+            for i in range(calls)]
+    unique = [('Clean', (i, i)) for i in range(calls)]
+    rows = []
+    for name, percepts in [('random walk', walk), ('never repeats', unique)]:
+        row = [name]
+        for program in [plan, agents.MemoProgram(plan, agents.MemoCache())]:
+            seconds = timed(lambda: [program(p) for p in percepts])
+            row.append(1e6 * seconds / calls)
+        row.append(program.cache.stats()['hit_rate'])
+        rows.append(row)
+    print_table(rows, ['percepts', 'direct us', 'memo us', 'hit rate'],
+                numfmt='%.3g')
+
+#______________________________________________________________________________
+
+def bench_trace(calls=100000):
+    """Microseconds per traced program call: printing each one, as
+    TraceAgent did (to a NullWriter), and recording it in a TraceRecorder."""
+    import agents
+    def printing(agent):
+        old_program = agent.program
+        def new_program(percept):
+            action = old_program(percept)
+            print '%s perceives %s and does %s' % (agent, percept, action)
+            return action
+        agent.program = new_program
+        return agent
+    percepts = [(['Clean', 'Dirty'][i % 2], (i % 10, i % 7))
+                for i in range(calls)]
+    rows = []
+    for name, wrap in [('print', printing),
+                       ('TraceRecorder', lambda agent: agents.TraceAgent(
+                           agent, agents.TraceRecorder())),
+                       ('TraceRecorder, off', lambda agent: agents.TraceAgent(
+                           agent, agents.TraceRecorder(), on=False))]:
+        program = wrap(agents.RandomVacuumAgent()).program
+        seconds = quietly(timed, lambda: [program(p) for p in percepts])
+        rows.append([name, 1e6 * seconds / calls])
+    print_table(rows, ['trace', 'us/call'], numfmt='%.3g')
+
+#______________________________________________________________________________
+
+def bench_trajectories(agents_per_env=100, size=30, steps=500, seed=1):
+    """Seconds to run a vacuum world of random agents while recording
+    every transition, by appending tuples to a list and pickling it at
+    the end, and with a TrajectoryWriter; and the bytes written."""
+    import agents, trajectories, cPickle, tempfile, shutil
+    class ListWriter:
+        def observe(self, env):
+            self.before = [(env.percept_status(agent), agent.location,
+                            agent.performance) for agent in env.agents]
+        def record(self, env, actions):
+            for (agent, (status, location, performance), action) in zip(
+                env.agents, self.before, actions):
+                self.rows.append((status, location, action,
+                                  agent.performance - performance,
+                                  env.is_done()))
+        def close(self):
+            f = open(os.path.join(self.directory, 'rows.pickle'), 'wb')
+            cPickle.dump(self.rows, f, 2)
+            f.close()
+    def list_writer(directory):
+        writer = ListWriter()
+        writer.directory, writer.rows = directory, []
+        writer.attach = lambda env: setattr(env, 'trajectory', writer)
+        return writer
+    rows = []
+    for name, make in [('list + pickle', list_writer),
+                       ('TrajectoryWriter', trajectories.TrajectoryWriter)]:
+        env = dirty_vacuum_world(size, 0.2, seed)
+        for i in range(agents_per_env):
+            quietly(env.add_object, agents.RandomVacuumAgent(seed + i),
+                    (1 + i % (size - 2), 1 + i // (size - 2)))
+        directory = tempfile.mkdtemp()
+        writer = make(directory)
+        writer.attach(env)
+        def run():
+            env.run(steps)
+            writer.close()
+        seconds = quietly(timed, run)
+        written = sum([os.path.getsize(os.path.join(directory, f))
+                       for f in os.listdir(directory)])
+        shutil.rmtree(directory)
+        rows.append([name, seconds, written])
+    print_table(rows, ['writer', 'seconds', 'bytes'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+def bench_scheduler(n=1000, period=100, steps=2000):
+    """Seconds to run a world of n agents that each do something every
+    period steps, with Environment.run (whose programs do NoOp in between)
+    and with an EventScheduler, which only calls them when they are due."""
+    import agents, scheduler
+    class Tally(agents.Environment):
+        def percept(self, agent): return self.trace.now
+        def execute_action(self, agent, action):
+            if action != 'NoOp': agent.performance += 1
+    def world(program):
+        env = Tally()
+        for i in range(n):
+            agent = agents.Agent()
+            agent.program, agent.performance = program, 0
+            env.agents.append(agent)
+        return env
+    ticks = world(lambda now: if_(now % period == 0, 'Work', 'NoOp'))
+    events = world(lambda now: 'Work')
+    def run_events():
+        runner = scheduler.EventScheduler(events, exogenous_every=None)
+        for agent in events.agents: runner.set_period(agent, period)
+        runner.run(steps)
+    rows = [['Environment.run', timed(ticks.run, steps)],
+            ['EventScheduler', timed(run_events)]]
+    assert ([a.performance for a in ticks.agents] ==
+            [a.performance for a in events.agents])
+    print_table(rows, ['runner', 'seconds'], numfmt='%.4g')
+
+#______________________________________________________________________________
+
+benchmarks = Dict(defaultdict=bench_defaultdict, objects=bench_objects,
+                  rules=bench_rules, vacuum=bench_vacuum,
+                  remote=bench_remote, dirt=bench_dirt,
+                  delete=bench_delete, render=bench_render,
+                  metrics=bench_metrics,
+                  moves=bench_moves, percepts=bench_percepts,
+                  population=bench_population, random=bench_random,
+                  shards=bench_shards, memo=bench_memo,
+                  trace=bench_trace, trajectories=bench_trajectories,
+                  scheduler=bench_scheduler)
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(benchmarks):
+        print '==', name
+        benchmarks[name]()
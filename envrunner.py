@@ -0,0 +1,176 @@
+"""Run environments whose agent programs are slow or live in other processes.
+
+ConcurrentRunner steps an Environment with every agent program running at
+once on worker threads, so one slow agent (a planner, or a program served
+over a socket) no longer stalls the others.  An agent that misses the
+deadline does the default action for that step.
+
+AgentServer serves an agent over TCP, and socket_program is the matching
+client: an agent program that asks the server for each action.
+
+>>> class Counter(Environment):
+...     def percept(self, agent): return agent.performance
+...     def execute_action(self, agent, action):
+...         if action == 'Up': agent.performance += 1
+>>> def slow_program(percept):
+...     time.sleep(1.0)
+...     return 'Up'
+>>> server = AgentServer(('localhost', 0), lambda: RandomAgent(['Up']))
+>>> thread = threading.Thread(target=server.serve_forever)
+>>> thread.daemon = True; thread.start()
+>>> env = Counter()
+>>> remote, slow = Agent(), Agent()
+>>> remote.program = socket_program(server.server_address)
+>>> slow.program = slow_program
+>>> for agent in [remote, slow]:
+...     agent.performance = 0
+...     env.agents.append(agent)
+>>> runner = ConcurrentRunner(env, timeout=0.2)
+>>> runner.run(3)
+>>> remote.performance, slow.performance, runner.timeouts[slow]
+(3, 0, 1)
+>>> remote.program.close(); runner.close(); server.shutdown()
+"""
+from agents import *
+from multiprocessing.pool import ThreadPool
+import multiprocessing, threading, socket, SocketServer, ast, time
+
+#______________________________________________________________________________
+
+class ConcurrentRunner (object):
+    """Step env with the programs of all its agents running concurrently.
+    Percepts are computed, and actions executed, on the calling thread in
+    the order of env.agents, so runs are as repeatable as the programs; a
+    lazy Percept is worked out before it is handed over (see
+    Percept.detached), so a late program still sees the world as it was.
+    An agent whose program has not answered timeout seconds after the step
+    started does the default action; it is not called again until that
+    program returns, and its late answer is dropped.  .timeouts counts the
+    timed-out calls of each agent.  Otherwise a step is just as
+    env.step() would make it:
+    >>> def world():
+    ...     env = VacuumEnvironment(6, implicit_walls=True)
+    ...     env.batch_moves('first')
+    ...     for (action, location) in [('Right', (1, 1)), ('Left', (3, 1))]:
+    ...         env.add_object(RandomAgent([action]), location)
+    ...     env.add_population(AgentPopulation(reflex_population_program,
+    ...         ['Suck', 'Left', 'Right', 'Up', 'Down'], [(3, 3)], seed=1))
+    ...     return env
+    >>> stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    >>> serial, threaded = world(), world()
+    >>> serial.step()
+    >>> runner = ConcurrentRunner(threaded)
+    >>> runner.step(); runner.close()
+    >>> sys.stdout = stdout
+    >>> [agent.location for agent in threaded.agents]
+    [(2, 1), (3, 1)]
+    >>> (threaded.populations[0].positions.tolist(), threaded.trace.now)
+    ([[3, 4]], 1)
+    >>> ([agent.location for agent in serial.agents],
+    ...  serial.populations[0].positions.tolist(), serial.trace.now)
+    ([(2, 1), (3, 1)], [[3, 4]], 1)
+
+    A program that answers late read its percept as it was at the start of
+    the step, not after the other agents acted:
+
+    >>> seen = []
+    >>> def late(percept):
+    ...     time.sleep(0.5)
+    ...     seen.append(percept[0])
+    ...     return 'NoOp'
+    >>> slow = Agent(); slow.program = late
+    >>> env = VacuumEnvironment(4, implicit_walls=True)
+    >>> stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    >>> env.add_object(Dirt(), (1, 1))
+    >>> env.add_object(RandomAgent(['Suck']), (1, 1))
+    >>> env.add_object(slow, (1, 1))
+    >>> runner = ConcurrentRunner(env, timeout=0.1)
+    >>> runner.step(); time.sleep(1.0); runner.close()
+    >>> sys.stdout = stdout
+    >>> seen, env.percept_status(slow)
+    (['Dirty'], 'Clean')
+    """
+
+    def __init__(self, env, timeout=1.0, default='NoOp', workers=16):
+        self.env = env
+        self.timeout = timeout
+        self.default = default
+        self.pool = ThreadPool(workers)
+        self.pending = {}
+        self.timeouts = DefaultDict(0)
+
+    def step(self):
+        "Run the environment for one time step."
+        env = self.env
+        if env.is_done(): return
+        env.begin_step()
+        calls = []
+        for agent in env.agents:
+            call = self.pending.get(agent)
+            if call is not None and not call.ready():
+                calls.append(None)
+            else:
+                self.pending.pop(agent, None)
+                percept = detached(env.percept(agent))
+                calls.append(self.pool.apply_async(agent.program, (percept,)))
+        deadline = time.time() + self.timeout
+        actions = []
+        for agent, call in zip(env.agents, calls):
+            action = self.default
+            if call is not None:
+                try:
+                    action = call.get(max(0, deadline - time.time()))
+                except multiprocessing.TimeoutError:
+                    self.pending[agent] = call
+                    self.timeouts[agent] += 1
+            actions.append(action)
+        env.apply_actions(env.agents, actions)
+
+    def run(self, steps=1000):
+        """Run the Environment for given number of time steps."""
+        for step in range(steps):
+            if self.env.is_done(): return
+            self.step()
+
+    def close(self):
+        "Stop the worker threads."
+        self.pool.terminate()
+
+#______________________________________________________________________________
+# Agents over TCP: one percept per line, written as a Python literal, and
+# one action per line in reply.
+
+class AgentRequestHandler (SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        program = self.server.AgentFactory().program
+        for line in self.rfile:
+            action = program(ast.literal_eval(line.strip()))
+            self.wfile.write('%s\n' % action)
+
+class AgentServer (SocketServer.ThreadingTCPServer):
+    """Serve agents at address: each connection gets a new agent made by
+    AgentFactory, whose program answers the percepts sent over it."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, AgentFactory):
+        self.AgentFactory = AgentFactory
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 AgentRequestHandler)
+
+def socket_program(address, timeout=None):
+    """Return an agent program that sends each percept to the AgentServer
+    at address and returns the action it answers with.  Call its .close()
+    to hang up."""
+    sock = socket.create_connection(address, timeout)
+    replies = sock.makefile('rb')
+    def program(percept):
+        if isinstance(percept, Percept): percept = tuple(percept)
+        sock.sendall('%r\n' % (percept,))
+        return replies.readline().strip()
+    def close():
+        replies.close()
+        sock.close()
+    program.close = close
+    return program
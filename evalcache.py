@@ -0,0 +1,256 @@
+"""A cache on disk for the scores of test_agent evaluations.
+
+cached_test_agent(cache, AgentFactory, steps, envs, seed) returns what
+test_agent would, but looks up each environment's score in a ResultCache
+first.  Scores are keyed by a stable hash of the environment (its class,
+size, objects, dirt regeneration, move policy and populations), the
+agent factory (the source of the factory, of the agent's classes and of
+its program, and its .version attribute, if any), the seed and the
+number of steps, so changing any of these makes a new entry.  The source
+of the environment's classes is part of the key too.  Each entry is a
+small file, written to a temporary name and renamed into place, so any
+number of worker processes can share one cache directory.  When there
+are more than about max_entries, the least recently used ones are
+removed.
+
+>>> import tempfile, shutil
+>>> cache = ResultCache(tempfile.mkdtemp())
+>>> def make_env():
+...     env = VacuumEnvironment(6, implicit_walls=True)
+...     env.add_objects([(Dirt(), (2, 2)), (Dirt(), (3, 4))])
+...     return env
+>>> stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+>>> first = cached_test_agent(cache, ModelBasedVacuumAgent, 50, [make_env()])
+>>> sys.stdout = stdout
+>>> cached_test_agent(cache, ModelBasedVacuumAgent, 50, [make_env()]) == first
+True
+>>> cache.hits, cache.misses, len(cache)
+(1, 1, 1)
+>>> shutil.rmtree(cache.directory)
+"""
+from agents import *
+import ast, hashlib, inspect, os, tempfile
+
+#______________________________________________________________________________
+
+class ResultCache (object):
+    """A directory of results, one file per key, holding at most about
+    max_entries of them.  .hits and .misses count the lookups.  The
+    directory is scanned when the cache is opened, and after that only
+    once the entries this cache has added make it slack (a fraction of
+    max_entries) too big, so a store costs the same however big the cache
+    is.  Entries that other processes add count only at the next scan.
+    >>> import tempfile, shutil
+    >>> cache = ResultCache(tempfile.mkdtemp(), max_entries=10, slack=0.5)
+    >>> for i in range(100): cache.put('%04d' % i, i)
+    >>> len(cache) <= 15, cache.scans, cache.get('0099'), cache.get('0000')
+    (True, 16, 99, None)
+    >>> shutil.rmtree(cache.directory)
+    """
+
+    def __init__(self, directory, max_entries=100000, slack=0.1):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.limit = max_entries + int(slack * max_entries)
+        self.hits = self.misses = self.stores = self.evictions = 0
+        self.scans = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): raise
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, default=None):
+        "The value stored under key, or default."
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                value = ast.literal_eval(f.read())
+            finally:
+                f.close()
+            os.utime(path, None) ## Recently used: keep it longer
+        except (IOError, OSError, SyntaxError, ValueError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        "Store value, a Python literal, under key."
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): raise
+        new = not os.path.exists(path)
+        fd, temp = tempfile.mkstemp(dir=directory)
+        os.write(fd, repr(value))
+        os.close(fd)
+        try:
+            os.rename(temp, path)
+        except OSError:
+            ## Windows will not rename over a file; another worker has
+            ## just stored the same result, so keep theirs.
+            os.remove(temp)
+        self.stores += 1
+        self.count += new
+        if self.count > self.limit:
+            self.evict()
+
+    def entries(self):
+        "A list of (last use, path) pairs for all the entries."
+        result = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    result.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass ## Evicted by someone else
+        return result
+
+    def evict(self):
+        """Scan the directory, and remove the least recently used entries
+        beyond max_entries."""
+        entries = self.entries()
+        self.scans += 1
+        self.count = min(len(entries), self.max_entries)
+        if len(entries) <= self.max_entries: return
+        entries.sort()
+        for (used, path) in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self.entries())
+
+    def stats(self):
+        return Dict(hits=self.hits, misses=self.misses, stores=self.stores,
+                    evictions=self.evictions)
+
+#______________________________________________________________________________
+
+def array_signature(value):
+    """value, or for a NumPy array, its shape, type and a hash of its data
+    (the repr of a large array leaves most of it out)."""
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        data = numpy.ascontiguousarray(value).tostring()
+        return (value.shape, str(value.dtype), hashlib.sha1(data).hexdigest())
+    return value
+
+def random_signature(rng):
+    "The state of a NumPy RandomState, or None."
+    if rng is None: return None
+    return tuple(map(array_signature, rng.get_state()))
+
+def env_signature(env):
+    """A description of an environment that stays the same from run to run:
+    the source of its classes, its objects, and whatever else changes
+    what happens in it (dirt that appears by itself, move policies and
+    populations).
+    >>> def make_env():
+    ...     env = VacuumEnvironment(6, implicit_walls=True)
+    ...     env.add_objects([(Dirt(), (2, 2))])
+    ...     return env
+    >>> plain, busy = make_env(), make_env()
+    >>> busy.regenerate_dirt(0.5, seed=1); busy.batch_moves('bump')
+    >>> env_signature(plain) == env_signature(make_env())
+    True
+    >>> env_signature(plain) == env_signature(busy)
+    False
+    >>> 'class VacuumEnvironment' in repr(env_signature(plain))
+    True
+    """
+    objects = sorted([(obj.__class__.__name__, repr(obj.location))
+                      for obj in env.objects + env.agents])
+    dirt = None
+    if getattr(env, 'dirt_rate', None) is not None:
+        dirt = (array_signature(env.dirt_rate), env.dirt_every,
+                env.dirt_poisson, random_signature(env.dirt_random))
+    moves = getattr(env, 'move_policy', None)
+    if moves is not None:
+        moves = (moves, random_signature(getattr(env, 'move_random', None)))
+    populations = [(code_signature(p.program), p.actions, p.seed, p.steps,
+                    array_signature(p.positions), array_signature(p.alive),
+                    array_signature(p.performance))
+                   for p in getattr(env, 'populations', [])]
+    classes = [c for c in env.__class__.__mro__ if issubclass(c, Environment)]
+    return (env.__class__.__module__, env.__class__.__name__,
+            [class_source(c) for c in classes],
+            getattr(env, 'width', None), getattr(env, 'height', None),
+            getattr(env, 'implicit_walls', None), objects, dirt, moves,
+            populations)
+
+def code_signature(obj):
+    """The source of a function or class, or of the class of any other
+    object; None if it cannot be found."""
+    if not (inspect.isfunction(obj) or inspect.ismethod(obj) or
+            inspect.isclass(obj)):
+        obj = obj.__class__
+    try:
+        return inspect.getsource(obj)
+    except (IOError, TypeError):
+        return None
+
+## Class -> its source, read once: classes do not change while running
+class_sources = {}
+
+def class_source(cls):
+    if cls not in class_sources: class_sources[cls] = code_signature(cls)
+    return class_sources[cls]
+
+def factory_signature(AgentFactory):
+    """A description of an agent factory that changes when its code does:
+    the source of the factory, of the classes of the agent it makes (up to
+    Agent) and of that agent's program, so that editing RandomAgent changes
+    the description of RandomVacuumAgent.  Code that the program calls is
+    left out; give the factory a .version, and change it, for that.
+    >>> 'class RandomAgent' in repr(factory_signature(RandomVacuumAgent))
+    True
+    """
+    state = random.getstate() ## Making the agent may draw from random
+    try:
+        agent = AgentFactory()
+    finally:
+        random.setstate(state)
+    program = agent.program
+    if isinstance(program, MemoProgram): program = program.program
+    classes = [c for c in agent.__class__.__mro__ if issubclass(c, Agent)]
+    return (getattr(AgentFactory, '__module__', None),
+            getattr(AgentFactory, '__name__', repr(AgentFactory)),
+            getattr(AgentFactory, 'version', None),
+            code_signature(AgentFactory),
+            [code_signature(c) for c in classes], code_signature(program))
+
+def result_key(*parts):
+    "A stable hash of a tuple of descriptions, for use as a cache key."
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def cached_test_agent(cache, AgentFactory, steps, envs, seed=0):
+    """Return the mean score of running an agent in each of the envs, for
+    steps, like test_agent, but take each score from cache when it is
+    there.  The random module is seeded with seed before each run."""
+    agent_part = factory_signature(AgentFactory)
+    total = 0
+    for env in envs:
+        key = result_key(env_signature(env), agent_part, seed, steps)
+        score = cache.get(key)
+        if score is None:
+            random.seed(seed)
+            agent = AgentFactory()
+            env.add_object(agent)
+            env.run(steps)
+            score = agent.performance
+            cache.put(key, score)
+        total += score
+    return float(total)/len(envs)
@@ -0,0 +1,206 @@
+"""Counters, gauges and latency histograms for long-running simulations.
+
+A Registry holds named metrics and exports them all, either in the
+Prometheus text format (to a file, or over HTTP with serve_metrics) or
+as a JSON snapshot.  Environment.enable_metrics() wires a standard set of
+them (steps, percepts, agent program latency, bumps, sucks, GC counts)
+into Environment.step, execute_action and move_to.
+
+>>> registry = Registry()
+>>> steps = registry.counter('steps_total', 'Steps run.')
+>>> latency = registry.histogram('latency_seconds', 'Latency.', [0.1, 1])
+>>> steps.inc(); steps.inc(2); latency.observe(0.05); latency.observe(5)
+>>> print registry.prometheus(),
+# HELP latency_seconds Latency.
+# TYPE latency_seconds histogram
+latency_seconds_bucket{le="0.1"} 1
+latency_seconds_bucket{le="1"} 1
+latency_seconds_bucket{le="+Inf"} 2
+latency_seconds_sum 5.05
+latency_seconds_count 2
+# HELP steps_total Steps run.
+# TYPE steps_total counter
+steps_total 3
+>>> registry.snapshot()['steps_total']
+3
+"""
+from utils import *
+import BaseHTTPServer, gc, json, tempfile, threading
+
+#______________________________________________________________________________
+
+class Counter (object):
+    "A number that only goes up."
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name, self.help, self.value = name, help, 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+    def snapshot(self):
+        return self.value
+
+class Gauge (object):
+    """A number that goes up and down; if fn is given, the value is fn(),
+    read whenever the gauge is exported."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        self.name, self.help, self.fn, self.value = name, help, fn, 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.fn: return self.fn()
+        return self.value
+
+    def samples(self):
+        return [(self.name, '', self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+## Bucket bounds, in seconds, for agent program latency: 1us to 10s.
+latency_buckets = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1, 10]
+
+class Histogram (object):
+    """Counts observations into buckets: counts[i] is the number of values
+    that were at most bounds[i] (and more than the bound before)."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, bounds=latency_buckets):
+        self.name, self.help = name, help
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        result, total = [], 0
+        for bound, n in zip(self.bounds + ['+Inf'], self.counts):
+            total += n
+            result.append((self.name + '_bucket', '{le="%s"}' %
+                           if_(bound == '+Inf', bound, lambda: '%g' % bound),
+                           total))
+        return result + [(self.name + '_sum', '', self.sum),
+                         (self.name + '_count', '', self.count)]
+
+    def snapshot(self):
+        return Dict(bounds=self.bounds, counts=self.counts, sum=self.sum,
+                    count=self.count)
+
+class Registry (object):
+    "A set of named metrics, and ways to export them."
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        "Add a metric, or return the one already there with its name."
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help=''):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help='', fn=None):
+        return self.add(Gauge(name, help, fn))
+
+    def histogram(self, name, help='', bounds=latency_buckets):
+        return self.add(Histogram(name, help, bounds))
+
+    def prometheus(self):
+        "All the metrics, in the Prometheus text exposition format."
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for (sample, labels, value) in metric.samples():
+                lines.append('%s%s %s' % (sample, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        "All the metrics, as a dict that json can write."
+        return dict([(name, metric.snapshot())
+                     for (name, metric) in self.metrics.items()])
+
+    def write_prometheus(self, path):
+        """Write the metrics to path, replacing it in one step, as the
+        Prometheus node exporter's textfile collector wants."""
+        write_atomically(path, self.prometheus())
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.snapshot(), sort_keys=True))
+
+def format_value(value):
+    if isinstance(value, float): return repr(value)
+    return str(value)
+
+def write_atomically(path, text):
+    "Write text to a temporary file next to path, then rename it to path."
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    os.write(fd, text)
+    os.close(fd)
+    if os.path.exists(path) and sys.platform == 'win32':
+        os.remove(path)
+    os.rename(temp, path)
+
+#______________________________________________________________________________
+
+class MetricsHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == '/metrics':
+            body, kind = registry.prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, kind = json.dumps(registry.snapshot()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(registry, port=9100, host='localhost'):
+    """Serve the registry at http://host:port/metrics (and /metrics.json)
+    from a background thread.  Return the server; call its shutdown() to
+    stop it."""
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def environment_metrics(registry):
+    """Make the metrics an Environment updates, in registry, and return
+    them as a Struct of steps, percepts, program_latency, bumps and sucks."""
+    for generation in range(3):
+        registry.gauge('python_gc_count_gen%d' % generation,
+                       'gc.get_count() for generation %d.' % generation,
+                       lambda generation=generation: gc.get_count()[generation])
+    return Struct(
+        registry=registry,
+        steps=registry.counter('env_steps_total', 'Environment steps run.'),
+        percepts=registry.counter('env_percepts_total', 'Percepts computed.'),
+        program_latency=registry.histogram(
+            'agent_program_seconds', 'Time taken by agent programs.'),
+        bumps=registry.counter('env_bumps_total', 'Moves into obstacles.'),
+        sucks=registry.counter('env_sucks_total', 'Dirt sucked up.'))
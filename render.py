@@ -0,0 +1,357 @@
+"""Draw environments offscreen, into NumPy arrays, and save them as images.
+
+A Renderer turns the state of an XYEnvironment into an RGB array of
+(height * cellsize, width * cellsize, 3) bytes, with no display needed.
+Cells are drawn with the sprites in images/*.gif, scaled to cellsize, or
+at small cell sizes with one solid colour per kind of object.  All the
+cells of one kind are drawn in a single NumPy assignment, so large boards
+render quickly.
+
+Frames can be written as PPM or PNG files, or collected into an animated
+GIF with GIFWriter; record() runs an environment and saves every k-th
+step.  Nothing here needs PIL: the sprites are read, and GIFs written, by
+the small codec at the end of this file.
+
+>>> env = VacuumEnvironment(5, implicit_walls=True)
+>>> env.add_objects([(Dirt(), (2, 3))])
+>>> frame = Renderer(env, cellsize=2).render()
+>>> frame.shape, tuple(frame[0, 0]) == tuple(frame[9, 9]), frame[6, 4].any()
+((10, 10, 3), True, True)
+"""
+from agents import *
+import struct, zlib
+
+require_numpy('render')
+
+image_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'images')
+
+## The sprite and solid colour for each kind of object, in drawing order;
+## an object is drawn as the first class it is an instance of.
+sprites = [(Obstacle, 'wall.gif', (128, 128, 128)),
+           (Dirt, 'dirt.gif', (120, 80, 40)),
+           (Agent, 'vacuum.gif', (200, 0, 0))]
+
+#______________________________________________________________________________
+
+class Renderer (object):
+    """Draws env, cellsize pixels per cell, on a background colour.  Cell
+    sizes below solid_below pixels use solid colours instead of sprites."""
+
+    def __init__(self, env, cellsize=8, background=(255, 255, 255),
+                 solid_below=8):
+        self.env = env
+        self.cellsize = cellsize
+        self.background = numpy.array(background, dtype=numpy.uint8)
+        self.solid = cellsize < solid_below
+        self.tiles = {} ## sprite name -> (tile, mask)
+        self.kinds = {} ## class -> sprite name
+        self.palette = numpy.array([background] + [colour for (oclass, name,
+                                                   colour) in sprites],
+                                   dtype=numpy.uint8)
+        self.border = None ## Cells of the implicit walls, when needed
+
+    def tile(self, name, colour):
+        "The (tile, mask) pair for a sprite, at the size of a cell."
+        if name not in self.tiles:
+            if self.solid:
+                pixels = numpy.empty((self.cellsize, self.cellsize, 3),
+                                     dtype=numpy.uint8)
+                pixels[:] = colour
+                mask = numpy.ones(pixels.shape[:2], dtype=bool)
+            else:
+                pixels, mask = read_gif(os.path.join(image_directory, name))
+                rows = numpy.arange(self.cellsize) * pixels.shape[0]
+                cols = numpy.arange(self.cellsize) * pixels.shape[1]
+                rows //= self.cellsize; cols //= self.cellsize
+                pixels, mask = pixels[rows][:, cols], mask[rows][:, cols]
+            self.tiles[name] = (pixels, mask[:, :, numpy.newaxis])
+        return self.tiles[name]
+
+    def kind(self, obj):
+        "The sprite name for an object, or None if it is not drawn."
+        cls = obj.__class__
+        if cls not in self.kinds:
+            self.kinds[cls] = None
+            for (oclass, name, colour) in sprites:
+                if isinstance(obj, oclass):
+                    self.kinds[cls] = name
+                    break
+        return self.kinds[cls]
+
+    def layers(self):
+        """A dict of sprite name -> list of the cells to draw it in, each
+        either a width x height array of booleans or a pair of arrays (xs,
+        ys).  Obstacles and dirt come from the arrays the environment keeps
+        (obstacles() and dirt_grid()), so only the agents, and the objects
+        of an environment without those arrays, are visited one by one."""
+        env = self.env
+        layers = dict([(name, []) for (oclass, name, colour) in sprites])
+        covered = []
+        for (oclass, method) in [(Obstacle, 'obstacles'), (Dirt, 'dirt_grid')]:
+            if hasattr(env, method):
+                name = self.kind(oclass())
+                if name: layers[name].append(getattr(env, method)() > 0)
+                covered.append(oclass)
+        objects = []
+        if [c for (c, name, colour) in sprites
+            if c not in covered and not issubclass(c, Agent)]:
+            objects = [obj for obj in env.objects
+                       if not isinstance(obj, tuple(covered))]
+        cells = {}
+        for obj in objects + env.agents:
+            name = self.kind(obj)
+            if name:
+                xs, ys = cells.setdefault(name, ([], []))
+                xs.append(obj.location[0]); ys.append(obj.location[1])
+        for (name, (xs, ys)) in cells.items():
+            layers[name].append((numpy.array(xs, int), numpy.array(ys, int)))
+        for population in getattr(env, 'populations', []):
+            if len(population) == 0: continue
+            name = self.kind(population.view(0))
+            if name: layers[name].append((population.positions[:, 0],
+                                          population.positions[:, 1]))
+        if getattr(env, 'implicit_walls', False):
+            if self.border is None:
+                self.border = numpy.ones((env.width, env.height), bool)
+                self.border[1:-1, 1:-1] = False
+            layers[self.kind(Wall())].append(self.border)
+        return layers
+
+    def cells_of(self, piece):
+        "The xs, ys of the cells of a piece of a layer, inside the board."
+        if isinstance(piece, numpy.ndarray): return piece.nonzero()
+        xs, ys = piece
+        inside = ((xs >= 0) & (xs < self.env.width) &
+                  (ys >= 0) & (ys < self.env.height))
+        return xs[inside], ys[inside]
+
+    def render(self, frame=None):
+        """Draw the environment, into frame if given (it must have the right
+        shape), and return the frame.  With solid colours, the kind drawn
+        in each cell is worked out first, in a grid of one byte per cell,
+        and the cells are then coloured all at once from a palette."""
+        env, cs = self.env, self.cellsize
+        if frame is None:
+            frame = numpy.empty((env.height * cs, env.width * cs, 3),
+                                dtype=numpy.uint8)
+        cells = frame.reshape(env.height, cs, env.width, cs, 3)
+        layers = self.layers()
+        if self.solid:
+            kinds = numpy.zeros((env.height, env.width), numpy.uint8)
+            for (i, (oclass, name, colour)) in enumerate(sprites):
+                for piece in layers[name]:
+                    if isinstance(piece, numpy.ndarray):
+                        numpy.copyto(kinds, i + 1, where=piece.T)
+                    else:
+                        xs, ys = self.cells_of(piece)
+                        kinds[ys, xs] = i + 1
+            if cs == 1:
+                self.palette.take(kinds, axis=0, out=frame)
+            else:
+                cells[:] = self.palette.take(kinds, axis=0)[
+                    :, numpy.newaxis, :, numpy.newaxis]
+            return frame
+        frame[:] = self.background
+        for (oclass, name, colour) in sprites:
+            tile, mask = self.tile(name, colour)
+            for piece in layers[name]:
+                xs, ys = self.cells_of(piece)
+                if mask.all():
+                    cells[ys, :, xs] = tile
+                else:
+                    cells[ys, :, xs] = numpy.where(mask, tile,
+                                                   cells[ys, :, xs])
+        return frame
+
+#______________________________________________________________________________
+# Writing frames
+
+def write_ppm(path, frame):
+    "Write an RGB frame as a binary PPM file."
+    f = open(path, 'wb')
+    f.write('P6\n%d %d\n255\n' % (frame.shape[1], frame.shape[0]))
+    f.write(numpy.ascontiguousarray(frame, dtype=numpy.uint8).tostring())
+    f.close()
+
+def png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+def write_png(path, frame, level=1):
+    "Write an RGB frame as a PNG file."
+    height, width = frame.shape[:2]
+    rows = numpy.zeros((height, width * 3 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = frame.reshape(height, width * 3) ## Filter byte 0: none
+    f = open(path, 'wb')
+    f.write('\x89PNG\r\n\x1a\n')
+    f.write(png_chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                          8, 2, 0, 0, 0)))
+    f.write(png_chunk('IDAT', zlib.compress(rows.tostring(), level)))
+    f.write(png_chunk('IEND', ''))
+    f.close()
+
+class GIFWriter (object):
+    """Collects frames, all the same size, into an animated GIF, delay
+    hundredths of a second apart.  Colours are rounded to the 216 colours
+    of the 6x6x6 web palette, and the picture data is stored without
+    compression, which is fast to write, if not small."""
+
+    def __init__(self, path, delay=10):
+        self.file = open(path, 'wb')
+        self.delay = delay
+        self.size = None
+
+    def add(self, frame):
+        height, width = frame.shape[:2]
+        if self.size is None:
+            self.size = (width, height)
+            levels = numpy.arange(6) * 51
+            palette = numpy.zeros((256, 3), dtype=numpy.uint8)
+            palette[:216] = numpy.array([(r, g, b) for r in levels
+                                         for g in levels for b in levels])
+            self.file.write('GIF89a' + struct.pack('<HHBBB', width, height,
+                                                   0xf7, 0, 0))
+            self.file.write(palette.tostring())
+            ## Loop forever
+            self.file.write('!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+        elif self.size != (width, height):
+            raise ValueError('GIF frames must all be %dx%d' % self.size)
+        levels = (frame.astype(numpy.uint16) + 25) // 51
+        indices = (levels[:, :, 0] * 36 + levels[:, :, 1] * 6 +
+                   levels[:, :, 2]).ravel()
+        self.file.write('!\xf9\x04' +
+                        struct.pack('<BHBB', 0, self.delay, 0, 0))
+        self.file.write(',' + struct.pack('<HHHHB', 0, 0, width, height, 0))
+        self.file.write('\x08' + gif_blocks(gif_literal_codes(indices)))
+
+    def close(self):
+        self.file.write(';')
+        self.file.close()
+
+def record(env, steps, path, every=1, cellsize=8, delay=10):
+    """Run env for steps, saving a frame before the first step and after
+    every k-th one.  If path ends in .gif, the frames make an animated GIF;
+    otherwise path is a pattern such as 'run/%05d.png' (or .ppm) that the
+    step number is put into.  Return the number of frames saved."""
+    renderer = Renderer(env, cellsize)
+    frame = None
+    if path.endswith('.gif'):
+        gif = GIFWriter(path, delay)
+        save = lambda step, frame: gif.add(frame)
+    else:
+        write = if_(path.endswith('.ppm'), write_ppm, write_png)
+        save = lambda step, frame: write(path % step, frame)
+    saved = 0
+    for step in range(steps + 1):
+        if step % every == 0:
+            frame = renderer.render(frame)
+            save(step, frame)
+            saved += 1
+        if step == steps or env.is_done(): break
+        env.step()
+    if path.endswith('.gif'): gif.close()
+    return saved
+
+#______________________________________________________________________________
+# A small GIF codec: enough to read the sprites and write animations.
+
+def read_gif(path):
+    """Read the first image of a GIF file.  Return (pixels, mask): an
+    (h, w, 3) array of bytes and an (h, w) array that is False where the
+    image is transparent."""
+    data = open(path, 'rb').read()
+    width, height, flags = struct.unpack('<HHB', data[6:11])
+    pos = 13
+    palette = None
+    if flags & 0x80:
+        n = 3 << ((flags & 7) + 1)
+        palette, pos = data[pos:pos+n], pos + n
+    transparent = None
+    while data[pos] != ',':
+        if data[pos] == '!':
+            label = data[pos+1]
+            blocks, pos = gif_read_blocks(data, pos + 2)
+            if label == '\xf9' and ord(blocks[0]) & 1:
+                transparent = ord(blocks[3])
+        else:
+            raise ValueError('%s is not a GIF file we can read' % path)
+    left, top, w, h, flags = struct.unpack('<HHHHB', data[pos+1:pos+10])
+    pos += 10
+    if flags & 0x80:
+        n = 3 << ((flags & 7) + 1)
+        palette, pos = data[pos:pos+n], pos + n
+    min_size = ord(data[pos])
+    blocks, pos = gif_read_blocks(data, pos + 1)
+    indices = numpy.fromstring(gif_lzw_decode(blocks, min_size)[:w*h],
+                               dtype=numpy.uint8).reshape(h, w)
+    if flags & 0x40: ## Interlaced: rows come in four passes
+        order = (range(0, h, 8) + range(4, h, 8) + range(2, h, 4) +
+                 range(1, h, 2))
+        rows = numpy.empty_like(indices)
+        rows[order] = indices
+        indices = rows
+    colours = numpy.fromstring(palette, dtype=numpy.uint8).reshape(-1, 3)
+    pixels = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+    mask = numpy.zeros((height, width), dtype=bool)
+    pixels[top:top+h, left:left+w] = colours[indices]
+    mask[top:top+h, left:left+w] = indices != transparent
+    return pixels, mask
+
+def gif_read_blocks(data, pos):
+    "Join the data sub-blocks starting at pos; return them and the next pos."
+    blocks = []
+    while data[pos] != '\x00':
+        n = ord(data[pos])
+        blocks.append(data[pos+1:pos+1+n])
+        pos += n + 1
+    return ''.join(blocks), pos + 1
+
+def gif_lzw_decode(data, min_size):
+    "Decode GIF LZW data into a string of colour indices."
+    clear, end = 1 << min_size, (1 << min_size) + 1
+    table = [chr(i) for i in range(clear)] + ['', '']
+    size, buf, nbits, prev, out = min_size + 1, 0, 0, None, []
+    for c in data:
+        buf |= ord(c) << nbits
+        nbits += 8
+        while nbits >= size:
+            code = buf & ((1 << size) - 1)
+            buf >>= size
+            nbits -= size
+            if code == clear:
+                del table[clear + 2:]
+                size, prev = min_size + 1, None
+                continue
+            if code == end:
+                return ''.join(out)
+            if code < len(table):
+                entry = table[code]
+                if prev is not None: table.append(prev + entry[0])
+            else:
+                entry = prev + prev[0]
+                table.append(entry)
+            out.append(entry)
+            prev = entry
+            if len(table) == 1 << size and size < 12:
+                size += 1
+    return ''.join(out)
+
+def gif_literal_codes(indices):
+    """LZW codes for 8-bit indices that use no string table: a clear code
+    before every 254 literals keeps the code size at 9 bits."""
+    n = len(indices)
+    groups = (n + 253) // 254
+    codes = numpy.zeros((groups, 255), dtype=numpy.uint16)
+    codes[:, 0] = 256
+    codes[:, 1:].flat[:n] = indices
+    return numpy.append(codes.ravel()[:groups + n], 257)
+
+def gif_blocks(codes):
+    "Pack 9-bit codes, least significant bit first, into GIF sub-blocks."
+    bits = ((codes[:, numpy.newaxis] >> numpy.arange(9)) & 1).astype(
+        numpy.uint8).ravel()
+    bits = numpy.append(bits, numpy.zeros(-len(bits) % 8, dtype=numpy.uint8))
+    data = numpy.packbits(bits.reshape(-1, 8)[:, ::-1]).tostring()
+    return ''.join([chr(len(data[i:i+255])) + data[i:i+255]
+                    for i in range(0, len(data), 255)]) + '\x00'
@@ -0,0 +1,193 @@
+"""Run an environment by events, so that only the agents due to act do.
+
+Environment.run calls every agent program on every step.  An
+EventScheduler instead keeps a heap of the times (in steps) at which
+things are due to happen: each agent acts every so many steps (its
+period), and may put itself to sleep by doing ('Sleep', n), or be
+put to sleep and woken up; populations and other events (any function
+of the environment) happen at given times or every so many steps.
+The scheduler goes from one due time to the next, skipping the steps in
+between, so a world where little happens runs in time proportional to
+what happens.  Agents found dead when due are dropped.  At each time,
+the due agents act as in Environment.step (their actions are worked
+out, then executed together), then the populations and other events
+happen, in the order scheduled.  With every period 1, that is exactly
+what run does.
+
+>>> def world():
+...     env = VacuumEnvironment(8, implicit_walls=True)
+...     env.regenerate_dirt(0.1, seed=2)
+...     for i in range(4):
+...         env.add_object(RandomVacuumAgent(seed=i), (i + 1, i + 1))
+...     return env
+>>> stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+>>> ticks, events = world(), world()
+>>> ticks.run(30)
+>>> EventScheduler(events).run(30)
+>>> sys.stdout = stdout
+>>> ([a.performance for a in ticks.agents] ==
+...  [a.performance for a in events.agents])
+True
+>>> (ticks.dirt_grid() == events.dirt_grid()).all(), events.clock
+(True, 30)
+
+Here one agent acts every 100 steps, and another one sleeps for 500
+steps once it has made 3 steps; only 14 of the 1000 steps are run:
+
+>>> class Counter(Environment):
+...     def percept(self, agent): return agent.performance
+...     def execute_action(self, agent, action): agent.performance += 1
+>>> env = Counter()
+>>> lazy, sleepy = Agent(), Agent()
+>>> lazy.program = lambda percept: 'Up'
+>>> sleepy.program = lambda percept: if_(percept < 3, 'Up', ('Sleep', 500))
+>>> for agent in [lazy, sleepy]:
+...     agent.performance = 0
+...     env.agents.append(agent)
+>>> scheduler = EventScheduler(env, exogenous_every=None)
+>>> scheduler.set_period(lazy, 100)
+>>> scheduler.run(1000)
+>>> lazy.performance, sleepy.performance, scheduler.times_run, scheduler.now
+(10, 3, 14, 1000)
+
+An agent removed stays removed, even if an event wakes it later on, and
+the run stops once no agent is alive:
+
+>>> scheduler.remove_agent(lazy)
+>>> scheduler.at(1100, lambda env: scheduler.wake(lazy))
+>>> scheduler.run(200)
+>>> lazy.performance, sleepy.performance, scheduler.now
+(10, 3, 1200)
+>>> def kill(env):
+...     for agent in env.agents: agent.alive = False
+>>> scheduler.at(1250, kill)
+>>> scheduler.run(1000)
+>>> sleepy.performance, scheduler.now
+(3, 1251)
+"""
+from agents import *
+import heapq, itertools
+
+#______________________________________________________________________________
+
+class EventScheduler (object):
+    """Runs env by events.  The agents in env when it is made act every
+    step to begin with, and if exogenous_every is given, so does
+    env.exogenous_change, every exogenous_every steps; pass None when the
+    world has no spontaneous change, or the period of it, so that idle
+    steps can be skipped.  Populations in env are stepped every step.
+    .now is the time (the step number) next to run, and .times_run the
+    number of times at which something happened."""
+
+    def __init__(self, env, exogenous_every=1):
+        self.env = env
+        self.heap, self.counter = [], itertools.count()
+        self.periods = {}  ## Agent -> its period, in steps
+        self.tokens = {}   ## Agent -> the number of its live heap entry
+        self.running = False
+        self.times_run = 0
+        self.set_time(env.trace.now)
+        for agent in env.agents:
+            self.add_agent(agent)
+        for population in env.populations:
+            self.add_population(population)
+        if exogenous_every:
+            self.every(exogenous_every, lambda env: env.exogenous_change(),
+                       self.now + exogenous_every - 1)
+
+    def set_time(self, time):
+        self.now = self.env.trace.now = time
+        if hasattr(self.env, 'clock'): self.env.clock = time
+
+    def push(self, time, kind, item, token=None):
+        ## Nothing may be scheduled for the time being run
+        time = max(time, self.now + self.running)
+        heapq.heappush(self.heap, (time, self.counter.next(), kind, item,
+                                   token))
+
+    def add_agent(self, agent, period=1, start=None):
+        """Have agent (already in env) act every period steps, from start
+        (now, by default)."""
+        self.periods[agent] = period
+        self.wake(agent, start)
+
+    def set_period(self, agent, period):
+        "Have agent act every period steps, from its next action on."
+        self.periods[agent] = period
+
+    def remove_agent(self, agent):
+        "Stop agent acting (as when it is deleted from env)."
+        self.tokens[agent] = self.tokens.get(agent, 0) + 1
+        self.periods.pop(agent, None)
+
+    def sleep(self, agent, steps=None):
+        "Stop agent acting for steps steps, or until woken if steps is None."
+        if agent not in self.periods: return ## Removed
+        self.tokens[agent] = self.tokens.get(agent, 0) + 1
+        if steps is not None:
+            self.push(self.now + steps, 'agent', agent, self.tokens[agent])
+
+    def wake(self, agent, time=None):
+        """Have agent act next at time (now, by default) instead.  An agent
+        that was removed stays removed."""
+        if agent not in self.periods: return
+        if time is None: time = self.now
+        self.tokens[agent] = self.tokens.get(agent, 0) + 1
+        self.push(time, 'agent', agent, self.tokens[agent])
+
+    def at(self, time, fn):
+        "Call fn(env) at time."
+        self.push(time, 'event', (fn, None))
+
+    def every(self, period, fn, start=None):
+        """Call fn(env) every period steps, from start (now, by default),
+        until it returns False."""
+        if start is None: start = self.now
+        self.push(start, 'event', (fn, period))
+
+    def add_population(self, population, period=1, start=None):
+        "Step population every period steps, while any of it is alive."
+        def step(env):
+            if not population.alive.any(): return False
+            population.step(env)
+        self.every(period, step, start)
+
+    def run(self, steps=1000):
+        """Run everything due in the next steps steps, or until env is done,
+        as Environment.run does."""
+        end = self.now + steps
+        heap, env = self.heap, self.env
+        while heap and heap[0][0] < end:
+            if env.is_done(): return
+            self.run_time(heap[0][0])
+        if not env.is_done(): self.set_time(max(self.now, end))
+
+    def run_time(self, time):
+        "Run everything due at time: the agents act, then the events happen."
+        env, heap, tokens = self.env, self.heap, self.tokens
+        self.set_time(time)
+        self.running = True
+        agents, events = [], []
+        while heap and heap[0][0] == time:
+            (time, n, kind, item, token) = heapq.heappop(heap)
+            if kind == 'event':
+                events.append(item)
+            elif tokens.get(item) == token and item.is_alive():
+                agents.append(item)
+        actors, actions = [], []
+        for (agent, action) in zip(agents, env.agent_actions(agents)):
+            if isinstance(action, tuple) and action[0] == 'Sleep':
+                self.push(time + action[1], 'agent', agent, tokens[agent])
+            else:
+                self.push(time + self.periods[agent], 'agent', agent,
+                          tokens[agent])
+                actors.append(agent)
+                actions.append(action)
+        env.execute_actions(actors, actions)
+        for (fn, period) in events:
+            if fn(env) is not False and period:
+                self.push(time + period, 'event', (fn, period))
+        self.running = False
+        self.times_run += 1
+        if env.metrics is not None: env.metrics.steps.inc()
+        self.set_time(time + 1)
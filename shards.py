@@ -0,0 +1,267 @@
+"""Step a giant vacuum world in parallel, one strip of it per process.
+
+A ShardedWorld copies a VacuumEnvironment, and one AgentPopulation in it,
+into layers of shared memory: the dirt and obstacles in each cell, and the
+population's arrays.  The board is cut into vertical strips, one for each
+worker process, and each step every worker steps the agents that stand
+in its strip.  Agents perceive and suck only in their own cell, so a
+worker only writes the dirt in its strip and the entries of its agents;
+moves read the obstacle layer, which does not change, across the border.
+The owner of each agent is kept in two arrays, read one step and written
+the next, so an agent that walks over a border is handed to the worker
+next door for the following step; that is the only exchange between
+strips.  New dirt (see regenerate_dirt) is drawn between steps by the
+parent, with the environment's own generator.  Programs draw with
+population.draw, which does not depend on how the agents are split up, so
+the results are exactly those of stepping the environment itself.
+
+>>> def world():
+...     env = VacuumEnvironment(30, implicit_walls=True)
+...     env.regenerate_dirt(0.05, seed=3)
+...     env.add_population(AgentPopulation(reflex_population_program,
+...         ['Suck', 'Left', 'Right', 'Up', 'Down'],
+...         [(x, y) for x in range(1, 29, 3) for y in range(1, 29, 2)], 5))
+...     return env
+>>> serial = world()
+>>> serial.run(40)
+>>> env = world()
+>>> sharded = ShardedWorld(env, env.populations[0], workers=3)
+>>> sharded.run(40)
+>>> sharded.write_back()
+>>> population = env.populations[0]
+>>> (population.positions == serial.populations[0].positions).all()
+True
+>>> (population.performance == serial.populations[0].performance).all()
+True
+>>> (env.dirt_grid() == serial.dirt_grid()).all()
+True
+>>> sharded.close()
+
+A program that fails in a worker, or a worker that dies, is raised in the
+parent as a WorkerError, as in agenthost.py:
+
+>>> def failing(percepts, population):
+...     if population.steps == 1: return 1 / 0
+...     os._exit(3)
+>>> for steps in [0, 1]: # doctest: +ELLIPSIS
+...     env = world()
+...     env.populations[0].program = failing
+...     env.populations[0].steps = steps
+...     sharded = ShardedWorld(env, env.populations[0], workers=2)
+...     try:
+...         sharded.run(2)
+...     except WorkerError, e:
+...         print str(e).splitlines()[-1]
+...     sharded.close()
+worker process ... died (exit code 3)
+ZeroDivisionError: integer division or modulo by zero
+"""
+from agents import *
+from agenthost import WorkerError, report_errors, wait_for_workers
+import multiprocessing, multiprocessing.queues
+
+#______________________________________________________________________________
+
+def shared_array(typecode, values):
+    """A RawArray holding a copy of values, an array of any shape, and a
+    NumPy view of it with that shape."""
+    values = numpy.asarray(values)
+    raw = multiprocessing.RawArray(typecode, values.size)
+    view = numpy.frombuffer(raw, dtype=typecode).reshape(values.shape)
+    view[:] = values
+    return raw, view
+
+def view_of(raw, typecode, shape):
+    return numpy.frombuffer(raw, dtype=typecode).reshape(shape)
+
+class PopulationShard (object):
+    """The agents of a population that one worker steps this time: what a
+    population program may look at."""
+
+    def __init__(self, actions, seed, steps, ids):
+        self.actions, self.seed, self.steps, self.ids = actions, seed, steps, ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def draw(self, low, high):
+        return hashed_ints(self.seed, self.steps, self.ids, low, high)
+
+class Strip (object):
+    """The columns first..last-1 of a sharded world, as seen by the worker
+    that owns them; step() steps the agents in them.  The layers are NumPy
+    views of the shared arrays."""
+
+    def __init__(self, number, bounds, spec, layers):
+        self.number, self.bounds = number, bounds
+        self.__dict__.update(spec)
+        self.__dict__.update(layers)
+        self.numbers = dict([(a, i) for (i, a) in enumerate(self.actions)])
+
+    def owners(self, positions):
+        "The number of the strip that owns each of positions."
+        x = numpy.clip(positions[:, 0], 0, self.width - 1)
+        return numpy.searchsorted(self.bounds[1:], x, side='right')
+
+    def step(self, steps):
+        numbers, width, height = self.numbers, self.width, self.height
+        mine = numpy.nonzero(self.owner[steps % 2] == self.number)[0]
+        positions = self.positions[mine]
+        x, y = positions[:, 0], positions[:, 1]
+        inside = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+        cell = numpy.where(inside, x * height + y, 0)
+        dirt = self.dirt.ravel()
+        status = inside & (dirt[cell] > 0)
+        percepts = {'status': status, 'location': positions.copy(),
+                    'bump': self.bump[mine].astype(bool)}
+        shard = PopulationShard(self.actions, self.seed, steps, mine)
+        codes = numpy.asarray(self.program(percepts, shard), dtype=int)
+        codes = numpy.where(self.alive[mine].astype(bool), codes, -1)
+        ## Moves, as XYEnvironment.move_targets
+        deltas = numpy.zeros((len(mine), 2), int)
+        moving = numpy.zeros(len(mine), bool)
+        for (action, delta) in XYEnvironment.move_deltas.items():
+            if action in numbers:
+                chosen = codes == numbers[action]
+                deltas[chosen] = delta
+                moving |= chosen
+        target = positions + deltas
+        tx, ty = target[:, 0], target[:, 1]
+        if self.implicit_walls:
+            bumped = ~((0 < tx) & (tx < width - 1) &
+                       (0 < ty) & (ty < height - 1))
+        else:
+            bumped = numpy.zeros(len(mine), bool)
+        tinside = (0 <= tx) & (tx < width) & (0 <= ty) & (ty < height)
+        bumped[tinside] |= self.obstacles[tx[tinside], ty[tinside]] != 0
+        bumped &= moving
+        moved = moving & ~bumped
+        self.bump[mine] = bumped
+        positions[moved] = target[moved]
+        self.positions[mine] = positions
+        ## Sucks: of the agents sucking in one cell, the first ones get the
+        ## dirt there, one each, as VacuumEnvironment.execute_population
+        if 'Suck' in numbers:
+            suckers = numpy.nonzero((codes == numbers['Suck']) & status)[0]
+            order = suckers[numpy.lexsort((suckers, cell[suckers]))]
+            cells = cell[order]
+            first = numpy.ones(len(order), bool)
+            first[1:] = cells[1:] != cells[:-1]
+            starts = numpy.maximum.accumulate(
+                numpy.where(first, numpy.arange(len(order)), 0))
+            takes = numpy.arange(len(order)) - starts < dirt[cells]
+            self.performance[mine[order[takes]]] += 100
+            numpy.subtract.at(dirt, cells[takes], 1)
+        charged = codes >= 0
+        if 'Nop' in numbers: charged &= codes != numbers['Nop']
+        self.performance[mine[charged]] -= 1
+        ## Hand agents that left the strip to their new owners
+        self.owner[(steps + 1) % 2][mine] = self.owners(positions)
+
+def run_strip(number, bounds, spec, raws, go, done, stopping, steps,
+              errors):
+    """The loop of a worker: step the strip each time go is released.  A
+    step that raises is reported on errors."""
+    layers = dict([(name, view_of(raw, typecode, shape))
+                   for (name, (raw, typecode, shape)) in raws.items()])
+    strip = Strip(number, bounds, spec, layers)
+    while True:
+        go.acquire()
+        if stopping.value: break
+        report_errors(lambda: strip.step(steps.value), errors)
+        done.release()
+
+class ShardedWorld (object):
+    """Step env, a VacuumEnvironment, and population, an AgentPopulation in
+    it, on workers processes, each owning a strip of the board.  Nothing
+    else in env may act: it should have no other agents or populations.
+    Call write_back() to copy the results into env and population, and
+    close() when done, to stop the workers."""
+
+    def __init__(self, env, population, workers=2):
+        require_numpy('ShardedWorld')
+        self.env, self.population = env, population
+        spec = dict(program=population.program, actions=population.actions,
+                    seed=population.seed, width=env.width, height=env.height,
+                    implicit_walls=env.implicit_walls)
+        bounds = numpy.linspace(0, env.width, workers + 1).astype(int)
+        self.layers, raws = {}, {}
+        for (name, typecode, values) in [
+            ('dirt', 'l', env.dirt_grid()),
+            ('obstacles', 'b', env.obstacles()),
+            ('positions', 'l', population.positions),
+            ('performance', 'l', population.performance),
+            ('bump', 'b', population.bump),
+            ('alive', 'b', population.alive),
+            ('owner', 'l', numpy.zeros((2, len(population)), int))]:
+            raw, self.layers[name] = shared_array(typecode, values)
+            raws[name] = (raw, typecode, numpy.shape(values))
+        strip = Strip(-1, bounds, spec, self.layers)
+        self.layers['owner'][population.steps % 2] = strip.owners(
+            self.layers['positions'])
+        self.steps = multiprocessing.RawValue('l', population.steps)
+        self.stopping = multiprocessing.RawValue('b', 0)
+        self.done = multiprocessing.Semaphore(0)
+        self.errors = multiprocessing.queues.SimpleQueue()
+        self.workers = []
+        for number in range(workers):
+            go = multiprocessing.Semaphore(0)
+            process = multiprocessing.Process(
+                target=run_strip,
+                args=(number, bounds, spec, raws, go, self.done,
+                      self.stopping, self.steps, self.errors))
+            process.daemon = True
+            process.start()
+            self.workers.append((process, go))
+
+    def step(self):
+        """Step all the strips at once, then make the exogenous change.  If
+        a strip failed, or its worker died, stop the workers and raise
+        WorkerError."""
+        if not self.workers: raise WorkerError('the ShardedWorld is closed')
+        for (process, go) in self.workers:
+            go.release()
+        try:
+            wait_for_workers(self.done, [p for (p, go) in self.workers],
+                             self.errors)
+        except WorkerError:
+            for (process, go) in self.workers:
+                process.terminate()
+                process.join()
+            self.workers = []
+            raise
+        self.steps.value += 1
+        env = self.env
+        env.clock += 1
+        if env.dirt_rate is not None and env.clock % env.dirt_every == 0:
+            obstacles, dirt = self.layers['obstacles'], self.layers['dirt']
+            for (x, y) in env.dirt_cells():
+                if not obstacles[x, y]: dirt[x, y] += 1
+
+    def run(self, steps=1000):
+        for step in range(steps):
+            self.step()
+
+    def write_back(self):
+        """Copy the state of the shared layers into the population and the
+        Dirt objects of the environment."""
+        env, population, layers = self.env, self.population, self.layers
+        population.positions[:] = layers['positions']
+        population.performance[:] = layers['performance']
+        population.bump[:] = layers['bump']
+        population.steps = self.steps.value
+        for obj in [o for o in env.objects if isinstance(o, Dirt)]:
+            env.delete_object(obj)
+        xs, ys = layers['dirt'].nonzero()
+        env.add_objects([(Dirt(), (x, y))
+                         for (x, y) in zip(xs.tolist(), ys.tolist())
+                         for i in range(layers['dirt'][x, y])])
+
+    def close(self):
+        "Stop the worker processes."
+        self.stopping.value = 1
+        for (process, go) in self.workers:
+            go.release()
+        for (process, go) in self.workers:
+            process.join()
+        self.workers = []
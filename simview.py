@@ -0,0 +1,318 @@
+"""Run a simulation in a process of its own, and watch it from the GUI.
+
+A Simulation moves an environment into a worker process, which steps it
+and, after each step, publishes a snapshot of it into shared memory: the
+kind of object drawn in each cell (its place in object_looks, plus one)
+and the cells of the agents.  There are two snapshot buffers; the worker
+fills the one readers are not using and then makes it the latest, and a
+sequence number on each buffer lets a reader notice a buffer that was
+rewritten under it and read again.  The GUI sends commands over a queue:
+step, run, stop, speed and add.  A SnapshotView stands in for the
+environment in an EnvCanvas, answering its questions from the latest
+snapshot and turning its changes into commands, and a ViewerToolbar
+polls for new snapshots, so the Tk main loop never waits on a step.
+"python simview.py 200" watches a 200 x 200 vacuum world this way.
+
+>>> env = VacuumEnvironment(8, implicit_walls=True)
+>>> env.add_objects([(Dirt(), (2, 2)), (Dirt(), (3, 3))])
+>>> simulation = Simulation(env, quiet=True)
+>>> view = SnapshotView(simulation)
+>>> view.list_objects_at((2, 2)), view.list_objects_at((0, 4))
+([<Dirt>], [<Obstacle>])
+>>> view.add_object('ModelBasedVacuumAgent', (2, 2))
+>>> view.step()
+>>> view.wait(1)
+True
+>>> view.list_objects_at((2, 2)), [a.location for a in view.list_agents()]
+([], [(2, 2)])
+>>> simulation.close()
+"""
+from agents import *
+import multiprocessing, Queue
+
+#______________________________________________________________________________
+
+def cell_kinds(env):
+    """A width x height array of the kind of object to draw in each cell:
+    one plus the index in object_looks, or 0 for nothing.  Agents are left
+    out.  Where there are several, the later kind in object_looks wins."""
+    kinds = numpy.zeros((env.width, env.height), 'b')
+    def mark(cells, oclass):
+        kinds[cells] = numpy.maximum(kinds[cells], object_look(oclass()) + 1)
+    if hasattr(env, 'dirt_grid'):
+        mark(env.obstacles(), Obstacle)
+        mark(env.dirt_grid() > 0, Dirt)
+    else:
+        for obj in env.objects:
+            look = object_look(obj)
+            (x, y) = obj.location
+            if (look is not None and not isinstance(obj, Agent) and
+                0 <= x < env.width and 0 <= y < env.height):
+                kinds[x, y] = max(kinds[x, y], look + 1)
+    if getattr(env, 'implicit_walls', False):
+        border = numpy.ones((env.width, env.height), bool)
+        border[1:-1, 1:-1] = False
+        mark(border, Wall)
+    return kinds
+
+def agent_cells(env):
+    "An n x 2 array of the cells of all the agents, populations included."
+    cells = [numpy.array([agent.location for agent in env.agents],
+                         dtype=int).reshape(-1, 2)]
+    for population in getattr(env, 'populations', []):
+        cells.append(population.positions)
+    return numpy.concatenate(cells)
+
+class Snapshot (object):
+    """Two buffers in shared memory, each holding the cell kinds, the
+    agents' cells (at most max_agents of them) and the step number of one
+    moment of a width x height environment."""
+
+    def __init__(self, width, height, max_agents=10000):
+        self.width, self.height, self.max_agents = width, height, max_agents
+        self.cells = [self.shared('b', (width, height)) for b in (0, 1)]
+        self.agents = [self.shared('l', (max_agents, 2)) for b in (0, 1)]
+        self.counts = self.shared('l', 2)
+        self.steps = self.shared('l', 2)
+        self.seq = self.shared('l', 2)   ## Odd while a buffer is written
+        self.latest = multiprocessing.RawValue('l', 0)
+
+    def shared(self, typecode, shape):
+        raw = multiprocessing.RawArray(typecode, int(numpy.prod(shape)))
+        return numpy.frombuffer(raw, dtype=typecode).reshape(shape)
+
+    def publish(self, env, steps):
+        "Write env into the buffer readers are not using; make it the latest."
+        b = 1 - self.latest.value
+        self.seq[b] += 1
+        self.cells[b][:] = cell_kinds(env)
+        cells = agent_cells(env)[:self.max_agents]
+        self.agents[b][:len(cells)] = cells
+        self.counts[b] = len(cells)
+        self.steps[b] = steps
+        self.seq[b] += 1
+        self.latest.value = b
+
+    def read(self):
+        """Copies of the latest (version, step number, cell kinds, agent
+        cells); the version changes with every publish.  Nothing here waits
+        for the writer: a read it tore is just done again."""
+        while True:
+            b = self.latest.value
+            seq = self.seq[b]
+            if seq % 2: continue
+            n = self.counts[b]
+            result = ((b, int(seq)), int(self.steps[b]), self.cells[b].copy(),
+                      self.agents[b][:n].copy())
+            if self.seq[b] == seq: return result
+
+def simulate(env, snapshot, commands, quiet):
+    """The loop of the worker process: obey commands, step env while
+    running, and publish a snapshot after every change."""
+    if quiet: sys.stdout = open(os.devnull, 'w')
+    classes = dict([(c.__name__, c) for c in env.object_classes()])
+    running, delay, steps = False, 0.0, 0
+    while True:
+        try:
+            command = commands.get(block=not running)
+        except Queue.Empty:
+            command = None
+        changed = False
+        while command is not None:
+            name, args = command[0], command[1:]
+            if name == 'quit':
+                return
+            elif name == 'step':
+                env.step()
+                steps, changed = steps + 1, True
+            elif name == 'run':
+                running = True
+            elif name == 'stop':
+                running = False
+            elif name == 'speed':
+                delay = if_(args[0] > 0, lambda: 1.0 / args[0], 0.0)
+            elif name == 'add':
+                (cname, location) = args
+                env.add_object(classes[cname](), location)
+                changed = True
+            try:
+                command = commands.get_nowait()
+            except Queue.Empty:
+                command = None
+        if running:
+            if env.is_done():
+                running = False
+            else:
+                env.step()
+                steps, changed = steps + 1, True
+        if changed:
+            snapshot.publish(env, steps)
+        if running and delay:
+            time.sleep(delay)
+
+class Simulation (object):
+    """Step env in a worker process, publishing a Snapshot after each step.
+    Once started, env belongs to the worker: change it only by sending
+    commands (see SnapshotView).  With quiet, the worker's printing is
+    thrown away.  Call close() when done, to stop the worker."""
+
+    def __init__(self, env, max_agents=10000, quiet=False):
+        require_numpy('Simulation')
+        self.width, self.height = env.width, env.height
+        self.classes = [c.__name__ for c in env.object_classes()]
+        self.snapshot = Snapshot(env.width, env.height, max_agents)
+        self.snapshot.publish(env, 0)
+        self.commands = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=simulate, args=(env, self.snapshot, self.commands, quiet))
+        self.process.daemon = True
+        self.process.start()
+
+    def send(self, *command):
+        self.commands.put(command)
+
+    def close(self):
+        "Stop the worker process."
+        self.send('quit')
+        self.process.join()
+
+#______________________________________________________________________________
+
+def remote_class(name):
+    """A stand-in for the object class called name, for the canvas' menu:
+    what it makes is the name, which SnapshotView.add_object sends on."""
+    make = lambda: name
+    make.__name__ = name
+    return make
+
+class SnapshotView (object):
+    """Stands in for the environment of a Simulation, as far as EnvCanvas
+    and EnvToolbar need one.  Questions about what is where are answered
+    from the snapshot last read by refresh(), with new objects of the
+    classes in object_looks standing for what was there; step, run, stop,
+    set_speed and add_object send commands to the worker."""
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.width, self.height = simulation.width, simulation.height
+        self.implicit_walls = False ## Walls are in the snapshot
+        self.observers = []
+        self.version = None
+        self.refresh()
+
+    def refresh(self):
+        "Read the latest snapshot; return true if it is a new one."
+        (version, self.steps, self.cells,
+         self.agent_cells) = self.simulation.snapshot.read()
+        changed, self.version = version != self.version, version
+        return changed
+
+    def wait(self, steps, timeout=10.0):
+        """Refresh until the snapshot is of at least steps steps; return
+        false if that took longer than timeout seconds."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.refresh()
+            if self.steps >= steps: return True
+            time.sleep(0.01)
+        return False
+
+    def mark(self, code, location):
+        obj = object_looks[code - 1][0]()
+        obj.location = location
+        return obj
+
+    def list_objects_at(self, (x, y), oclass=Object):
+        if not (0 <= x < self.width and 0 <= y < self.height): return []
+        code = self.cells[x, y]
+        if not code: return []
+        obj = self.mark(code, (x, y))
+        return [obj for obj in [obj] if isinstance(obj, oclass)]
+
+    def some_objects_at(self, location, oclass=Object):
+        return self.list_objects_at(location, oclass) != []
+
+    def all_objects(self):
+        xs, ys = self.cells.nonzero()
+        return [self.mark(self.cells[x, y], (x, y))
+                for (x, y) in zip(xs.tolist(), ys.tolist())]
+
+    objects = property(all_objects)
+
+    def list_agents(self):
+        agent = object_look(Agent()) + 1
+        return [self.mark(agent, tuple(cell))
+                for cell in self.agent_cells.tolist()]
+
+    agents = property(list_agents)
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def object_classes(self):
+        return [remote_class(name) for name in self.simulation.classes]
+
+    def add_object(self, name, location):
+        self.simulation.send('add', name, location)
+
+    def step(self):
+        self.simulation.send('step')
+
+    def run(self):
+        self.simulation.send('run')
+
+    def stop(self):
+        self.simulation.send('stop')
+
+    def set_speed(self, speed):
+        self.simulation.send('speed', speed)
+
+class ViewerToolbar (EnvToolbar):
+    """An EnvToolbar for a SnapshotView: its buttons send commands, and it
+    redraws the canvas whenever a new snapshot comes in."""
+
+    def __init__(self, parent, view, canvas, poll=50):
+        super(ViewerToolbar, self).__init__(parent, view, canvas)
+        self.poll_ms = poll
+        self.poll()
+
+    def poll(self):
+        if self.env.refresh():
+            self.canvas.repintar()
+        self.after(self.poll_ms, self.poll)
+
+    def step(self):
+        self.env.step()
+
+    def run(self):
+        self.env.set_speed(self.speed)
+        self.env.run()
+
+    def stop(self):
+        self.env.stop()
+
+    def set_speed(self, speed):
+        self.speed = float(speed)
+        self.env.set_speed(self.speed)
+
+def view_simulation(env, cellwidth=50, title='Progra IA'):
+    """Start a Simulation of env and watch it in a window until it is
+    closed."""
+    simulation = Simulation(env)
+    root = tk.Tk()
+    root.title(title)
+    view = SnapshotView(simulation)
+    canvas = EnvCanvas(root, view, cellwidth)
+    toolbar = ViewerToolbar(root, view, canvas)
+    for w in [canvas, toolbar]:
+        w.pack(side="bottom", fill="x", padx="3", pady="3")
+    try:
+        root.mainloop()
+    finally:
+        simulation.close()
+
+if __name__ == '__main__':
+    size = int((sys.argv[1:] or [20])[0])
+    env = VacuumEnvironment(size, implicit_walls=True)
+    env.regenerate_dirt(0.001)
+    view_simulation(env, cellwidth=max(1, 600 // size))
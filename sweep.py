@@ -0,0 +1,167 @@
+"""Run parameter sweeps over agents and environments, and keep the results.
+
+A sweep expands a grid of parameters (a dict of name -> list of values)
+into work units, one per combination, and runs them on a pool of
+processes.  Each result is appended to a CSV file, one row and one column
+per parameter and result, as soon as it comes in; a sweep that is run
+again with the same file skips the units that already have a row, so an
+interrupted sweep picks up where it left off.
+
+>>> import tempfile
+>>> path = tempfile.mktemp('.csv')
+>>> grid = {'size': [6, 8], 'density': [0.25], 'steps': [50], 'seed': [1, 2],
+...         'agent': ['ModelBasedVacuumAgent', 'RandomVacuumAgent']}
+>>> run_sweep(vacuum_unit, grid, path, processes=2)
+8
+>>> run_sweep(vacuum_unit, grid, path, processes=2)
+0
+>>> rows = read_results(path)
+>>> len(rows), sorted(rows[0])
+(8, ['agent', 'density', 'dirt_left', 'score', 'seed', 'size', 'steps'])
+>>> os.remove(path)
+
+Parameters that are floats are matched with the rows they were written
+in exactly, even when they do not print in full:
+
+>>> grid = {'size': [6], 'density': [1 / 3.0], 'steps': [10], 'seed': [1],
+...         'agent': ['RandomVacuumAgent']}
+>>> run_sweep(vacuum_unit, grid, path, processes=1)
+1
+>>> run_sweep(vacuum_unit, grid, path, processes=1), len(read_results(path))
+(0, 1)
+>>> os.remove(path)
+
+A row cut short by an interrupted write is dropped, and its unit run again:
+
+>>> grid['seed'] = [1, 2]
+>>> run_sweep(vacuum_unit, grid, path, processes=1)
+2
+>>> f = open(path, 'r+b'); f.truncate(os.path.getsize(path) - 3); f.close()
+>>> run_sweep(vacuum_unit, grid, path, processes=1)
+1
+>>> sorted([(row['seed'], row['score'] != '') for row in read_results(path)])
+[('1', True), ('2', True)]
+>>> os.remove(path)
+"""
+from agents import *
+import csv, itertools, multiprocessing, os
+
+#______________________________________________________________________________
+
+def expand_grid(grid):
+    """All the combinations of a grid of parameters, as a list of dicts.
+    >>> expand_grid({'b': [1, 2], 'a': ['x']})
+    [{'a': 'x', 'b': 1}, {'a': 'x', 'b': 2}]
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[n] for n in names])]
+
+def cell_text(value):
+    "The text the csv module writes for value: repr for floats, else str."
+    if isinstance(value, float): return repr(value)
+    return str(value)
+
+def unit_key(params, names):
+    """The key of a work unit: its parameter values, as they are in the
+    file.  Rows read back have text values, which are kept as they are.
+    >>> row = {'rate': 1 / 3.0, 'name': 'a'}
+    >>> unit_key(row, ['rate', 'name']) == unit_key(
+    ...     {'rate': repr(1 / 3.0), 'name': 'a'}, ['rate', 'name'])
+    True
+    """
+    return tuple([cell_text(params[n]) for n in names])
+
+def read_results(path):
+    "The rows of a results file, as a list of dicts of strings."
+    if not os.path.exists(path): return []
+    f = open(path, 'rb')
+    try:
+        return list(csv.DictReader(f))
+    finally:
+        f.close()
+
+def drop_partial_row(path):
+    """If the file at path does not end with a newline, its last row was
+    cut short while being written: cut it off."""
+    if not os.path.exists(path): return
+    f = open(path, 'r+b')
+    try:
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(max(0, end - 65536))
+        tail = f.read()
+        if tail and not tail.endswith('\n'):
+            f.truncate(end - len(tail) + tail.rfind('\n') + 1)
+    finally:
+        f.close()
+
+def call_unit((fn, params)):
+    return params, fn(**params)
+
+def quiet_worker():
+    "The environments trace every step to stdout; workers throw that away."
+    sys.stdout = open(os.devnull, 'w')
+
+def run_sweep(fn, grid, path, processes=None):
+    """Run fn(**params) for every combination of parameters in grid that is
+    not yet in the CSV file at path, on a pool of processes, appending one
+    row per result as it comes in.  A last row left unfinished by an
+    earlier run is dropped first.  fn must be a module-level function
+    returning a dict of results.  Return the number of units run."""
+    names = sorted(grid)
+    drop_partial_row(path)
+    done = set([unit_key(row, names) for row in read_results(path)])
+    units = [params for params in expand_grid(grid)
+             if unit_key(params, names) not in done]
+    if not units: return 0
+    new_file = not os.path.exists(path) or not os.path.getsize(path)
+    f = open(path, 'ab')
+    writer = None
+    pool = multiprocessing.Pool(processes, quiet_worker)
+    try:
+        for (params, results) in pool.imap_unordered(
+                call_unit, [(fn, params) for params in units]):
+            if writer is None:
+                columns = names + sorted(results)
+                writer = csv.DictWriter(f, columns)
+                if new_file: writer.writerow(dict(zip(columns, columns)))
+            row = dict(params)
+            row.update(results)
+            writer.writerow(row)
+            f.flush()
+    finally:
+        pool.terminate()
+        f.close()
+    return len(units)
+
+def summarize(path, by, value, numfmt='%.4g'):
+    """Print a table of the mean, standard deviation and count of the value
+    column in the results at path, for each combination of the by columns."""
+    groups = {}
+    for row in read_results(path):
+        groups.setdefault(tuple([row[c] for c in by]), []).append(
+            float(row[value]))
+    table = []
+    for key in sorted(groups):
+        values = groups[key]
+        spread = if_(len(values) > 1, lambda: stddev(values), 0.0)
+        table.append(list(key) + [mean(values), spread, len(values)])
+    print_table(table, by + ['mean ' + value, 'stddev', 'n'], numfmt=numfmt)
+
+#______________________________________________________________________________
+
+def vacuum_unit(agent, size, density, seed, steps):
+    """Run one agent, named by its factory in agents.py, for steps in a
+    size x size VacuumEnvironment with dirt on a fraction density of the
+    cells.  Return its score and the number of dirts left."""
+    random.seed(seed)
+    env = VacuumEnvironment(size)
+    env.add_objects([(Dirt(), (x, y)) for x in range(1, size - 1)
+                     for y in range(1, size - 1) if random.random() < density])
+    AgentFactory = globals()[agent]
+    test = AgentFactory()
+    env.add_object(test, (1, 1))
+    env.run(steps)
+    return {'score': test.performance,
+            'dirt_left': len([o for o in env.objects if isinstance(o, Dirt)])}
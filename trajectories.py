@@ -0,0 +1,343 @@
+"""Record what agents perceive and do, as datasets for learning agents.
+
+A TrajectoryWriter attached to an environment records one transition per
+agent per step: the step, the episode and the agent's place in env.agents,
+the fields of its percept, its action, its reward (the change in its
+performance over the step) and whether it is done (the environment is, or
+the agent is no longer alive).  Transitions are gathered chunk by chunk
+and then written to one file per column, memory-mapped and grown as
+needed, so a run of any length never holds more than a chunk in memory.
+A percept field whose values are tuples of ints (a location) or numbers
+is stored as such; other values, and actions, are stored as numbers into
+a list of the values seen, kept in meta.json with the number of
+transitions written so far.  A TrajectoryReader maps the columns back,
+read-only, and reads transitions one by one, in chunks or at random,
+without loading the files into memory.
+
+>>> import tempfile, shutil
+>>> directory = tempfile.mkdtemp()
+>>> writer = TrajectoryWriter(directory, chunk=4)
+>>> env = writer.attach(VacuumEnvironment(6, implicit_walls=True))
+>>> stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+>>> env.add_objects([(Dirt(), (1, 1)), (Dirt(), (3, 3))])
+>>> env.add_object(RandomAgent(['Suck']))
+>>> env.run(10)
+>>> sys.stdout = stdout
+>>> writer.close()
+>>> reader = TrajectoryReader(directory)
+>>> len(reader), reader.fields
+(10, ['status', 'location', 'bump'])
+>>> t = reader[0]
+>>> t.percept, t.action, t.reward
+(('Dirty', (1, 1), 'None'), 'Suck', 99.0)
+>>> reader[1].percept, reader[1].reward
+(('Clean', (1, 1), 'None'), -1.0)
+>>> reader.column('reward').sum() == env.agents[0].performance
+True
+>>> shutil.rmtree(directory)
+
+A field that starts out as ints and later has floats is stored as floats;
+one whose values change kind in any other way is an error:
+
+>>> class Levels(Environment):
+...     def percept(self, agent): return None
+...     def execute_action(self, agent, action): pass
+...     def percept_level(self, agent):
+...         return if_(self.trace.now < 3, self.trace.now, self.trace.now / 2.)
+...     def percept_place(self, agent):
+...         return if_(self.trace.now < 3, (1, 1), 'nowhere')
+>>> directory = tempfile.mkdtemp()
+>>> writer = TrajectoryWriter(directory, fields=('level',), chunk=2)
+>>> env = writer.attach(Levels())
+>>> env.add_object(RandomAgent(['NoOp'])).run(6)
+>>> writer.close()
+>>> TrajectoryReader(directory).column('percept_level').tolist()
+[0.0, 1.0, 2.0, 1.5, 2.0, 2.5]
+>>> writer = TrajectoryWriter(directory, fields=('place',), chunk=2)
+>>> env = writer.attach(Levels())
+>>> env = env.add_object(RandomAgent(['NoOp']))
+>>> for step in range(6): env.step()
+Traceback (most recent call last):
+ValueError: column percept_place holds values like ('i4', (2,)), not 'nowhere'
+>>> shutil.rmtree(directory)
+"""
+from agents import *
+from metrics import write_atomically
+import ast, json
+
+#______________________________________________________________________________
+
+class Column (object):
+    """A growable array of rows of the given dtype and shape, memory-mapped
+    from the file at path.  Room is made for twice as many rows whenever
+    it runs out; close() cuts the file down to the rows written."""
+
+    def __init__(self, path, dtype, shape=(), capacity=1024):
+        self.path, self.dtype, self.shape = path, numpy.dtype(dtype), shape
+        self.row_size = self.dtype.itemsize * int(numpy.prod(shape))
+        self.count = 0
+        self.array = None
+        open(path, 'wb').close()
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None ## Unmap before the file changes size
+        f = open(self.path, 'r+b')
+        f.truncate(capacity * self.row_size)
+        f.close()
+        self.capacity = capacity
+        if capacity:
+            self.array = numpy.memmap(self.path, self.dtype, 'r+',
+                                      shape=(capacity,) + self.shape)
+
+    def extend(self, rows):
+        rows = numpy.asarray(rows, self.dtype).reshape((-1,) + self.shape)
+        end = self.count + len(rows)
+        if end > self.capacity:
+            self.resize(max(end, 2 * self.capacity))
+        self.array[self.count:end] = rows
+        self.count = end
+
+    def flush(self):
+        if self.array is not None: self.array.flush()
+
+    def retype(self, dtype):
+        "Store rows as dtype from now on, converting those already written."
+        rows = numpy.array(self.array[:self.count]) if self.count else []
+        self.array = None
+        self.dtype = numpy.dtype(dtype)
+        self.row_size = self.dtype.itemsize * int(numpy.prod(self.shape))
+        open(self.path, 'wb').close()
+        self.count = 0
+        self.resize(self.capacity)
+        self.extend(rows)
+
+    def close(self):
+        self.resize(self.count)
+        self.flush()
+        self.array = None
+
+def value_kind(value):
+    """The (dtype, shape) to store values like value in, or None if they
+    should be stored as numbers into a list of the values seen."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, long)):
+        return ('i8', ())
+    if isinstance(value, float):
+        return ('f8', ())
+    if (isinstance(value, tuple) and value and
+        every(lambda v: isinstance(v, (int, long)), value)):
+        return ('i4', (len(value),))
+    return None
+
+class TrajectoryWriter (object):
+    """Writes the transitions of the environments it is attached to into
+    directory, in chunks of chunk transitions.  fields are the percept
+    fields to record, each read with env.percept_<field>(agent), as a
+    Percept would.  Call close() when done; until then, meta.json counts
+    the transitions written so far, so a reader sees only whole chunks."""
+
+    fixed_columns = [('step', 'i8'), ('episode', 'i4'), ('agent', 'i4'),
+                     ('action', None), ('reward', 'f4'), ('done', 'b1')]
+
+    def __init__(self, directory, fields=('status', 'location', 'bump'),
+                 chunk=65536):
+        require_numpy('TrajectoryWriter')
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.directory, self.fields, self.chunk = directory, fields, chunk
+        self.names = ([name for (name, dtype) in self.fixed_columns] +
+                      ['percept_' + field for field in fields])
+        self.buffers = dict([(name, []) for name in self.names])
+        self.columns = None ## Made at the first flush, from the values seen
+        self.vocabularies = {} ## Column name -> (codes, values)
+        self.episodes = {} ## Environment -> its episode number
+        self.pending = None
+        self.count = 0
+
+    def attach(self, env):
+        "Start a new episode, recording every step env takes; return env."
+        self.episodes[env] = len(self.episodes)
+        env.trajectory = self
+        return env
+
+    def observe(self, env):
+        "Read the agents' percepts and performance, before a step."
+        agents = env.agents
+        percepts = [[getattr(env, 'percept_' + field)(agent)
+                     for agent in agents] for field in self.fields]
+        self.pending = (env.trace.now, [agent.performance for agent in agents],
+                        percepts)
+
+    def record(self, env, actions):
+        "Buffer the transitions of the step observed last."
+        step, before, percepts = self.pending
+        agents, buffers = env.agents, self.buffers
+        n, done = len(agents), env.is_done()
+        buffers['step'].extend([step] * n)
+        buffers['episode'].extend([self.episodes[env]] * n)
+        buffers['agent'].extend(range(n))
+        buffers['action'].extend(actions)
+        buffers['reward'].extend([agent.performance - performance for
+                                  (agent, performance) in zip(agents, before)])
+        buffers['done'].extend([done or not agent.is_alive()
+                                for agent in agents])
+        for (field, values) in zip(self.fields, percepts):
+            buffers['percept_' + field].extend(values)
+        self.pending = None
+        if len(buffers['step']) >= self.chunk: self.flush()
+
+    def code(self, name, value):
+        "The number of value in the list of values of column name."
+        codes, values = self.vocabularies[name]
+        if value not in codes:
+            codes[value] = len(values)
+            values.append(value)
+        return codes[value]
+
+    def check_kinds(self, name, values):
+        """Make sure the column name, made for values of the kind of the
+        first one, can hold values: an int column becomes a float column
+        once floats come, and anything else that does not fit raises
+        ValueError, rather than being cut down to fit."""
+        column, kind = self.columns[name], self.kinds[name]
+        kinds = set(map(value_kind, values))
+        if kinds <= set([kind]): return
+        numbers = set([('i8', ()), ('f8', ())])
+        if kind in numbers and kinds <= numbers:
+            column.retype('f8')
+            self.kinds[name] = ('f8', ())
+            return
+        raise ValueError('column %s holds values like %r, not %r' % (
+            name, self.kinds[name], [v for v in values
+                                     if value_kind(v) != kind][0]))
+
+    def make_columns(self):
+        self.columns = {}
+        self.kinds = {} ## Percept column name -> the kind of its values
+        kinds = dict(self.fixed_columns)
+        for name in self.names:
+            if name in kinds: kind = kinds[name] and (kinds[name], ())
+            else: kind = self.kinds[name] = value_kind(self.buffers[name][0])
+            if kind is None:
+                self.vocabularies[name] = ({}, [])
+                kind = ('i4', ())
+            self.columns[name] = Column(
+                os.path.join(self.directory, name + '.dat'), *kind)
+
+    def flush(self):
+        "Write the buffered transitions to the files, and meta.json."
+        if not self.buffers['step']: return
+        if self.columns is None: self.make_columns()
+        for name in self.names:
+            values = self.buffers[name]
+            if name in self.vocabularies:
+                values = [self.code(name, value) for value in values]
+            elif name in self.kinds:
+                self.check_kinds(name, values)
+            self.columns[name].extend(values)
+            del self.buffers[name][:]
+        for column in self.columns.values():
+            column.flush()
+        self.count = self.columns['step'].count
+        self.write_meta()
+
+    def write_meta(self):
+        columns = dict([(name, dict(dtype=column.dtype.str,
+                                    shape=list(column.shape)))
+                        for (name, column) in self.columns.items()])
+        for (name, (codes, values)) in self.vocabularies.items():
+            columns[name]['values'] = map(repr, values)
+        write_atomically(os.path.join(self.directory, 'meta.json'),
+                         json.dumps(dict(count=self.count,
+                                         fields=list(self.fields),
+                                         columns=columns), sort_keys=True))
+
+    def close(self):
+        "Write what is left, and cut the files down to size."
+        self.flush()
+        for column in (self.columns or {}).values():
+            column.close()
+
+#______________________________________________________________________________
+
+def literal(text):
+    "The value that repr gave text for, or text itself if it cannot be read."
+    try:
+        return ast.literal_eval(text)
+    except (SyntaxError, ValueError):
+        return text
+
+class TrajectoryReader (object):
+    """The transitions in a directory written by a TrajectoryWriter.
+    column(name) is the memory-mapped array of a column, as stored;
+    reader[i] is transition i, decoded, and iterating gives them all;
+    chunks() and batch() give columns of many transitions at once."""
+
+    def __init__(self, directory):
+        require_numpy('TrajectoryReader')
+        f = open(os.path.join(directory, 'meta.json'))
+        try:
+            meta = json.load(f)
+        finally:
+            f.close()
+        self.directory = directory
+        self.count, self.fields = meta['count'], map(str, meta['fields'])
+        self.columns, self.values = {}, {}
+        for (name, spec) in meta['columns'].items():
+            name = str(name)
+            shape = (self.count,) + tuple(spec['shape'])
+            if self.count:
+                self.columns[name] = numpy.memmap(
+                    os.path.join(directory, name + '.dat'),
+                    numpy.dtype(str(spec['dtype'])), 'r', shape=shape)
+            else:
+                self.columns[name] = numpy.zeros(shape, str(spec['dtype']))
+            if 'values' in spec:
+                self.values[name] = map(literal, spec['values'])
+
+    def __len__(self):
+        return self.count
+
+    def column(self, name):
+        return self.columns[name]
+
+    def decode(self, name, stored):
+        "The value of an entry of a column, as it was recorded."
+        if name in self.values: return self.values[name][int(stored)]
+        if numpy.ndim(stored): return tuple(stored.tolist())
+        return stored.item()
+
+    def __getitem__(self, i):
+        if i < 0: i += self.count
+        if not 0 <= i < self.count: raise IndexError(i)
+        get = lambda name: self.decode(name, self.columns[name][i])
+        return Struct(step=get('step'), episode=get('episode'),
+                      agent=get('agent'), action=get('action'),
+                      reward=get('reward'), done=get('done'),
+                      percept=tuple([get('percept_' + field)
+                                     for field in self.fields]))
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def chunks(self, size=65536):
+        """Dicts of column name -> the slice of the column for each run of
+        size transitions, in order.  The slices are views of the files."""
+        for start in xrange(0, self.count, size):
+            yield dict([(name, column[start:start + size])
+                        for (name, column) in self.columns.items()])
+
+    def batch(self, indices):
+        "A dict of column name -> the rows at indices, read into memory."
+        indices = numpy.sort(numpy.asarray(indices))
+        return dict([(name, numpy.asarray(column[indices]))
+                     for (name, column) in self.columns.items()])
+
+    def sample(self, n, seed=None):
+        "A batch of n transitions drawn at random, with replacement."
+        rng = numpy.random.RandomState(seed)
+        return self.batch(rng.randint(self.count, size=n))
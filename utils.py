@@ -220,6 +220,23 @@ except NameError:
 
 
 
+#______________________________________________________________________________
+# Optional packages
+
+# NumPy is used, where it is installed, by the parts of the code that work
+# on whole grids or populations at once.  Everything else runs without it;
+# the parts that need it raise ImportError when they are used without it.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def require_numpy(what):
+    "Raise ImportError, saying what needs NumPy, if NumPy is not installed."
+    if numpy is None:
+        raise ImportError('%s needs NumPy, which is not installed' % what)
+
 #______________________________________________________________________________
 # Simple Data Structures: infinity, Dict, Struct
 
@@ -232,17 +249,33 @@ def Dict(**entries):
     """
     return entries
 
+## Types whose values can be shared between keys without copying.
+immutable_types = (int, long, float, complex, bool, str, unicode,
+                   frozenset, type(None))
+
 class DefaultDict(dict):
-    """Dictionary with a default value for unknown keys."""
-    def __init__(self, default):
+    """Dictionary with a default value for unknown keys.
+    The default is either a value, which is deep-copied for each new key
+    (unless it is immutable, in which case it is shared), or a factory,
+    a function of no arguments called to make the value for each new key:
+    DefaultDict(factory=list) is faster than DefaultDict([])."""
+    def __init__(self, default=None, factory=None):
         self.default = default
-
-    def __getitem__(self, key):
-        if key in self: return self.get(key)
-        return self.setdefault(key, copy.deepcopy(self.default))
+        self.factory = factory
+        self.shared = factory is None and type(default) in immutable_types
+
+    def __missing__(self, key):
+        if self.factory is not None:
+            value = self.factory()
+        elif self.shared:
+            value = self.default
+        else:
+            value = copy.deepcopy(self.default)
+        self[key] = value
+        return value
 
     def __copy__(self):
-        copy = DefaultDict(self.default)
+        copy = DefaultDict(self.default, self.factory)
         copy.update(self)
         return copy
 
@@ -790,6 +823,12 @@ __doc__ += """
 >>> d['x']
 [1]
 
+>>> d = DefaultDict(factory=list)
+>>> d['x'].append(1)
+>>> d['y'].append(2)
+>>> d['x'], d.get('z'), len(d)
+([1], None, 2)
+
 >>> s = Struct(a=1, b=2)
 >>> s.a
 1